@@ -0,0 +1,182 @@
+"""
+This module contains the automatic beat and downbeat tracking.
+
+The onset strength envelope is computed chunk by chunk over the decoded audio, so the
+analysis can run as a cancellable background job with progress. Beats are tracked on
+the envelope, and the downbeats are the beats of the phase with the strongest bass
+onsets. The peaks of the same envelope make the onset index, the sorted onset times
+tapped markers are snapped to. All times are in ms of the original audio, like
+Core.beats and Core.measures, so they hold at every rate.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import librosa
+
+from pcm import to_mono
+
+HOP_LENGTH = 512
+N_MELS = 128
+# Length of the chunks the onset envelope is computed in
+CHUNK_SECONDS = 30
+# Extra audio on each side of a chunk, so the spectrogram frames at the edges match
+CONTEXT_FRAMES = 4
+# Mel bands below this frequency make up the bass envelope used for downbeats
+BASS_FMAX = 200.0
+BEATS_PER_MEASURE = 4
+
+# Names of the arrays cached next to the decoded audio
+BEATS_NAME = "beats"
+MEASURES_NAME = "measures"
+ONSETS_NAME = "onsets"
+
+
+def onset_envelopes(audio_array, sample_rate, job=None):
+    """
+    Computes the onset strength envelope of the audio and of its bass, chunk by chunk.
+
+    Args:
+        audio_array (np.array): The audio array.
+        sample_rate (int): The sample rate.
+        job (jobs.Job): The job running the analysis, for cancellation and progress.
+
+    Returns:
+        tuple: The full and the bass onset envelopes with one value per HOP_LENGTH
+            frames, or None if the job was cancelled.
+    """
+    num_frames = audio_array.shape[-1]
+    chunk_frames = max(1, int(CHUNK_SECONDS * sample_rate) // HOP_LENGTH) * HOP_LENGTH
+    context = CONTEXT_FRAMES * HOP_LENGTH
+    mel_frequencies = librosa.mel_frequencies(n_mels=N_MELS, fmax=sample_rate / 2)
+    num_bass_bands = max(1, int(np.sum(mel_frequencies < BASS_FMAX)))
+
+    full, bass = [], []
+    for start in range(0, num_frames, chunk_frames):
+        if job is not None and job.cancelled.is_set():
+            return None
+        end = min(num_frames, start + chunk_frames)
+        input_start = max(0, start - context)
+        input_end = min(num_frames, end + context)
+
+        audio = to_mono(audio_array[..., input_start:input_end])
+        spectrogram = librosa.power_to_db(librosa.feature.melspectrogram(
+            y=audio, sr=sample_rate, hop_length=HOP_LENGTH, n_mels=N_MELS))
+        skip = (start - input_start) // HOP_LENGTH
+        count = -(-(end - start) // HOP_LENGTH)
+        full.append(librosa.onset.onset_strength(
+            S=spectrogram, sr=sample_rate, hop_length=HOP_LENGTH)[skip:skip + count])
+        bass.append(librosa.onset.onset_strength(
+            S=spectrogram[:num_bass_bands], sr=sample_rate,
+            hop_length=HOP_LENGTH)[skip:skip + count])
+
+        if job is not None:
+            job.progress = end / num_frames
+
+    return np.concatenate(full), np.concatenate(bass)
+
+
+def track_beats(audio_array, sample_rate, job=None, beats_per_measure=BEATS_PER_MEASURE):
+    """
+    Tracks the beats and the downbeats of the audio.
+
+    Returns:
+        tuple: The beat times and the measure (downbeat) times in ms, and the tempo in
+            beats per minute, or None if the job was cancelled.
+    """
+    envelopes = onset_envelopes(audio_array, sample_rate, job)
+    if envelopes is None:
+        return None
+    return beats_from_envelopes(*envelopes, sample_rate, beats_per_measure)
+
+
+def track_beats_and_onsets(audio_array, sample_rate, job=None):
+    """
+    Tracks the beats and the downbeats and picks the onsets of the audio, computing
+    the onset envelope once.
+
+    Returns:
+        tuple: The beat, measure and onset times in ms and the tempo, like
+            track_beats, or None if the job was cancelled.
+    """
+    envelopes = onset_envelopes(audio_array, sample_rate, job)
+    if envelopes is None:
+        return None
+    beats, measures, tempo = beats_from_envelopes(*envelopes, sample_rate)
+    return beats, measures, pick_onsets(envelopes[0], sample_rate), tempo
+
+
+def detect_onsets(audio_array, sample_rate, job=None):
+    """
+    Returns the onset times of the audio in ms, sorted, or None if the job was
+    cancelled.
+    """
+    envelopes = onset_envelopes(audio_array, sample_rate, job)
+    if envelopes is None:
+        return None
+    return pick_onsets(envelopes[0], sample_rate)
+
+
+def pick_onsets(envelope, sample_rate):
+    """
+    Returns the times in ms of the peaks of an onset envelope, sorted.
+    """
+    frames = librosa.onset.onset_detect(onset_envelope=envelope, sr=sample_rate,
+                                        hop_length=HOP_LENGTH)
+    return np.asarray(frames, dtype=np.float64) * HOP_LENGTH / sample_rate * 1000
+
+
+def beats_from_envelopes(full, bass, sample_rate, beats_per_measure=BEATS_PER_MEASURE):
+    """
+    Tracks the beats on the onset envelope and the downbeats on the bass envelope.
+
+    Returns:
+        tuple: The beat times and the measure (downbeat) times in ms, and the tempo in
+            beats per minute.
+    """
+    tempo, beat_frames = librosa.beat.beat_track(
+        onset_envelope=full, sr=sample_rate, hop_length=HOP_LENGTH)
+    beat_frames = np.asarray(beat_frames)
+    beats = beat_frames * HOP_LENGTH / sample_rate * 1000
+
+    # The downbeats are the beats of the phase with the strongest bass onsets
+    measures = np.zeros(0)
+    if len(beat_frames) >= beats_per_measure:
+        scores = [bass[beat_frames[phase::beats_per_measure]].mean()
+                  for phase in range(beats_per_measure)]
+        measures = beats[int(np.argmax(scores))::beats_per_measure]
+
+    return beats, measures, float(np.atleast_1d(tempo)[0])
+
+
+def benchmark(seconds, sample_rate=44100, bpm=120):
+    """
+    Times the analysis of a synthetic click track and reports the real-time factor.
+    """
+    rng = np.random.default_rng(0)
+    audio = rng.standard_normal(int(seconds * sample_rate)).astype(np.float32) * 0.01
+    beat_frames = np.arange(0, len(audio) - 2000, int(60 / bpm * sample_rate))
+    click = np.hanning(2000).astype(np.float32) * np.sin(np.arange(2000) * 0.3)
+    for index, frame in enumerate(beat_frames):
+        audio[frame:frame + 2000] += click * (1.0 if index % 4 == 0 else 0.5)
+    audio = audio[np.newaxis] * 0.6
+
+    # Warm up librosa, whose first call compiles its kernels
+    track_beats(audio[:, :10 * sample_rate], sample_rate)
+
+    started = time.perf_counter()
+    beats, measures, onsets, tempo = track_beats_and_onsets(audio, sample_rate)
+    elapsed = time.perf_counter() - started
+    print(f"Analyzed {seconds:.0f} s in {elapsed:.2f} s "
+          f"({seconds / elapsed:.0f}x real time)")
+    print(f"Tempo {tempo:.1f} BPM, {len(beats)} beats, {len(measures)} measures, "
+          f"{len(onsets)} onsets")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark beat tracking on a synthetic track.")
+    parser.add_argument("--seconds", type=float, default=300)
+    args = parser.parse_args()
+    benchmark(args.seconds)
@@ -0,0 +1,195 @@
+"""
+This module contains the headless batch mode.
+
+It precomputes everything the app would compute for a folder of recordings: the
+decoded audio in the cache, the waveform envelopes, the beats, measures and onsets,
+and slowed renders at chosen rates written to WAV files. It uses the functions of core.py
+and runs without pygame or Tk.
+
+Files are processed on a process pool. Every step is skipped when its result already
+exists and the renders are written under a temporary name, so an interrupted run
+resumes where it stopped when started again. The renders mirror the folders of the
+recordings under the output folder, so recordings of the same name do not collide.
+
+    python batch.py ~/Recordings --rates 0.8 0.5 --workers 4
+"""
+
+import argparse
+import os
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import analysis
+from cache import AudioCache, DEFAULT_CACHE_DIR, write_atomically
+from core import ENVELOPE_NAME, read_audio_file, stretch_audio
+from pcm import to_int16
+from waveform import WaveformPyramid
+
+# Extensions of the files picked up in a folder
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aac")
+
+DEFAULT_RATES = (0.8, 0.5)
+DEFAULT_OUTPUT_DIR = "renders"
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def find_audio_files(paths):
+    """
+    Returns the audio files given directly or found in the given folders.
+
+    Returns:
+        list: The sorted (path, relative path) of every file, the relative path being
+            relative to the deepest folder holding all files, so it is unique.
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                files.update(os.path.abspath(os.path.join(directory, name))
+                             for name in names if name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            files.add(os.path.abspath(path))
+    if not files:
+        return []
+    root = os.path.commonpath([os.path.dirname(file_path) for file_path in files])
+    return [(file_path, os.path.relpath(file_path, root)) for file_path in sorted(files)]
+
+
+def render_path(relative_path, rate, output_dir):
+    """
+    Returns the path of the render of a file at a rate, e.g. live/song-0.8x.wav for
+    live/song.mp3.
+    """
+    stem = os.path.splitext(relative_path)[0]
+    return os.path.join(output_dir, f"{stem}-{rate:g}x.wav")
+
+
+def write_wav(path, audio_array, sample_rate):
+    """
+    Writes an audio array to a 16-bit WAV file, under a unique temporary name until
+    complete.
+    """
+    samples = to_int16(audio_array)
+
+    def write(file):
+        with wave.open(file, "wb") as wav_file:
+            wav_file.setnchannels(samples.shape[1])
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(samples.tobytes())
+    write_atomically(path, write)
+
+
+def process_file(file_path, relative_path, rates, output_dir, cache_dir, beats=True):
+    """
+    Runs the missing steps for one file. Runs in a worker process.
+
+    Args:
+        file_path (str): The path to the audio file.
+        relative_path (str): The path the renders mirror under the output folder.
+
+    Returns:
+        tuple: The length of the audio in seconds and the (step, seconds) timings of
+            the steps that ran.
+    """
+    cache = AudioCache(cache_dir)
+    timings = []
+    renders = [(rate, render_path(relative_path, rate, output_dir)) for rate in rates]
+    key = cache.key_for(file_path)
+
+    def cached(name):
+        return os.path.exists(cache.array_path(key, name))
+
+    def store(name, array):
+        # The entry may have been evicted by another worker
+        if os.path.isdir(cache.entry_dir(key)):
+            cache.store_array(key, name, array)
+
+    started = time.perf_counter()
+    audio_array, sample_rate, _ = cache.get(file_path, read_audio_file)
+    timings.append(("decode", time.perf_counter() - started))
+
+    if not cached(ENVELOPE_NAME):
+        started = time.perf_counter()
+        store(ENVELOPE_NAME, WaveformPyramid.build(audio_array).to_array())
+        timings.append(("envelope", time.perf_counter() - started))
+
+    if beats and not (cached(analysis.BEATS_NAME) and cached(analysis.MEASURES_NAME)
+                      and cached(analysis.ONSETS_NAME)):
+        started = time.perf_counter()
+        beat_times, measure_times, onset_times, _ = analysis.track_beats_and_onsets(
+            audio_array, sample_rate)
+        store(analysis.BEATS_NAME, beat_times)
+        store(analysis.MEASURES_NAME, measure_times)
+        store(analysis.ONSETS_NAME, onset_times)
+        timings.append(("beats", time.perf_counter() - started))
+
+    for rate, path in renders:
+        if os.path.exists(path):
+            continue
+        started = time.perf_counter()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_wav(path, stretch_audio(audio_array, rate), sample_rate)
+        timings.append((f"render {rate:g}x", time.perf_counter() - started))
+
+    return audio_array.shape[-1] / sample_rate, timings
+
+
+def run_batch(paths, rates, output_dir, cache_dir, workers, beats=True):
+    """
+    Processes the audio files on a process pool and reports the timing of every
+    file and the total throughput.
+    """
+    files = find_audio_files(paths)
+    if not files:
+        print("No audio files found")
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Processing {len(files)} files with {workers} workers")
+
+    started = time.perf_counter()
+    total_seconds = 0.0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_file, file_path, relative_path, rates,
+                                   output_dir, cache_dir, beats): relative_path
+                   for file_path, relative_path in files}
+        try:
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    seconds, timings = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    failed += 1
+                    print(f"{name}: failed: {error}")
+                    continue
+                total_seconds += seconds
+                steps = ", ".join(f"{step} {elapsed:.1f} s" for step, elapsed in timings)
+                print(f"{name} ({seconds:.0f} s): {steps}")
+        except KeyboardInterrupt:
+            print("Interrupted, run again to resume")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    elapsed = time.perf_counter() - started
+    print(f"Processed {len(files) - failed} files, {total_seconds / 60:.1f} min of "
+          f"audio in {elapsed:.1f} s ({total_seconds / elapsed:.1f}x real time), "
+          f"{failed} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the cache, beats and slowed renders of recordings.")
+    parser.add_argument("paths", nargs="+", help="audio files or folders")
+    parser.add_argument("--rates", type=float, nargs="*", default=list(DEFAULT_RATES),
+                        help="rates of the slowed renders")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR,
+                        help="folder of the rendered WAV files")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--no-beats", action="store_true",
+                        help="skip the beat tracking")
+    args = parser.parse_args()
+    run_batch(args.paths, args.rates, args.output, args.cache_dir, args.workers,
+              beats=not args.no_beats)
@@ -0,0 +1,260 @@
+"""
+This module contains the benchmark suite of the audio and plotting hot paths.
+
+The suite generates a synthetic recording of configurable length, sample rate and
+channel count, so it needs no external files, and times decoding, slicing,
+stretching, the playback block preparation, plain and with real-time stretching or
+filtering, and the waveform drawing under the Agg backend and by the raster view.
+Every benchmark reports the median and the minimum of its repeats and its peak memory,
+measured in a separate run with tracemalloc so that tracing does not slow the timed
+runs.
+
+    python bench.py run --seconds 120 --channels 2 --output results.json
+    python bench.py compare baseline.json results.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+import matplotlib
+
+# Draw offscreen, without Tk
+matplotlib.use("Agg")
+
+# pylint: disable=wrong-import-position
+from core import Core, get_audio_array, read_audio_file, stretch_audio
+from pcm import to_int16
+from playback import BLOCK_FRAMES, LoopStream
+from plot import Plot
+from raster import WaveformRaster
+
+DEFAULT_SECONDS = 60
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_CHANNELS = 2
+DEFAULT_REPEAT = 5
+# Length of the region stretched by the stretch benchmark
+STRETCH_SECONDS = 10
+# A benchmark is a regression when it is slower than the baseline by this fraction
+DEFAULT_THRESHOLD = 0.2
+# Differences below this many seconds are timer noise
+MIN_DIFFERENCE = 0.001
+
+
+def synthetic_audio(seconds, sample_rate, num_channels, seed=0):
+    """
+    Returns a reproducible (channels, frames) float32 recording: a chord, a click
+    every half second and some noise.
+    """
+    rng = np.random.default_rng(seed)
+    num_frames = int(seconds * sample_rate)
+    times = np.arange(num_frames) / sample_rate
+    audio = sum(np.sin(2 * np.pi * frequency * times) for frequency in (220, 277, 330))
+    audio = audio / 3 * 0.3 + rng.standard_normal(num_frames) * 0.02
+    click = np.hanning(400) * 0.5
+    for frame in range(0, num_frames - len(click), sample_rate // 2):
+        audio[frame:frame + len(click)] += click
+    audio = np.clip(audio, -1, 1).astype(np.float32)
+    if num_channels == 2:
+        return np.stack((audio, audio[::-1]))
+    return audio[np.newaxis]
+
+
+def write_wav(path, audio_array, sample_rate):
+    samples = to_int16(audio_array)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(samples.shape[1])
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+
+
+def measure(function, repeat):
+    """
+    Times a function and measures its peak memory.
+
+    Returns:
+        dict: The median and minimum time in seconds and the peak memory in MB.
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": statistics.median(times), "min_seconds": min(times),
+            "repeat": repeat, "peak_mb": peak / 1024 ** 2}
+
+
+def run_benchmarks(seconds, sample_rate, num_channels, repeat):
+    """
+    Runs the benchmarks on a synthetic recording.
+
+    Returns:
+        dict: The results by benchmark name.
+    """
+    audio = synthetic_audio(seconds, sample_rate, num_channels)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "synthetic.wav")
+        write_wav(path, audio, sample_rate)
+        results["read_audio_file"] = measure(lambda: read_audio_file(path), repeat)
+
+    results["get_audio_array"] = measure(
+        lambda: get_audio_array(audio, seconds / 4, seconds / 2, sample_rate).copy(),
+        repeat)
+
+    region = audio[:, :int(min(seconds, STRETCH_SECONDS) * sample_rate)]
+    # Warm up librosa, whose first call compiles its kernels
+    stretch_audio(region[:, :sample_rate], 0.8)
+    results["stretch_audio"] = measure(lambda: stretch_audio(region, 0.8), repeat)
+
+    # The blocks play_mp3 hands to the output: one second of them
+    stream = LoopStream()
+    stream.set_source(audio)
+    block = np.zeros((BLOCK_FRAMES, 2), dtype=np.int16)
+
+    def render_blocks():
+        for _ in range(sample_rate // BLOCK_FRAMES):
+            stream.render(block)
+    results["play_blocks"] = measure(render_blocks, repeat)
+
+    # The same blocks stretched in real time by the live mode
+    stream.set_rate(0.8, sample_rate)
+    results["live_stretch_blocks"] = measure(render_blocks, repeat)
+
+    # Unstretched blocks through the voice isolation filter
+    stream.set_rate(None, sample_rate)
+    stream.set_filter("voice", sample_rate)
+    results["filtered_blocks"] = measure(render_blocks, repeat)
+
+    plot = Plot(None)
+    core = Core(None, plot)
+    core.original_data = audio
+    core.playing_data = audio
+    core.sample_rate = sample_rate
+    core.num_channels = num_channels
+
+    def display_waveform():
+        # Without the envelope, so that it is built like on a first load
+        core.pyramid = None
+        plot.display_waveform(core)
+    results["display_waveform"] = measure(display_waveform, repeat)
+
+    def draw_plot():
+        plot.current_plot_pos = (plot.current_plot_pos + 5000) % plot.plot_length
+        plot.draw_plot()
+    results["draw_plot"] = measure(draw_plot, repeat)
+
+    # The same windows rasterized at the size of the figure
+    raster = WaveformRaster()
+    size = plot.canvas.get_width_height()
+
+    def draw_raster():
+        plot.current_plot_pos = (plot.current_plot_pos + 5000) % plot.plot_length
+        start = plot.current_plot_pos * plot.plot_downsample
+        raster.render(plot.pyramid, audio, start,
+                      start + int(plot.plot_window) * plot.plot_downsample,
+                      plot.ax.get_ylim(), size)
+    results["draw_raster"] = measure(draw_raster, repeat)
+    core.on_closing()
+    return results
+
+
+def run(args):
+    started = time.perf_counter()
+    results = run_benchmarks(args.seconds, args.sample_rate, args.channels, args.repeat)
+    report = {
+        "meta": {"seconds": args.seconds, "sample_rate": args.sample_rate,
+                 "channels": args.channels, "python": platform.python_version(),
+                 "numpy": np.__version__, "machine": platform.machine(),
+                 "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:18} {result['seconds'] * 1000:9.1f} ms "
+              f"(min {result['min_seconds'] * 1000:.1f} ms), "
+              f"peak {result['peak_mb']:.1f} MB")
+    print(f"Ran in {time.perf_counter() - started:.1f} s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def compare(args):
+    """
+    Compares results with a baseline. Exits with status 1 if any benchmark got
+    slower or used more memory than the threshold allows.
+
+    The minimum times are compared, which vary much less between runs than the
+    medians on a busy machine.
+    """
+    with open(args.baseline, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(args.results, "r", encoding="utf-8") as file:
+        results = json.load(file)
+    different = [key for key in baseline["meta"]
+                 if key != "time" and baseline["meta"][key] != results["meta"].get(key)]
+    if different:
+        print(f"Warning: the runs differ in {', '.join(different)}")
+
+    regressions = 0
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:18} new")
+            continue
+        ratio = result["min_seconds"] / base["min_seconds"]
+        memory_ratio = result["peak_mb"] / max(base["peak_mb"], 1e-6)
+        flags = []
+        if (ratio > 1 + args.threshold
+                and result["min_seconds"] - base["min_seconds"] > MIN_DIFFERENCE):
+            flags.append("SLOWER")
+        if memory_ratio > 1 + args.threshold and result["peak_mb"] - base["peak_mb"] > 1:
+            flags.append("MORE MEMORY")
+        regressions += bool(flags)
+        print(f"{name:18} {base['min_seconds'] * 1000:9.1f} -> "
+              f"{result['min_seconds'] * 1000:9.1f} ms ({ratio:5.2f}x), "
+              f"{base['peak_mb']:.1f} -> {result['peak_mb']:.1f} MB "
+              f"{' '.join(flags)}")
+    print(f"{regressions} regressions")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the audio and plotting hot paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--seconds", type=float, default=DEFAULT_SECONDS)
+    run_parser.add_argument("--sample-rate", type=int, default=DEFAULT_SAMPLE_RATE)
+    run_parser.add_argument("--channels", type=int, choices=(1, 2),
+                            default=DEFAULT_CHANNELS)
+    run_parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    run_parser.add_argument("--output", help="JSON file to write the results to")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare results with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
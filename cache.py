@@ -0,0 +1,307 @@
+"""
+This module contains the on-disk cache of decoded audio.
+
+Decoding a long MP3 through ffmpeg takes seconds, so the decoded PCM is stored as a
+.npy file together with its sample rate and channel count. Later loads memory-map the
+.npy file, which opens in milliseconds and only pages in the regions that are used.
+Entries are keyed by the path, size, modification time and a hash of the file content,
+and the least recently used entries are evicted when the cache exceeds its size cap.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "music-transcriber")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Number of bytes hashed at the start and at the end of the file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+AUDIO_NAME = "audio"
+META_FILE = "meta.json"
+# Layout of the stored audio. Entries of another layout are decoded again.
+AUDIO_FORMAT = "float32-channels-frames"
+# An entry is marked as used on a load at most this often, in seconds
+TOUCH_INTERVAL = 60
+
+
+def file_fingerprint(file_path):
+    """
+    Returns a dictionary that identifies the content of a file.
+
+    Only the first and the last HASH_BLOCK_SIZE bytes are hashed, which together with
+    the size and the modification time is enough to detect a changed recording without
+    reading the whole file.
+
+    Args:
+        file_path (str): The path to the file.
+
+    Returns:
+        dict: The path, size, mtime and content hash of the file.
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    content_hash = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        content_hash.update(file.read(HASH_BLOCK_SIZE))
+        if stat.st_size > 2 * HASH_BLOCK_SIZE:
+            file.seek(-HASH_BLOCK_SIZE, os.SEEK_END)
+            content_hash.update(file.read(HASH_BLOCK_SIZE))
+    return {
+        "path": file_path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "content_hash": content_hash.hexdigest(),
+    }
+
+
+def write_atomically(path, write, mode="wb"):
+    """
+    Writes a file under a unique temporary name in its folder and renames it into
+    place, so readers never see a partial file and concurrent writers of the same
+    file, on threads or in processes, never share a temporary file.
+
+    Args:
+        path (str): The path of the file.
+        write (callable): Called with the open temporary file.
+        mode (str): The mode to open the temporary file in.
+    """
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    encoding = None if "b" in mode else "utf-8"
+    try:
+        with os.fdopen(descriptor, mode, encoding=encoding) as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def fingerprint_key(fingerprint):
+    """
+    Returns the cache key of a file fingerprint.
+    """
+    text = json.dumps(fingerprint, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """
+    The AudioCache class stores decoded audio and derived arrays on disk.
+
+    Every cached file has its own entry directory holding the decoded audio, a
+    meta.json file and any other arrays stored for it.
+
+    Attributes:
+        cache_dir (str): The directory holding the cache entries.
+        max_bytes (int): The size cap of the cache in bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key_for(self, file_path):
+        """
+        Returns the cache key of the file at the given path.
+        """
+        return fingerprint_key(file_fingerprint(file_path))
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def array_path(self, key, name):
+        return os.path.join(self.entry_dir(key), f"{name}.npy")
+
+    def read_meta(self, key):
+        meta_path = os.path.join(self.entry_dir(key), META_FILE)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, key, meta):
+        meta_path = os.path.join(self.entry_dir(key), META_FILE)
+        write_atomically(meta_path, lambda file: json.dump(meta, file), "w")
+
+    def touch(self, key, meta=None):
+        """
+        Marks the entry as used now, for the LRU eviction. The meta file is only
+        rewritten if the entry was not marked within TOUCH_INTERVAL, and a failure,
+        e.g. because the entry was evicted meanwhile, is ignored.
+        """
+        meta = meta if meta is not None else self.read_meta(key)
+        now = time.time()
+        if meta is None or now - meta.get("last_access", 0) < TOUCH_INTERVAL:
+            return
+        meta["last_access"] = now
+        try:
+            self.write_meta(key, meta)
+        except OSError:
+            pass
+
+    def load_array(self, key, name, mmap=True):
+        """
+        Loads an array of a cache entry.
+
+        Args:
+            key (str): The cache key.
+            name (str): The name of the array.
+            mmap (bool): Whether to memory-map the array instead of reading it.
+
+        Returns:
+            np.array: The array, or None if it is not cached.
+        """
+        path = self.array_path(key, name)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r" if mmap else None)
+
+    def store_array(self, key, name, array):
+        """
+        Stores an array in a cache entry. The entry must already exist.
+        """
+        write_atomically(self.array_path(key, name),
+                         lambda file: np.save(file, np.ascontiguousarray(array)))
+
+    def load(self, file_path):
+        """
+        Loads the decoded audio of a file from the cache.
+
+        Args:
+            file_path (str): The path to the audio file.
+
+        Returns:
+            tuple: The memory-mapped audio array, sample rate and number of channels,
+                or None if the file is not cached.
+        """
+        key = self.key_for(file_path)
+        meta = self.read_meta(key)
+        if meta is None or meta.get("format") != AUDIO_FORMAT:
+            return None
+        audio_array = self.load_array(key, AUDIO_NAME)
+        if audio_array is None:
+            return None
+        self.touch(key, meta)
+        return audio_array, meta["sample_rate"], meta["num_channels"]
+
+    def store(self, file_path, audio_array, sample_rate, num_channels):
+        """
+        Stores the decoded audio of a file and evicts old entries if needed. The
+        arrays derived from a previous version of the entry are removed.
+
+        Returns:
+            str: The cache key of the file.
+        """
+        fingerprint = file_fingerprint(file_path)
+        key = fingerprint_key(fingerprint)
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        os.makedirs(self.entry_dir(key), exist_ok=True)
+        self.store_array(key, AUDIO_NAME, audio_array)
+        meta = dict(fingerprint, sample_rate=sample_rate, num_channels=num_channels,
+                    format=AUDIO_FORMAT, last_access=time.time())
+        self.write_meta(key, meta)
+        self.evict()
+        return key
+
+    def get(self, file_path, decode):
+        """
+        Returns the decoded audio of a file, decoding and caching it on a miss.
+
+        Args:
+            file_path (str): The path to the audio file.
+            decode (callable): Called with the path on a miss. Returns the audio
+                array, sample rate and number of channels.
+
+        Returns:
+            tuple: The memory-mapped audio array, sample rate and number of channels.
+        """
+        cached = self.load(file_path)
+        if cached is not None:
+            print(f"Loaded {file_path} from cache")
+            return cached
+
+        audio_array, sample_rate, num_channels = decode(file_path)
+        self.store(file_path, audio_array, sample_rate, num_channels)
+        cached = self.load(file_path)
+        if cached is None:
+            # The entry was evicted right away because it is larger than the cap
+            return audio_array, sample_rate, num_channels
+        return cached
+
+    def entries(self):
+        """
+        Returns a list of (key, last access time, size in bytes) of all entries.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self.entry_dir(key)
+            if not os.path.isdir(entry_dir):
+                continue
+            meta = self.read_meta(key) or {}
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir)
+                       if entry.is_file())
+            entries.append((key, meta.get("last_access", 0), size))
+        return entries
+
+    def size(self):
+        """
+        Returns the total size of the cache in bytes.
+        """
+        return sum(size for _, _, size in self.entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits its size cap.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+            print(f"Evicted cache entry {key}")
+
+    def remove(self, file_path):
+        """
+        Removes the entry of a file from the cache.
+        """
+        shutil.rmtree(self.entry_dir(self.key_for(file_path)),
+                      ignore_errors=True)
+
+    def purge(self):
+        """
+        Removes all entries from the cache.
+        """
+        for key, _, _ in self.entries():
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        print(f"Purged cache {self.cache_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inspect or purge the decoded audio cache.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--purge", action="store_true",
+                        help="remove all cache entries")
+    args = parser.parse_args()
+
+    cache = AudioCache(args.cache_dir)
+    if args.purge:
+        cache.purge()
+    else:
+        entries = cache.entries()
+        print(f"{len(entries)} entries, {cache.size() / 1024 ** 2:.1f} MB "
+              f"in {cache.cache_dir}")
@@ -5,11 +5,33 @@ It includes functions to read an audio file, get a specific segment of an audio
 and stretch the audio array. It also contains the Core class (definition not fully shown here).
 """
 
-import pygame
+import os
+import subprocess
+import time
+import wave
+
 from pydub import AudioSegment
+from pydub.utils import get_encoder_name, mediainfo
 import numpy as np
 import librosa
 
+import analysis
+import export
+import filters
+import markers
+import notes
+import telemetry
+import pcm
+from cache import AudioCache
+from jobs import JobScheduler
+from playlist import Playlist
+from stretch import StretchCache, StretchJob
+from taps import CALIBRATION_TAPS, TapCorrector
+from waveform import WaveformPyramid
+
+# Name of the cached envelope pyramid of the decoded audio
+ENVELOPE_NAME = "envelope"
+
 
 def read_audio_file(file_path):
     """
@@ -19,19 +41,92 @@ def read_audio_file(file_path):
         file_path (str): The path to the audio file.
 
     Returns:
-        tuple: A tuple containing the audio array, sample rate, and number of channels.
+        tuple: A tuple containing the audio array as (channels, frames) float32, the
+            sample rate, and the number of channels.
     """
     audio_segment = AudioSegment.from_file(file_path)
     sample_rate = audio_segment.frame_rate
     num_channels = audio_segment.channels
-    raw_data = audio_segment.raw_data
-    audio_array = np.frombuffer(raw_data, dtype=np.int16)
-    if num_channels == 2:
-        audio_array = audio_array.reshape((-1, 2))
+    audio_array = pcm.from_pcm(audio_segment.raw_data, audio_segment.sample_width,
+                               num_channels)
 
     return audio_array, sample_rate, num_channels
 
 
+# Number of frames in a block yielded by stream_audio_file
+BLOCK_FRAMES = 65536
+
+# Length of the region stretched from the playhead when no loop is selected
+STRETCH_REGION_SECONDS = 60
+
+# Factor by which every click on Slow Down slows the audio
+SLOW_DOWN_FACTOR = 0.8
+
+
+def stream_audio_file(file_path, block_frames=BLOCK_FRAMES):
+    """
+    Opens an audio file for decoding in blocks instead of all at once.
+
+    PCM WAV files are read directly, other formats are decoded by an ffmpeg process
+    that writes 32-bit float samples to a pipe.
+
+    Args:
+        file_path (str): The path to the audio file.
+        block_frames (int): The number of frames in a block.
+
+    Returns:
+        tuple: A tuple containing the sample rate, the number of channels, the
+            (estimated) number of frames, and a generator yielding blocks of at
+            most block_frames frames, in the format of read_audio_file.
+    """
+    if file_path.lower().endswith(".wav"):
+        try:
+            with wave.open(file_path, "rb") as wav_file:
+                sample_width = wav_file.getsampwidth()
+                sample_rate = wav_file.getframerate()
+                num_channels = wav_file.getnchannels()
+                num_frames = wav_file.getnframes()
+        except wave.Error:
+            pass  # not PCM, e.g. float samples
+        else:
+            return sample_rate, num_channels, num_frames, _wav_blocks(
+                file_path, sample_width, num_channels, block_frames)
+
+    info = mediainfo(file_path)
+    sample_rate = int(info["sample_rate"])
+    num_channels = int(info["channels"])
+    num_frames = int(float(info.get("duration", 0)) * sample_rate)
+    return sample_rate, num_channels, num_frames, _ffmpeg_blocks(
+        file_path, num_channels, block_frames)
+
+
+def _wav_blocks(file_path, sample_width, num_channels, block_frames):
+    with wave.open(file_path, "rb") as wav_file:
+        while True:
+            raw_data = wav_file.readframes(block_frames)
+            if not raw_data:
+                return
+            yield pcm.from_pcm(raw_data, sample_width, num_channels)
+
+
+def _ffmpeg_blocks(file_path, num_channels, block_frames):
+    command = [get_encoder_name(), "-v", "error", "-i", file_path,
+               "-f", "f32le", "-acodec", "pcm_f32le", "-"]
+    block_bytes = block_frames * num_channels * 4
+    with subprocess.Popen(command, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as process:
+        try:
+            while True:
+                raw_data = process.stdout.read(block_bytes)
+                if not raw_data:
+                    return
+                # drop a trailing partial frame
+                raw_data = raw_data[:len(raw_data) - len(raw_data) % (4 * num_channels)]
+                yield pcm.from_pcm(raw_data, 4, num_channels, floating=True)
+        finally:
+            process.kill()
+
+
 def get_audio_array(audio_array, start_time, duration, sample_rate):
     """
     Returns the audio array starting from start_time and lasting duration seconds.
@@ -43,9 +138,30 @@ def get_audio_array(audio_array, start_time, duration, sample_rate):
         sample_rate (int): The sample rate.
 
     Returns:
-        np.array: The segment of the audio array.
+        np.array: The segment of the audio array, a view of it.
+    """
+    return audio_array[..., int(start_time * sample_rate):int((start_time + duration) * sample_rate)]
+
+
+def get_stretch_region(loop_start, loop_end, sample_rate, num_frames):
+    """
+    Returns the frames to stretch for a loop. Without a loop end, the area after the
+    loop start is stretched and looped, while the loop itself stays open.
+
+    Args:
+        loop_start (int): The loop start in ms.
+        loop_end (int): The loop end in ms, or None.
+        sample_rate (int): The sample rate.
+        num_frames (int): The number of frames of the audio.
+
+    Returns:
+        tuple: The start and the end frame of the region.
     """
-    return audio_array[int(start_time * sample_rate):int((start_time + duration) * sample_rate)]
+    start_frame = int(loop_start / 1000 * sample_rate)
+    if loop_end is None:
+        end_frame = min(num_frames, start_frame + STRETCH_REGION_SECONDS * sample_rate)
+        return start_frame, end_frame
+    return start_frame, int(loop_end / 1000 * sample_rate)
 
 
 def stretch_audio(audio_array, slow_down_rate):
@@ -53,22 +169,28 @@ def stretch_audio(audio_array, slow_down_rate):
     Stretches the audio array by a given rate.
 
     Args:
-        audio_array (np.array): The audio array.
+        audio_array (np.array): The (channels, frames) float32 audio array.
         slow_down_rate (float): The rate to slow down the audio.
 
     Returns:
-        np.array: The stretched audio array.
+        np.array: The stretched audio array, in the same format.
+    """
+    # librosa stretches the last axis, so all channels are stretched in one call
+    return librosa.effects.time_stretch(audio_array, rate=slow_down_rate)
+
+
+def warm_up(sample_rate=22050):
+    """
+    Stretches and beat-tracks two seconds of noise, so the first real stretch or
+    analysis does not wait for librosa to import scipy and numba and to compile its
+    kernels. Meant to run on a background thread after startup.
     """
-    # prepare the audio by converting the audio array to float32
-    audio = audio_array.astype(np.float32) / 32767.0
-    # stretch the audio
-    stretched_audio = librosa.effects.time_stretch(audio, rate=slow_down_rate)
-    # convert the stretched audio to int16
-    stretched_audio_int16 = (stretched_audio * 32767).astype(np.int16)
-    # If mono, convert to stereo by duplicating the channel
-    # if stretched_audio.ndim == 1:
-    #     stretched_audio_int16 = np.stack((stretched_audio_int16, stretched_audio_int16), axis=-1)
-    return stretched_audio_int16
+    started = time.perf_counter()
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal((1, 2 * sample_rate)) * 0.1).astype(pcm.DTYPE)
+    stretch_audio(audio, SLOW_DOWN_FACTOR)
+    analysis.track_beats(audio, sample_rate)
+    print(f"Warmed up the analysis in {time.perf_counter() - started:.1f} s")
 
 
 class Core:
@@ -78,31 +200,60 @@ class Core:
     Attributes:
         root: The root widget of the application.
         plot: The plot widget of the application.
-        beats (list): A list to store the beats.
-        measures (list): A list to store the measures.
-        original_data (np.array): The original audio data.
-        playing_data (np.array): The audio data currently being played.
+        beats (MarkerStore): The beats in ms of the original audio, sorted.
+        measures (MarkerStore): The measures in ms of the original audio, sorted.
+        taps (TapCorrector): Corrects tapped markers and snaps them to the onsets of
+            the audio.
+        markers_changed (bool): Whether the markers changed since the session file of
+            the file was written.
+        original_data (np.array): The original audio data, (channels, frames) float32.
+        playing_data (np.array): The audio data currently being played, in the same
+            format. It is converted to the device format block by block.
         sample_rate (int): The sample rate of the audio data.
         num_channels (int): The number of channels in the audio data.
+        cache (AudioCache): The on-disk cache of decoded audio.
+        cache_key (str): The cache key of original_data, or None if it is not cached.
+        decoding (bool): Whether the audio is still being decoded in the background.
+        decoded_frames (int): The number of frames decoded so far.
+        jobs (JobScheduler): Runs decoding, stretching and analysis in the background.
+        rate (float): The playback rate. The loop region is stretched to it, while
+            original_data, the waveform and all times stay at the original speed.
+        live (bool): Whether the output stretches in real time, instead of playing
+            a region rendered at the rate in the background.
+        stretch_job (StretchJob): The job stretching the loop region, if any.
+        stretch_cache (StretchCache): The finished stretched renders.
+        filter_preset (str): The preset of filters.py the playback is filtered with.
+        show_filtered (bool): Whether the waveform shows the filtered audio.
+        playlist (Playlist): The recordings of the session, the next of which are
+            prefetched.
     """
 
-    def __init__(self, root, plot):
+    def __init__(self, root, plot, device=None):
         """
-        Initializes the Core class with the root and plot widgets, initializes the Pygame mixer,
-        and initializes the beats, measures, and audio data attributes.
+        Initializes the Core class with the root and plot widgets, and initializes the
+        beats, measures, and audio data attributes. Pygame is initialized by
+        start_output, on the first use of the output.
 
         Args:
             root: The root widget of the application.
             plot: The plot widget of the application.
+            device: The output device to play through, e.g. a SimulatedDevice of
+                simulated.py. A PygameDevice is created on first use if None.
         """
         self.root = root
         self.plot = plot
 
-        # Initialize Pygame mixer
-        pygame.mixer.init()
+        # The audio output and its device, created by start_output
+        self._output = None
+        self.device = device
 
-        self.beats = []
-        self.measures = []
+        self.beats = markers.MarkerStore()
+        self.measures = markers.MarkerStore()
+        self.markers_changed = False
+        # Tapped markers are corrected with the calibrated offset and snapped to onsets
+        self.taps = TapCorrector.load()
+        # Detected notes as (onset ms, offset ms, MIDI pitch) rows
+        self.notes = np.zeros((0, 3))
 
         # Audio data
         self.original_data = None
@@ -110,106 +261,557 @@ class Core:
         self.sample_rate = None
         self.num_channels = None
 
+        # Decoded audio is memory-mapped from the cache on later loads
+        self.cache = AudioCache()
+        self.cache_key = None
+        self.playlist = Playlist()
+
+        # Background jobs
+        self.jobs = JobScheduler(root)
+
+        # Streaming decode state
+        self.decoding = False
+        self.decoded_frames = 0
+        self.pyramid = None
+        self.enveloped_frames = 0
+        self.waveform_shown = False
+        self.load_started_at = None
+        self.first_sound_pending = False
+
+        # Time-stretch state
+        self.rate = 1.0
+        self.live = False
+        self.stretch_job = None
+        self.stretch_cache = StretchCache()
+
+        # Isolation filter state
+        self.filter_preset = "off"
+        self.show_filtered = False
+
         # Playback and loop state
         self.playing = False
-        self.stopped = False
         self.loop_start = 0
         self.loop_end = None
-        self.start_play_time = None
 
-        self.paused_at = 0
+        self.paused_at = None
 
     def on_closing(self):
         """
         Stops the music playback and quits Pygame when the application is closed.
         """
-        pygame.mixer.stop()  # Stop music playback
-        pygame.quit()  # pyLint: disable=no-member
+        self.jobs.shutdown()
+        self.save_session()
+        if self._output is not None:
+            self._output.quit()  # Stop music playback
+
+    @property
+    def output(self):
+        return self.start_output()
 
+    def start_output(self):
+        """
+        Initializes the output and its device, unless they already are. The output
+        opens the device at the sample rate of the audio.
+
+        pygame is imported here rather than at startup, so the window shows without
+        waiting for it and the batch mode can use this module without it.
+
+        Returns:
+            AudioOutput: The output.
+        """
+        if self._output is None:
+            # pylint: disable=import-outside-toplevel
+            from playback import AudioOutput, PygameDevice
+            if self.device is None:
+                self.device = PygameDevice()
+            self._output = AudioOutput(self.device)
+        return self._output
+
+    @telemetry.timed("load_mp3_from_file_path")
     def load_mp3_from_file_path(self, file_path):
         """
         Loads an MP3 file from the given file path and displays the waveform.
+
+        The file is opened by a background job. The decoded audio is taken from the
+        cache if the file was loaded before. Otherwise the file is decoded in blocks,
+        and the waveform and playback of the decoded part are available while it runs.
         """
+        self.reset_file_state()
+        self.jobs.submit("load", self.open_audio_file, file_path,
+                         on_progress=self.show_decoding, on_done=self.on_loaded)
 
-        self.original_data, self.sample_rate, self.num_channels = read_audio_file(
-            file_path)
+    def reset_file_state(self):
+        """
+        Stops the work on the current file and clears its state before another file
+        is loaded.
+        """
+        self.stop_decoding()
+        self.stop_stretching()
+        self.jobs.cancel("analysis")
+        self.jobs.cancel("notes")
+        self.jobs.cancel("filter")
+        self.plot.show_filtered_waveform(None, None)
+        self.save_session()
+        self.rate = 1.0
+        self.set_live(False)
+        self.beats.set(())
+        self.measures.set(())
+        self.markers_changed = False
+        self.notes = np.zeros((0, 3))
+        self.load_started_at = time.perf_counter()
+        self.first_sound_pending = True
+        self.decoded_frames = 0
+        self.enveloped_frames = 0
+        self.waveform_shown = False
+
+    def open_audio_file(self, job, file_path):
+        """
+        Opens an audio file from the cache, or decodes it in blocks. Runs on a worker
+        thread. While decoding, the buffer, its pyramid and the number of decoded
+        frames are published on the job for show_decoding.
+
+        Returns:
+            tuple: The audio array, sample rate, number of channels, cache key and
+                waveform pyramid.
+        """
+        cached = self.cache.load(file_path)
+        if cached is not None:
+            print(f"Loaded {file_path} from cache")
+            audio_array, sample_rate, num_channels = cached
+            key = self.cache.key_for(file_path)
+            pyramid = self.load_waveform_pyramid(key, audio_array)
+            return audio_array, sample_rate, num_channels, key, pyramid
+
+        sample_rate, num_channels, num_frames, blocks = stream_audio_file(file_path)
+        buffer = np.zeros((num_channels, num_frames), dtype=pcm.DTYPE)
+        job.decode_format = (sample_rate, num_channels)
+        job.decoded_frames = 0
+        job.pyramid = WaveformPyramid.zeros(num_frames, pcm.DTYPE)
+        job.buffer = buffer
+
+        position = 0
+        for block in blocks:
+            if job.cancelled.is_set():
+                blocks.close()
+                return None
+            end = position + block.shape[-1]
+            if end > buffer.shape[-1]:
+                # The duration reported by the decoder was too short
+                grown = np.zeros((num_channels, max(end, 2 * buffer.shape[-1])),
+                                 dtype=pcm.DTYPE)
+                grown[:, :position] = buffer[:, :position]
+                buffer = grown
+                job.pyramid = WaveformPyramid.zeros(buffer.shape[-1], pcm.DTYPE)
+                job.buffer = buffer
+            buffer[:, position:end] = block
+            position = end
+            job.decoded_frames = position
+            job.progress = position / buffer.shape[-1]
+
+        audio_array = buffer[:, :position]
+        key = self.cache.store(file_path, audio_array, sample_rate, num_channels)
+        pyramid = self.load_waveform_pyramid(key, audio_array)
+        return audio_array, sample_rate, num_channels, key, pyramid
+
+    def show_decoding(self, job):
+        """
+        Shows the part of the audio decoded so far. Runs on the Tk thread.
+        """
+        buffer = getattr(job, "buffer", None)
+        if buffer is None:
+            return
+
+        if buffer is not self.original_data:
+            # The decoding started, or the buffer was reallocated
+            self.sample_rate, self.num_channels = job.decode_format
+            self.original_data = buffer
+            self.pyramid = job.pyramid
+            self.cache_key = None
+            self.decoding = True
+            self.playing_data = get_audio_array(
+                self.original_data, self.loop_start / 1000,
+                self.original_data.shape[-1] / self.sample_rate, self.sample_rate)
+            self.waveform_shown = False
+
+        self.decoded_frames = job.decoded_frames
+        if self.decoded_frames > 0:
+            if not self.waveform_shown:
+                self.plot.display_waveform(self)
+                self.waveform_shown = True
+                self.enveloped_frames = 0
+                self.report_load_time("first waveform")
+            decoded_frames = self.decoded_frames
+            self.plot.update_waveform(self.enveloped_frames, decoded_frames)
+            self.enveloped_frames = decoded_frames
+            if not self.playing:
+                self.plot.draw_plot()
+
+    def on_loaded(self, result):
+        """
+        Shows the completely loaded audio. Runs on the Tk thread.
+        """
+        (self.original_data, self.sample_rate, self.num_channels,
+         self.cache_key, self.pyramid) = result
+        self.decoding = False
         self.playing_data = self.original_data
-        # Display waveform
+        # Cached markers and notes are set without a redraw before the waveform is
+        # shown, so that it is drawn once with them
+        self.analyze()
+        self.load_notes()
         self.plot.display_waveform(self)
+        if not self.waveform_shown:
+            self.report_load_time("first waveform")
+        self.report_load_time("complete load")
+        self.update_filtered_waveform()
+        self.restore_entry()
 
-    def toggle_play_pause(self, _):
-        print("Toggling play/pause")
-        if self.playing:
-            self.stop_mp3()  # Pause the music
-        else:
-            self.play_mp3()  # Unpause the music
+    def analyze(self):
+        """
+        Fills the beats and measures from the session file of the file if it has one,
+        or by beat tracking, from the cache if the file was analyzed before.
 
-    def play_mp3(self):
-        pygame.mixer.quit()
-        self.playing = False
-        print("Stopped")
+        The times are in the original audio, so they hold at every rate and the
+        analysis runs once per file. The onset index taps are snapped to is built
+        along with the beats, or on its own if the beats are known.
+        """
+        self.taps.set_onsets(())
+        if self.cache_key is not None:
+            onsets = self.cache.load_array(self.cache_key, analysis.ONSETS_NAME,
+                                           mmap=False)
+            if onsets is not None:
+                self.taps.set_onsets(onsets)
+            if self.load_markers():
+                if onsets is None:
+                    self.jobs.submit("onsets", self.run_onset_detection,
+                                     self.original_data, self.sample_rate,
+                                     on_done=self.on_onsets_detected)
+                return
+        self.jobs.submit("analysis", self.run_analysis, self.original_data,
+                         self.sample_rate, on_done=self.on_analyzed)
+
+    def load_markers(self):
+        """
+        Shows the beats and measures of the session file, or the cached tracked ones.
 
-        pygame.mixer.init()
-        pygame.init()
-        self.paused_at = None
+        Returns:
+            bool: Whether there were any.
+        """
+        session = markers.load_session(self.cache_key)
+        if session is not None:
+            print(f"Loaded {len(session[0])} beats and {len(session[1])} measures "
+                  "from the session")
+            self.set_markers(*session, redraw=False)
+            return True
+        beats = self.cache.load_array(self.cache_key, analysis.BEATS_NAME, mmap=False)
+        measures = self.cache.load_array(self.cache_key, analysis.MEASURES_NAME, mmap=False)
+        if beats is None or measures is None:
+            return False
+        self.set_markers(beats, measures, redraw=False)
+        return True
+
+    def run_analysis(self, job, audio_array, sample_rate):
+        # Runs on a worker thread
+        return analysis.track_beats_and_onsets(audio_array, sample_rate, job)
+
+    def on_analyzed(self, result):
+        """
+        Shows the tracked beats and measures and caches them with the onsets. Runs on
+        the Tk thread.
+        """
+        if result is None:
+            return
+        beats, measures, onsets, tempo = result
+        print(f"Tempo: {tempo:.1f} BPM, {len(beats)} beats, {len(onsets)} onsets")
+        if self.cache_key is not None:
+            self.cache.store_array(self.cache_key, analysis.BEATS_NAME, beats)
+            self.cache.store_array(self.cache_key, analysis.MEASURES_NAME, measures)
+            self.cache.store_array(self.cache_key, analysis.ONSETS_NAME, onsets)
+        self.taps.set_onsets(onsets)
+        self.set_markers(beats, measures)
+
+    def run_onset_detection(self, job, audio_array, sample_rate):
+        # Runs on a worker thread
+        return analysis.detect_onsets(audio_array, sample_rate, job)
+
+    def on_onsets_detected(self, onsets):
+        if onsets is None:
+            return
+        if self.cache_key is not None:
+            self.cache.store_array(self.cache_key, analysis.ONSETS_NAME, onsets)
+        self.taps.set_onsets(onsets)
+
+    def load_notes(self):
+        """
+        Shows the notes detected before, if the file was loaded before.
+        """
+        if self.cache_key is not None:
+            cached = self.cache.load_array(self.cache_key, notes.NOTES_NAME, mmap=False)
+            if cached is not None:
+                self.set_notes(cached, redraw=False)
 
-        if self.playing_data.any():
-            if self.num_channels == 1:
-                audio = np.stack(
-                    (self.playing_data, self.playing_data), axis=-1)
-                sound = pygame.mixer.Sound(buffer=audio)
+    def detect_notes(self):
+        """
+        Detects the notes of the audio in the background on all cores.
 
-                # Play the sound in a loop
-                sound.play(loops=-1)
+        The notes are in the original audio, so they hold at every rate and the
+        detection runs once per file.
+        """
+        if self.original_data is None or self.decoding:
+            print("Cannot detect notes while loading")
+            return
+        if len(self.notes) > 0:
+            print(f"{len(self.notes)} notes already detected")
+            return
+        self.jobs.submit("notes", self.run_note_detection, self.original_data,
+                         self.sample_rate, on_done=self.on_notes_detected)
+
+    def run_note_detection(self, job, audio_array, sample_rate):
+        # Runs on a worker thread, which waits for the worker processes
+        return notes.detect_notes(audio_array, sample_rate, job)
+
+    def on_notes_detected(self, result):
+        """
+        Shows the detected notes and caches them. Runs on the Tk thread.
+        """
+        if result is None:
+            return
+        if self.cache_key is not None:
+            self.cache.store_array(self.cache_key, notes.NOTES_NAME, result)
+        self.set_notes(result)
+
+    def set_notes(self, detected, redraw=True):
+        self.notes = np.asarray(detected, dtype=np.float64).reshape(-1, 3)
+        self.plot.update_note_axis()
+        if redraw:
+            self.redraw()
+
+    def set_markers(self, beats, measures, redraw=True):
+        # The markers stay editable like tapped ones
+        self.beats.set(beats)
+        self.measures.set(measures)
+        if redraw:
+            self.redraw()
+
+    def redraw(self):
+        """
+        Redraws the plot, unless the plot loop redraws it while playing or it does not
+        show the current audio yet.
+        """
+        if (not self.playing and self.pyramid is not None
+                and self.plot.pyramid is self.pyramid):
+            self.plot.draw_plot()
 
-                # record the time the playback started
-                self.start_play_time = pygame.time.get_ticks()
-                print(f"Start time: {self.start_play_time}")
+    def set_filter(self, preset):
+        """
+        Filters the playback with a preset of filters.py. It is heard from the next
+        output block, and the waveform follows if it shows the filtered audio.
+        """
+        self.filter_preset = preset
+        self.output.set_filter(preset)
+        print(f"Filter: {preset}")
+        self.update_filtered_waveform()
 
-                self.playing = True
-                self.plot.update_plot()  # Start the plot update loop
+    def toggle_filtered_waveform(self):
+        """
+        Switches the waveform between the original and the filtered audio.
+        """
+        self.show_filtered = not self.show_filtered
+        self.update_filtered_waveform()
 
-                print("Playing")
+    def update_filtered_waveform(self):
+        """
+        Shows the envelope of the filtered audio if enabled, from the cache if it was
+        built before for the preset, or builds it in the background.
+        """
+        self.jobs.cancel("filter")
+        if (not self.show_filtered or self.filter_preset == "off"
+                or self.original_data is None or self.decoding):
+            self.plot.show_filtered_waveform(None, None)
+            return
+        name = f"{ENVELOPE_NAME}-{self.filter_preset}"
+        if self.cache_key is not None:
+            array = self.cache.load_array(self.cache_key, name)
+            pyramid = None if array is None else WaveformPyramid.from_array(
+                array, self.original_data.shape[-1])
+            if pyramid is not None:
+                self.plot.show_filtered_waveform(pyramid, filters.FilteredAudio(
+                    self.original_data, self.sample_rate, self.filter_preset))
+                return
+        self.jobs.submit("filter", self.build_filtered_waveform, self.original_data,
+                         self.sample_rate, self.filter_preset,
+                         on_done=self.on_filtered_waveform)
+
+    def build_filtered_waveform(self, job, audio_array, sample_rate, preset):
+        # Runs on a worker thread
+        pyramid = filters.filtered_pyramid(audio_array, sample_rate, preset, job)
+        return None if pyramid is None else (preset, pyramid)
+
+    def on_filtered_waveform(self, result):
+        """
+        Shows the envelope of the filtered audio and caches it. Runs on the Tk thread.
+        """
+        if result is None:
+            return
+        preset, pyramid = result
+        if self.cache_key is not None:
+            self.cache.store_array(self.cache_key, f"{ENVELOPE_NAME}-{preset}",
+                                   pyramid.to_array())
+        self.plot.show_filtered_waveform(
+            pyramid, filters.FilteredAudio(self.original_data, self.sample_rate, preset))
+
+    def stop_decoding(self):
+        """
+        Cancels the background decoding of the previously loaded file.
+        """
+        self.jobs.cancel("load")
+        self.decoding = False
 
-    def get_current_time(self):
-        return pygame.time.get_ticks() - self.start_play_time + self.loop_start
+    def report_load_time(self, milestone):
+        if self.load_started_at is not None:
+            elapsed = (time.perf_counter() - self.load_started_at) * 1000
+            print(f"Time to {milestone}: {elapsed:.0f} ms")
 
-    # def play_mp3(self):
-    #     pygame.mixer.quit()
-    #     self.playing = False
-    #     print("Stopped")
+    def get_waveform_pyramid(self):
+        """
+        Returns the envelope pyramid of the original data.
+        """
+        if self.pyramid is None or self.pyramid.num_frames != self.original_data.shape[-1]:
+            self.pyramid = self.load_waveform_pyramid(self.cache_key, self.original_data)
+        return self.pyramid
 
-    #     if self.stopped:
-    #         self.stopped = False
-    #         return
+    def load_waveform_pyramid(self, key, audio_array):
+        """
+        Returns the envelope pyramid of an audio array, from the cache if possible.
+        """
+        if key is not None:
+            array = self.cache.load_array(key, ENVELOPE_NAME)
+            if array is not None:
+                pyramid = WaveformPyramid.from_array(array, audio_array.shape[-1])
+                if pyramid is not None:
+                    return pyramid
+
+        pyramid = WaveformPyramid.build(audio_array)
+        if key is not None:
+            self.cache.store_array(key, ENVELOPE_NAME, pyramid.to_array())
+        return pyramid
+
+    def update_playing_data(self):
+        """
+        Sets the playing data to the loop region. If the rate is not 1 the region is
+        stretched in the background, and playback can start on the finished part.
+        """
+        if self.original_data is None:
+            return
+        self.stop_stretching()
+        if self.rate == 1.0 or self.live:
+            end = self.original_data.shape[-1] / self.sample_rate if self.loop_end is None \
+                else self.loop_end / 1000
+            self.playing_data = get_audio_array(self.original_data, self.loop_start / 1000,
+                                                end - self.loop_start / 1000,
+                                                self.sample_rate)
+            return
+
+        start_frame, end_frame = get_stretch_region(
+            self.loop_start, self.loop_end, self.sample_rate, self.original_data.shape[-1])
+        cached = self.stretch_cache.get(
+            self.get_source_id(), start_frame, end_frame, self.rate)
+        if cached is not None:
+            print(f"Using cached stretch at rate {self.rate:.2f}")
+            self.playing_data = cached
+            return
+
+        self.stretch_job = StretchJob(self.original_data, self.sample_rate, self.rate,
+                                      start_frame, end_frame, stretch_audio)
+        self.playing_data = self.stretch_job.output
+        self.jobs.submit("stretch", self.stretch_job.run, on_done=self.on_stretched)
+
+    def on_stretched(self, job):
+        """
+        Caches the finished stretch. Runs on the Tk thread.
+        """
+        self.stretch_cache.put(self.get_source_id(), job.start_frame, job.end_frame,
+                               job.rate, job.output)
+        region_seconds = (job.end_frame - job.start_frame) / self.sample_rate
+        print(f"Stretched {region_seconds:.1f} s to rate {job.rate:.2f} "
+              f"in {job.elapsed:.2f} s")
 
-    #     pygame.mixer.init()
-    #     pygame.init()
-    #     self.paused_at = None
+    def get_source_id(self):
+        """
+        Returns the identity of the original data for the stretch cache.
+        """
+        return self.cache_key if self.cache_key is not None else id(self.original_data)
 
-    #     if self.playing_data.any():
-    #         if self.num_channels == 1:
-    #             audio = np.stack((self.playing_data, self.playing_data), axis=-1)
-    #             sound = pygame.mixer.Sound(buffer=audio)
+    def stop_stretching(self):
+        self.jobs.cancel("stretch")
+        if self.stretch_job is not None:
+            self.stretch_job.cancel()
+            self.stretch_job = None
 
-    #             # Play the sound
-    #             sound.play()
+    def cancel_stretch(self, _=None):
+        """
+        Cancels a running stretch and returns to the original speed.
+        """
+        if self.stretch_job is not None and not self.stretch_job.finished:
+            print("Stretch cancelled")
+            self.rate = 1.0
+            self.update_playing_data()
 
-    #             # record the time the playback started
-    #             self.start_play_time = pygame.time.get_ticks()
-    #             print(f"Start time: {self.start_play_time}")
+    def toggle_play_pause(self, _):
+        print("Toggling play/pause")
+        if self.playing:
+            self.stop_mp3()  # Pause the music
+        else:
+            self.play_mp3()  # Unpause the music
 
-    #             self.playing = True
-    #             self.plot.update_plot()  # Start the plot update loop
+    @telemetry.timed("play_mp3")
+    def play_mp3(self):
+        """
+        Plays the playing data in a loop from its start.
+
+        The output stays open between plays, so this only points it at the data.
+        The data is read in place, so a region that is still being decoded or
+        stretched can already play.
+        """
+        was_playing = self.playing
+        self.paused_at = None
+        self.report_clock_drift()
 
-    #             print("Playing")
+        if self.playing_data.shape[-1] > 0:
+            self.output.open(self.sample_rate)
+            self.output.play(self.playing_data)
+            if self.first_sound_pending:
+                self.report_load_time("first sound")
+                self.first_sound_pending = False
 
-    #             # Calculate the duration of the sound in seconds
-    #             duration = len(self.playing_data) / self.sample_rate
+            self.playing = True
+            if not was_playing:
+                self.plot.update_plot()  # Start the plot update loop
 
-    #             # Start a timer to call play_mp3 again after the sound finishes playing
-    #             if not self.stopped:
-    #                 threading.Timer(duration, self.play_mp3).start()
+            print("Playing")
+
+    def get_position(self):
+        """
+        Returns the playback position in frames of the original audio.
+
+        The position follows the frames consumed by the output, and playback of
+        stretched audio advances at the rate. In the live mode the output already
+        reports frames of the unstretched region.
+        """
+        loop_start_frame = int(self.loop_start / 1000 * self.sample_rate)
+        rate = 1.0 if self.live else self.rate
+        return loop_start_frame + int(self.output.position_frames() * rate)
+
+    def get_current_time(self):
+        """
+        Returns the playback position in ms of the original audio.
+        """
+        return self.get_position() / self.sample_rate * 1000
+
+    def report_clock_drift(self):
+        if self.playing:
+            drift, wall = self.output.drift()
+            print(f"Clock drift: {drift * 1000:+.1f} ms over {wall:.1f} s, "
+                  f"output latency {self.output.latency * 1000:.1f} ms")
 
     def on_select(self, xmin, xmax):
         # Convert sample indices to time in milliseconds
@@ -218,95 +820,381 @@ class Core:
         print(f"Selected region from {
               self.loop_start} ms to {self.loop_end} ms")
 
-        self.playing_data = get_audio_array(self.original_data, self.loop_start/1000,
-                                            self.loop_end/1000 - self.loop_start/1000,
-                                            self.sample_rate)
-        # if self.playing:
-        #     self.play_mp3()
-
-    # def on_plot_click(self, start_at):
-
-    #     self.playing_data = get_audio_array(self.original_data, start_at/1000,
-    #                                         self.original_data.shape[0]/self.sample_rate - start_at/1000,
-    #                                         self.sample_rate)
-    #     self.loop_start = start_at
-    #     self.loop_end = None
+        self.update_playing_data()
+        if self.playing:
+            self.play_mp3()
 
     def on_plot_click(self, start_at):
-        self.playing_data = get_audio_array(self.original_data, start_at/1000,
-                                            self.original_data.shape[0] /
-                                            self.sample_rate - start_at/1000,
-                                            self.sample_rate)
         self.loop_start = start_at
         self.loop_end = None
+        self.update_playing_data()
+        if self.playing:
+            self.play_mp3()
 
     def stop_mp3(self):
         if self.playing:
-            pygame.mixer.stop()
+            self.report_clock_drift()
+            self.output.stop()
             self.playing = False
             self.plot.update_plot()
             print("Stopped")
 
     def pause_mp3(self):
-        if self.playing_data.any():
+        if self.playing_data.shape[-1] > 0:
             if self.playing:
-                pygame.mixer.pause()
-                # record the time the playback was paused
+                self.output.pause()
+                # record the position the playback was paused at
                 self.playing = False
-                self.paused_at = pygame.time.get_ticks()
+                self.paused_at = self.get_current_time()
 
                 self.plot.update_plot()
                 print(f"Paused at {self.paused_at}")
                 print("Paused")
             else:
-                if self.paused_at:
-                    pygame.mixer.unpause()
-                    # record the time the playback was unpaused
-                    unpause_time = pygame.time.get_ticks()
-                    self.start_play_time += unpause_time - self.paused_at
-
-                    print(f"paused for {unpause_time - self.paused_at} ms")
-                    print(f"Start time: {self.start_play_time}")
+                if self.paused_at is not None:
+                    # The output clock stands still while paused
+                    self.output.unpause()
+                    self.paused_at = None
 
                     self.playing = True
                     self.plot.update_plot()
                     print("Unpaused")
 
     def reset_loop(self):
-        self.playing_data = self.original_data
         self.loop_start = 0
-        self.loop_end = self.playing_data.shape[0]
+        self.loop_end = None
+        self.update_playing_data()
         if self.playing:
             self.play_mp3()
         print("Loop reset")
 
+    @telemetry.timed("slow_down")
     def slow_down(self):
         """
         Slows down the audio by a factor of 0.8.
+
+        Only the loop region, or the area after the playhead, is stretched. The
+        stretching runs in the background, starting from the original audio.
         """
-        slow_down_rate = 0.8
-        stretched_audio_int16 = stretch_audio(
-            self.original_data, slow_down_rate)
+        self.set_rate(StretchCache.rate_key(self.rate * SLOW_DOWN_FACTOR))
 
-        self.original_data = stretched_audio_int16
-        self.plot.display_waveform(self)
+    @telemetry.timed("set_rate")
+    def set_rate(self, rate):
+        """
+        Sets the playback rate. The loop region is rendered from the original audio
+        at this rate, or taken from the stretch cache if it was rendered before.
+        """
+        if self.decoding:
+            print("Cannot change the speed while decoding")
+            return
+        if self.original_data is None:
+            return
+        self.rate = rate
+        self.set_live(False)
+        self.update_playing_data()
+        if self.playing:
+            self.play_mp3()
+
+        print(f"Slow down rate: {self.rate:.2f}")
+
+    def set_live_rate(self, rate):
+        """
+        Sets the playback rate in the live mode, where the output stretches the
+        unstretched region in real time. Nothing is rendered, and while playing the
+        rate changes within a few blocks, without restarting.
+        """
+        if self.original_data is None:
+            return
+        self.rate = rate
+        if not self.live:
+            self.set_live(True)
+            self.update_playing_data()
+            if self.playing:
+                self.play_mp3()
+        self.output.set_rate(rate)
+
+    def set_live(self, live):
+        """
+        Switches the real-time stretching of the output on or off.
+        """
+        if live == self.live:
+            return
+        self.live = live
+        self.output.open(self.sample_rate)
+        self.output.set_rate(self.rate if live else None)
 
-        self.playing_data = stretched_audio_int16
+    def mark_beat(self, event=None):
+        """
+        Marks the tapped time as a beat.
+        """
+        time_ms = self.get_tap_time(event)
+        if time_ms is not None:
+            self.add_marker(self.beats, time_ms)
 
-        print(f"Slow down rate: {slow_down_rate}")
+    def mark_measure(self, event=None):
+        """
+        Marks the tapped time as a measure.
+        """
+        time_ms = self.get_tap_time(event)
+        if time_ms is not None:
+            self.add_marker(self.measures, time_ms)
+            print(f"{len(self.measures)} measures")
 
-    def mark_beat(self, event):
+    def get_tap_time(self, event=None):
         """
-        Marks the current time as a beat.
+        Returns the time of a tap in ms of the original audio, corrected for the
+        queue delay of its key event and the calibrated offset and snapped to the
+        nearest onset. During a calibration the tap is taken by the calibration and
+        None is returned.
         """
-        current_time = self.get_current_time()
-        self.beats.append(current_time)
-        # self.plot.update_beat_axis()
-        # print(self.beats)
+        if self.sample_rate is None:
+            return None
+        delay_ms = self.taps.queue_delay(getattr(event, "time", None))
+        if self.taps.calibration is None:
+            return self.taps.correct(self.get_current_time(), self.rate, delay_ms)
+        if self.taps.calibrate(self.get_current_time(), self.rate, delay_ms):
+            print(f"Calibrated a tap offset of {self.taps.offset_ms:+.1f} ms")
+        else:
+            print(f"Calibration: {len(self.taps.calibration)} of "
+                  f"{CALIBRATION_TAPS} taps")
+        return None
 
-    def mark_measure(self, event):
+    def calibrate_taps(self):
+        """
+        Starts measuring the tap offset: the next taps along the beat are not marked,
+        and their median distance to the onsets becomes the offset.
+        """
+        if len(self.taps.onsets) == 0:
+            print("Cannot calibrate before the onsets are detected")
+            return
+        self.taps.start_calibration()
+        print(f"Calibrating: tap along the beat {CALIBRATION_TAPS} times")
+        if not self.playing:
+            self.play_mp3()
+
+    def remove_beat(self, _=None):
+        """
+        Removes the beat closest to the current time.
+        """
+        self.remove_nearest(self.beats)
+
+    def remove_measure(self, _=None):
+        """
+        Removes the measure closest to the current time.
+        """
+        self.remove_nearest(self.measures)
+
+    def add_marker(self, store, time_ms):
+        store.add(time_ms)
+        self.markers_changed = True
+        if not self.playing:
+            self.plot.draw_plot()
+
+    def remove_nearest(self, store):
+        if self.sample_rate is None:
+            return
+        nearest = store.remove_nearest(self.get_current_time())
+        if nearest is not None:
+            self.markers_changed = True
+            print(f"Removed marker at {nearest:.0f} ms")
+            if not self.playing:
+                self.plot.draw_plot()
+
+    def save_session(self):
+        """
+        Writes the beats and measures to the session file of the file, if they
+        changed.
+        """
+        if self.markers_changed and self.cache_key is not None:
+            markers.save_session(self.cache_key, self.beats, self.measures)
+            self.markers_changed = False
+            print(f"Saved {len(self.beats)} beats and {len(self.measures)} measures")
+
+    def open_files(self, file_paths):
+        """
+        Adds files to the playlist and switches to the first of them.
+        """
+        index = self.playlist.add(file_paths)
+        if index is not None:
+            self.switch_to(index)
+
+    def next_entry(self, _=None):
+        if self.playlist.index is not None:
+            self.switch_to(self.playlist.index + 1)
+
+    def previous_entry(self, _=None):
+        if self.playlist.index is not None:
+            self.switch_to(self.playlist.index - 1)
+
+    @telemetry.timed("switch_to")
+    def switch_to(self, index):
+        """
+        Switches to an entry of the playlist, keeping the loop and rate of the current
+        one in its entry. An entry held in memory or prepared in the cache by the
+        prefetching is shown at once, other ones are loaded like any file.
+        """
+        if not 0 <= index < len(self.playlist):
+            return
+        current = self.playlist.current
+        if current is not None:
+            current.loop_start, current.loop_end = self.loop_start, self.loop_end
+            current.rate, current.live = self.rate, self.live
+        if self.playing:
+            self.stop_mp3()
+        self.jobs.cancel("prefetch")
+
+        entry = self.playlist.select(index)
+        if entry.cache_key is None:
+            entry.cache_key = self.cache.key_for(entry.file_path)
+        self.loop_start, self.loop_end = entry.loop_start, entry.loop_end
+        print(f"Playlist {index + 1}/{len(self.playlist)}: {entry.file_path}")
+        loaded = entry.loaded
+        if loaded is None and entry.prepared:
+            loaded = self.load_prepared(entry)
+        if loaded is None:
+            self.load_mp3_from_file_path(entry.file_path)
+            return
+        self.reset_file_state()
+        self.on_loaded(loaded)
+
+    def load_prepared(self, entry):
+        """
+        Returns the audio of an entry memory-mapped from the cache, like the result
+        of open_audio_file, or None if the cache entry was evicted.
+        """
+        cached = self.cache.load(entry.file_path)
+        if cached is None:
+            entry.prepared = False
+            return None
+        audio_array, sample_rate, num_channels = cached
+        pyramid = self.load_waveform_pyramid(entry.cache_key, audio_array)
+        return audio_array, sample_rate, num_channels, entry.cache_key, pyramid
+
+    def restore_entry(self):
+        """
+        Holds the loaded audio in its playlist entry, restores the loop and rate of
+        the entry and prefetches the next entries.
+        """
+        entry = self.playlist.current
+        if entry is None or entry.cache_key != self.cache_key:
+            return
+        entry.hold((self.original_data, self.sample_rate, self.num_channels,
+                    self.cache_key, self.pyramid))
+        entry.prepared = True
+        self.playlist.enforce_budget()
+        if entry.live:
+            self.set_live_rate(entry.rate)
+        elif entry.rate != 1.0:
+            self.set_rate(entry.rate)
+        else:
+            self.update_playing_data()
+        self.prefetch()
+
+    def prefetch(self):
+        """
+        Prefetches the next entry of the playlist that is not prepared yet, in the
+        background. The following ones are prefetched when it finishes.
+        """
+        entry = self.playlist.next_to_prefetch()
+        if entry is not None:
+            self.jobs.submit("prefetch", self.run_prefetch, entry,
+                             on_done=self.on_prefetched)
+
+    def run_prefetch(self, job, entry):
+        """
+        Decodes a playlist entry into the cache, caches its envelope pyramid and
+        analysis and stretches its loop if it was left at another rate. Runs on a
+        worker thread.
+
+        Returns:
+            tuple: The entry, its audio like the result of open_audio_file, read into
+                memory, and the finished StretchJob or None, or None if the job was
+                cancelled.
+        """
+        audio_array, sample_rate, num_channels = self.cache.get(
+            entry.file_path, read_audio_file)
+        key = self.cache.key_for(entry.file_path)
+        # The entry is missing if the file is larger than the whole cache
+        cached = os.path.isdir(self.cache.entry_dir(key))
+        pyramid = self.load_waveform_pyramid(key if cached else None, audio_array)
+
+        names = (analysis.BEATS_NAME, analysis.MEASURES_NAME, analysis.ONSETS_NAME)
+        if cached and not all(os.path.exists(self.cache.array_path(key, name))
+                              for name in names):
+            result = analysis.track_beats_and_onsets(audio_array, sample_rate, job)
+            if result is None:
+                return None
+            for name, array in zip(names, result):
+                self.cache.store_array(key, name, array)
+
+        stretch_job = None
+        if entry.rate != 1.0 and not entry.live:
+            start_frame, end_frame = get_stretch_region(
+                entry.loop_start, entry.loop_end, sample_rate, audio_array.shape[-1])
+            stretch_job = StretchJob(audio_array, sample_rate, entry.rate, start_frame,
+                                     end_frame, stretch_audio).run(job)
+            if not stretch_job.finished:
+                return None
+        if job is not None and job.cancelled.is_set():
+            return None
+
+        # Read into memory, so that playing it does not wait for the disk
+        loaded = (np.array(audio_array), sample_rate, num_channels, key, pyramid)
+        return entry, loaded, stretch_job
+
+    def on_prefetched(self, result):
+        """
+        Holds a prefetched entry in memory within the budget and prefetches the next
+        one. Runs on the Tk thread.
+        """
+        if result is None:
+            return
+        entry, loaded, stretch_job = result
+        entry.prepared = True
+        entry.hold(loaded)
+        if stretch_job is not None:
+            self.stretch_cache.put(entry.cache_key, stretch_job.start_frame,
+                                   stretch_job.end_frame, stretch_job.rate,
+                                   stretch_job.output)
+        released = self.playlist.enforce_budget()
+        print(f"Prefetched {os.path.basename(entry.file_path)}, holding "
+              f"{self.playlist.nbytes() / 1024 ** 2:.0f} MB"
+              + (f", released {len(released)}" if released else ""))
+        self.prefetch()
+
+    def export_region(self, path):
+        """
+        Writes the loop region at the current rate to a WAV or FLAC file in the
+        background, reusing the stretched render if it is cached.
+        """
+        if self.original_data is None or self.decoding:
+            return
+        start_frame = int(self.loop_start / 1000 * self.sample_rate)
+        end_frame = self.original_data.shape[-1] if self.loop_end is None \
+            else int(self.loop_end / 1000 * self.sample_rate)
+        rendered = None
+        if self.rate != 1.0:
+            rendered = self.stretch_cache.get(
+                self.get_source_id(), start_frame, end_frame, self.rate)
+        self.jobs.submit("export", self.run_export, path, self.original_data,
+                         self.sample_rate, start_frame, end_frame, self.rate, rendered,
+                         on_done=self.on_exported)
+
+    def run_export(self, job, path, audio_array, sample_rate, start_frame, end_frame,
+                   rate, rendered):
+        # Runs on a worker thread
+        written = export.export_region(path, audio_array, sample_rate, start_frame,
+                                       end_frame, rate, rendered, stretch_audio, job)
+        return None if written is None else (path, written / sample_rate)
+
+    def on_exported(self, result):
+        if result is not None:
+            print(f"Exported {result[1]:.1f} s to {result[0]}")
+
+    def export_markers(self, path, click=True):
         """
-        Marks the current time as a measure.
+        Writes the beats and measures to a MIDI file, with a click track if click.
         """
-        self.measures.append(self.get_current_time())
-        print(self.measures)
+        export.write_midi(path, self.beats.to_array(), self.measures.to_array(), click)
+        print(f"Exported {len(self.beats)} beats and {len(self.measures)} measures "
+              f"to {path}")
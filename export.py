@@ -0,0 +1,398 @@
+"""
+This module contains the export of loop regions and markers.
+
+A region is written to a WAV or FLAC file in blocks of EXPORT_BLOCK_FRAMES, so memory
+stays constant however long it is: unstretched blocks are views of the source array,
+a cached render is sliced the same way, and other rates are stretched chunk by chunk
+with stretch_chunks of stretch.py and written as every chunk finishes. The file is
+written under a temporary name until complete.
+
+The beats and measures are written to a standard MIDI file: a tempo map with a tempo
+change at every beat, so the quarter notes of a sequencer fall on the tapped beats and
+every measure has the time signature of its beat count, and a click track on the
+percussion channel, accented on the measures.
+
+Many regions are exported in parallel on a process pool. The file is decoded into
+the cache once, and the workers only memory-map its audio array, without touching the
+cache entry.
+
+    python export.py song.mp3 --region 10 20 --region 30 45 --rates 1 0.8 --format flac
+    python export.py song.mp3 --midi song.mid  # the beats and measures of the session
+"""
+
+import argparse
+import os
+import struct
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from cache import AUDIO_NAME, AudioCache, DEFAULT_CACHE_DIR, write_atomically
+from pcm import to_int16
+from stretch import CHUNK_SECONDS, stretch_chunks
+
+# Number of frames written at a time
+EXPORT_BLOCK_FRAMES = 64 * 1024
+EXPORT_FORMATS = ("wav", "flac")
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# Ticks per quarter note of the MIDI files, and the tempo without at least two beats
+TICKS_PER_QUARTER = 480
+DEFAULT_TEMPO_BPM = 120
+# Percussion channel and the General MIDI notes of the click: a high wood block on the
+# measures and a low one on the other beats
+CLICK_CHANNEL = 9
+MEASURE_CLICK = (76, 127)
+BEAT_CLICK = (77, 90)
+CLICK_TICKS = TICKS_PER_QUARTER // 8
+# A beat this close to a measure in ms is the same click
+CLICK_TOLERANCE_MS = 30
+
+
+class AudioWriter:
+    """
+    The AudioWriter class writes int16 blocks to a WAV or a FLAC file, chosen by the
+    extension, under a temporary name that is renamed when the writer is closed
+    without an error.
+    """
+
+    def __init__(self, path, sample_rate, num_channels):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower().lstrip(".")
+        if self.format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported format: {path}")
+        # A unique name, so concurrent exports to the same path do not collide
+        descriptor, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        os.close(descriptor)
+        if self.format == "flac":
+            # soundfile is installed with librosa
+            import soundfile  # pylint: disable=import-outside-toplevel
+            self.file = soundfile.SoundFile(self.tmp_path, "w", sample_rate, num_channels,
+                                            subtype="PCM_16", format="FLAC")
+        else:
+            self.file = wave.open(self.tmp_path, "wb")
+            self.file.setnchannels(num_channels)
+            self.file.setsampwidth(2)
+            self.file.setframerate(sample_rate)
+
+    def write(self, samples):
+        """
+        Appends a (frames, channels) int16 block.
+        """
+        if self.format == "flac":
+            self.file.write(samples)
+        else:
+            self.file.writeframes(samples.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, *_):
+        self.file.close()
+        if error_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+def region_blocks(audio_array, sample_rate, start_frame, end_frame, rate=1.0,
+                  rendered=None, stretch=None, block_frames=EXPORT_BLOCK_FRAMES):
+    """
+    Yields a region of audio at a rate in blocks.
+
+    Args:
+        audio_array (np.array): The (channels, frames) source audio.
+        sample_rate (int): The sample rate.
+        start_frame (int): The first frame of the region.
+        end_frame (int): The frame after the region.
+        rate (float): The stretch rate.
+        rendered (np.array): The region already stretched to the rate, e.g. from the
+            StretchCache, or None to stretch it.
+        stretch (callable): Stretches an audio array by a rate, like
+            core.stretch_audio.
+        block_frames (int): The number of frames in a block.
+
+    Yields:
+        tuple: The (channels, frames) block and the finished fraction of the region.
+    """
+    if rate == 1.0 or rendered is not None:
+        source = audio_array[..., start_frame:end_frame] if rendered is None else rendered
+        for start in range(0, source.shape[-1], block_frames):
+            end = min(source.shape[-1], start + block_frames)
+            yield source[..., start:end], end / source.shape[-1]
+        return
+
+    for _, body, chunk_end in stretch_chunks(audio_array, sample_rate, rate, start_frame,
+                                             end_frame, stretch,
+                                             int(CHUNK_SECONDS * sample_rate)):
+        progress = (chunk_end - start_frame) / (end_frame - start_frame)
+        for start in range(0, body.shape[-1], block_frames):
+            yield body[..., start:start + block_frames], progress
+
+
+def export_region(path, audio_array, sample_rate, start_frame, end_frame, rate=1.0,
+                  rendered=None, stretch=None, job=None):
+    """
+    Writes a region of audio at a rate to a WAV or FLAC file, block by block.
+
+    Args:
+        path (str): The path of the file, ending in .wav or .flac.
+        job (jobs.Job): The job exporting the region, for cancellation and progress.
+        The other arguments are those of region_blocks.
+
+    Returns:
+        int: The number of frames written, or None if the job was cancelled.
+    """
+    start_frame = max(0, int(start_frame))
+    end_frame = min(audio_array.shape[-1], int(end_frame))
+    written = 0
+    try:
+        with AudioWriter(path, sample_rate, audio_array.shape[0]) as writer:
+            for block, progress in region_blocks(audio_array, sample_rate, start_frame,
+                                                 end_frame, rate, rendered, stretch):
+                if job is not None and job.cancelled.is_set():
+                    raise InterruptedError
+                writer.write(to_int16(block))
+                written += block.shape[-1]
+                if job is not None:
+                    job.progress = progress
+    except InterruptedError:
+        return None
+    return written
+
+
+def variable_length(value):
+    """
+    Returns a number as a MIDI variable-length quantity.
+    """
+    encoded = [value & 0x7f]
+    value >>= 7
+    while value:
+        encoded.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(encoded))
+
+
+def midi_track(events):
+    """
+    Returns a track chunk of (tick, event bytes) events, which must be sorted.
+    """
+    data = bytearray()
+    previous = 0
+    for tick, event in events:
+        data += variable_length(tick - previous) + event
+        previous = tick
+    data += variable_length(0) + b"\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(data)) + bytes(data)
+
+
+def tempo_event(microseconds):
+    return b"\xff\x51\x03" + int(microseconds).to_bytes(3, "big")
+
+
+def tempo_map(beats):
+    """
+    Places every beat on a quarter note and returns the tempo changes that make the
+    quarter notes fall on the beats. A beat after the start gets a pickup of whole
+    ticks before it.
+
+    Args:
+        beats (np.array): The sorted beat times in ms.
+
+    Returns:
+        tuple: The times in ms and the ticks of the knots of the map, between which
+            it is linear, and the (tick, microseconds per quarter) tempo changes.
+    """
+    beats = np.unique(np.asarray(beats, dtype=np.float64))
+    if len(beats) < 2:
+        quarter_ms = 60000 / DEFAULT_TEMPO_BPM
+        return (np.array([0.0, quarter_ms]), np.array([0.0, TICKS_PER_QUARTER]),
+                [(0, quarter_ms * 1000)])
+
+    intervals = np.diff(beats)
+    pickup = 0
+    if beats[0] > 0:
+        pickup = max(1, int(round(beats[0] / intervals[0] * TICKS_PER_QUARTER)))
+    ticks = pickup + np.arange(len(beats), dtype=np.float64) * TICKS_PER_QUARTER
+    tempos = [(int(tick), interval * 1000) for tick, interval in zip(ticks, intervals)]
+    if pickup:
+        tempos.insert(0, (0, beats[0] * 1000 / pickup * TICKS_PER_QUARTER))
+        beats = np.concatenate(([0.0], beats))
+        ticks = np.concatenate(([0.0], ticks))
+    return beats, ticks, tempos
+
+
+def to_ticks(times, knot_times, knot_ticks):
+    """
+    Returns the ticks of times in ms on a tempo map, continuing its last tempo.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    ticks = np.interp(times, knot_times, knot_ticks)
+    last_tempo = ((knot_ticks[-1] - knot_ticks[-2]) / (knot_times[-1] - knot_times[-2]))
+    after = times > knot_times[-1]
+    ticks[after] = knot_ticks[-1] + (times[after] - knot_times[-1]) * last_tempo
+    return np.rint(ticks).astype(np.int64)
+
+
+def write_midi(path, beats, measures, click=True):
+    """
+    Writes beats and measures to a standard MIDI file with a tempo map, and a click
+    track if click is set.
+
+    Args:
+        path (str): The path of the file.
+        beats (np.array): The sorted beat times in ms.
+        measures (np.array): The sorted measure times in ms.
+        click (bool): Whether to add the click track.
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    measures = np.asarray(measures, dtype=np.float64)
+    knot_times, knot_ticks, tempos = tempo_map(beats)
+    events = [(0, b"\xff\x03" + variable_length(9) + b"Tempo map")]
+    events += [(tick, tempo_event(min(0xffffff, max(1, round(microseconds)))))
+               for tick, microseconds in tempos]
+
+    # A time signature of n quarters wherever the beat count of the measures changes
+    measure_ticks = to_ticks(measures, knot_times, knot_ticks)
+    previous_count = None
+    for index, measure in enumerate(measures):
+        if index + 1 == len(measures):
+            break
+        count = int(np.sum((beats >= measure - CLICK_TOLERANCE_MS)
+                           & (beats < measures[index + 1] - CLICK_TOLERANCE_MS)))
+        if 0 < count < 256 and count != previous_count:
+            events.append((int(measure_ticks[index]), bytes((0xff, 0x58, 4, count, 2, 24, 8))))
+            previous_count = count
+    tracks = [midi_track(sorted(events, key=lambda event: event[0]))]
+
+    if click:
+        clicks = [(tick, MEASURE_CLICK) for tick in measure_ticks]
+        # Beats on a measure click once, accented
+        near_measure = np.zeros(len(beats), dtype=bool)
+        if len(measures):
+            nearest = np.clip(np.searchsorted(measures, beats), 1, len(measures)) - 1
+            following = np.clip(nearest + 1, 0, len(measures) - 1)
+            near_measure = ((np.abs(beats - measures[nearest]) <= CLICK_TOLERANCE_MS)
+                            | (np.abs(beats - measures[following]) <= CLICK_TOLERANCE_MS))
+        clicks += [(tick, BEAT_CLICK) for tick in
+                   to_ticks(beats[~near_measure], knot_times, knot_ticks)]
+        click_events = [(0, b"\xff\x03" + variable_length(5) + b"Click")]
+        for tick, (note, velocity) in clicks:
+            click_events.append((int(tick), bytes((0x90 | CLICK_CHANNEL, note, velocity))))
+            click_events.append((int(tick) + CLICK_TICKS,
+                                 bytes((0x80 | CLICK_CHANNEL, note, 0))))
+        # Note offs first at the same tick, so a click never cuts the next one
+        click_events.sort(key=lambda event: (event[0], event[1][0] & 0xf0 != 0x80))
+        tracks.append(midi_track(click_events))
+
+    header = b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks), TICKS_PER_QUARTER)
+    write_atomically(path, lambda file: file.write(header + b"".join(tracks)))
+
+
+def region_path(file_path, start_ms, end_ms, rate, output_dir, extension):
+    """
+    Returns the path of the export of a region, e.g. song-10.0-20.0s-0.8x.flac.
+    """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(output_dir, f"{stem}-{start_ms / 1000:.1f}-{end_ms / 1000:.1f}s-"
+                                    f"{rate:g}x.{extension}")
+
+
+def export_task(audio_path, sample_rate, start_ms, end_ms, rate, path):
+    """
+    Exports one region of the decoded audio. Runs in a worker process, which only
+    memory-maps the .npy file of the audio and leaves the cache entry alone.
+
+    Returns:
+        tuple: The length of the export in seconds and the time it took.
+    """
+    from core import stretch_audio  # pylint: disable=import-outside-toplevel
+
+    started = time.perf_counter()
+    audio_array = np.load(audio_path, mmap_mode="r")
+    written = export_region(path, audio_array, sample_rate, start_ms / 1000 * sample_rate,
+                            end_ms / 1000 * sample_rate, rate, stretch=stretch_audio)
+    return written / sample_rate, time.perf_counter() - started
+
+
+def export_regions(file_path, regions, rates, output_dir, extension, cache_dir, workers):
+    """
+    Exports every region of a file at every rate on a process pool, and reports the
+    time of every export and the total.
+
+    Args:
+        regions (list): The (start ms, end ms) of the regions.
+        rates (list): The stretch rates.
+    """
+    # pylint: disable=import-outside-toplevel
+    from core import read_audio_file
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Decode once, so the workers all memory-map the cached audio
+    cache = AudioCache(cache_dir)
+    audio_array, sample_rate, _ = cache.get(file_path, read_audio_file)
+    audio_path = cache.array_path(cache.key_for(file_path), AUDIO_NAME)
+    tasks = [(start_ms, end_ms, rate, region_path(file_path, start_ms, end_ms, rate,
+                                                  output_dir, extension))
+             for start_ms, end_ms in regions for rate in rates]
+    print(f"Exporting {len(tasks)} regions with {workers} workers")
+
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        if not os.path.exists(audio_path):
+            # The file is larger than the whole cache, so it was not kept there
+            audio_path = os.path.join(directory, f"{AUDIO_NAME}.npy")
+            np.save(audio_path, audio_array)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(export_task, audio_path, sample_rate, *task): task[-1]
+                       for task in tasks}
+            for future in as_completed(futures):
+                name = os.path.basename(futures[future])
+                try:
+                    seconds, elapsed = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    print(f"{name}: failed: {error}")
+                    continue
+                print(f"{name}: {seconds:.1f} s in {elapsed:.1f} s")
+    print(f"Exported in {time.perf_counter() - started:.1f} s")
+
+
+def export_session_midi(file_path, path, cache_dir, click=True):
+    """
+    Writes the beats and measures of the session of a file to a MIDI file.
+    """
+    import markers  # pylint: disable=import-outside-toplevel
+    session = markers.load_session(AudioCache(cache_dir).key_for(file_path))
+    if session is None:
+        print(f"No beats or measures saved for {file_path}")
+        return
+    beats, measures = session
+    write_midi(path, beats, measures, click)
+    print(f"Wrote {len(beats)} beats and {len(measures)} measures to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export loop regions to audio files and markers to MIDI.")
+    parser.add_argument("file", help="audio file")
+    parser.add_argument("--region", type=float, nargs=2, action="append", default=[],
+                        metavar=("START", "END"), help="region in seconds, repeatable")
+    parser.add_argument("--rates", type=float, nargs="*", default=[1.0])
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="wav")
+    parser.add_argument("--output", default="exports", help="folder of the exports")
+    parser.add_argument("--midi", metavar="PATH",
+                        help="write the beats and measures of the session to PATH")
+    parser.add_argument("--no-click", action="store_true",
+                        help="write only the tempo map to the MIDI file")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+    if args.region:
+        export_regions(args.file, [(start * 1000, end * 1000) for start, end in args.region],
+                       args.rates, args.output, args.format, args.cache_dir, args.workers)
+    if args.midi:
+        export_session_midi(args.file, args.midi, args.cache_dir, not args.no_click)
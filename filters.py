@@ -0,0 +1,195 @@
+"""
+This module contains the isolation filters of the playback.
+
+A FilterStage filters the output blocks on their way to the mixer, to pick out a bass
+line or a voice while looping. A preset combines a stereo mode, which keeps the mid
+(L + R) or the side (L - R) signal, with a Butterworth filter run as second-order
+sections over all channels at once. The filter state is carried from block to block,
+so a preset applies from the next block without filtering the file up front.
+
+The waveform can show the filtered signal. Its envelope is built by filtering the
+file in chunks in the background and is cached like the envelope of the original.
+
+    python filters.py --seconds 60  # measure the cost per block of every preset
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from pcm import DTYPE, to_mono
+from waveform import WaveformPyramid
+
+# Presets by name: the stereo mode ("stereo", "mid" or "side") and the filter as
+# (type, cutoff frequency or band in Hz), or None
+PRESETS = {
+    "off": ("stereo", None),
+    "bass": ("stereo", ("lowpass", 250)),
+    "voice": ("mid", ("bandpass", (300, 3400))),
+    "treble": ("stereo", ("highpass", 2000)),
+    "mid": ("mid", None),
+    "side": ("side", None),
+}
+# Order of the Butterworth filters. A band-pass has twice as many sections.
+FILTER_ORDER = 4
+# Frames filtered ahead of a window drawn sample by sample, so the filter has settled
+LEAD_FRAMES = 4096
+# Frames filtered at a time to build the envelope, a multiple of BASE_BUCKET
+ENVELOPE_CHUNK_FRAMES = 256 * 1024
+
+
+def design(filter_spec, sample_rate):
+    """
+    Returns the float32 second-order sections of a (type, cutoff) filter.
+    """
+    # scipy.signal takes seconds to import, so it is imported on first use
+    from scipy import signal  # pylint: disable=import-outside-toplevel
+    kind, cutoff = filter_spec
+    return signal.butter(FILTER_ORDER, cutoff, btype=kind, fs=sample_rate,
+                         output="sos").astype(np.float32)
+
+
+def apply_mode(block, mode):
+    """
+    Returns the (channels, frames) block reduced to its mid or side signal, or the
+    block itself in the stereo mode.
+    """
+    if block.ndim == 1:
+        block = block[np.newaxis]
+    if mode == "mid":
+        return to_mono(block)[np.newaxis]
+    if mode == "side":
+        if block.shape[0] < 2:
+            return np.zeros((1, block.shape[-1]), dtype=block.dtype)
+        return ((block[0] - block[1]) * 0.5)[np.newaxis]
+    return block
+
+
+class FilterStage:
+    """
+    The FilterStage class filters consecutive blocks of audio with a preset.
+
+    Attributes:
+        preset (str): The name of the preset, a key of PRESETS.
+        mode (str): The stereo mode of the preset.
+        sos (np.array): The second-order sections of the filter, or None.
+        state (np.array): The state of the sections after the last block, shaped
+            (sections, channels, 2), or None before the first block.
+    """
+
+    def __init__(self, sample_rate, preset="off"):
+        self.sample_rate = sample_rate
+        self.set_preset(preset)
+
+    def set_preset(self, preset):
+        """
+        Switches to a preset. It applies from the next block.
+        """
+        mode, filter_spec = PRESETS[preset]
+        self.preset = preset
+        self.mode = mode
+        self.sos = None if filter_spec is None else design(filter_spec, self.sample_rate)
+        self.state = None
+
+    def process(self, block):
+        """
+        Filters the next block, continuing from the state of the previous one.
+
+        Returns:
+            np.array: The filtered (channels, frames) block. It has one channel in
+                the mid and side modes.
+        """
+        audio = apply_mode(block, self.mode)
+        if self.sos is not None:
+            from scipy import signal  # pylint: disable=import-outside-toplevel
+            if self.state is None or self.state.shape[1] != audio.shape[0]:
+                self.state = np.zeros((len(self.sos), audio.shape[0], 2), dtype=DTYPE)
+            audio, self.state = signal.sosfilt(self.sos, audio, axis=-1, zi=self.state)
+        return audio
+
+
+class FilteredAudio:
+    """
+    The FilteredAudio class is a read-only view of audio through a preset, for the
+    waveform. Slicing its frames filters them, with LEAD_FRAMES before them so the
+    filter has settled.
+
+    Attributes:
+        audio (np.array): The (channels, frames) audio.
+        shape (tuple): The shape of the filtered audio.
+    """
+
+    def __init__(self, audio, sample_rate, preset):
+        self.audio = audio
+        self.sample_rate = sample_rate
+        self.preset = preset
+        channels = 1 if PRESETS[preset][0] != "stereo" else audio.shape[0]
+        self.shape = (channels, audio.shape[-1])
+
+    def __getitem__(self, key):
+        frames = key[-1] if isinstance(key, tuple) else key
+        start, stop, _ = frames.indices(self.shape[-1])
+        lead = min(start, LEAD_FRAMES)
+        stage = FilterStage(self.sample_rate, self.preset)
+        return stage.process(self.audio[..., start - lead:stop])[..., lead:]
+
+
+def filtered_pyramid(audio_array, sample_rate, preset, job=None):
+    """
+    Builds the envelope pyramid of the filtered audio chunk by chunk, so the filtered
+    audio is never held in full.
+
+    Args:
+        audio_array (np.array): The (channels, frames) audio.
+        sample_rate (int): The sample rate.
+        preset (str): The name of the preset.
+        job (jobs.Job): The job building the envelope, for cancellation and progress.
+
+    Returns:
+        WaveformPyramid: The envelope pyramid, or None if the job was cancelled.
+    """
+    num_frames = audio_array.shape[-1]
+    pyramid = WaveformPyramid.zeros(num_frames, DTYPE)
+    stage = FilterStage(sample_rate, preset)
+    for start in range(0, num_frames, ENVELOPE_CHUNK_FRAMES):
+        if job is not None and job.cancelled.is_set():
+            return None
+        end = min(num_frames, start + ENVELOPE_CHUNK_FRAMES)
+        pyramid.update_block(stage.process(audio_array[..., start:end]), start)
+        if job is not None:
+            job.progress = end / num_frames
+    return pyramid
+
+
+def benchmark(seconds, block_frames, sample_rate=44100):
+    """
+    Measures the cost per block of every preset against the block duration, and the
+    time to build a filtered envelope.
+    """
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal((2, int(seconds * sample_rate))) * 0.1).astype(DTYPE)
+    block_ms = block_frames / sample_rate * 1000
+    for preset in PRESETS:
+        stage = FilterStage(sample_rate, preset)
+        stage.process(audio[:, :block_frames])
+        started = time.perf_counter()
+        num_blocks = audio.shape[-1] // block_frames
+        for index in range(num_blocks):
+            stage.process(audio[:, index * block_frames:(index + 1) * block_frames])
+        elapsed = (time.perf_counter() - started) / num_blocks * 1000
+        print(f"{preset:7} {elapsed:.3f} ms per {block_ms:.1f} ms block "
+              f"({elapsed / block_ms:.1%} of a core)")
+
+    started = time.perf_counter()
+    filtered_pyramid(audio, sample_rate, "voice")
+    print(f"Filtered envelope of {seconds:.0f} s: {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the cost of the isolation filters per output block.")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--block", type=int, default=1024)
+    args = parser.parse_args()
+    benchmark(args.seconds, args.block)
@@ -0,0 +1,178 @@
+"""
+This module contains the scheduler of background jobs.
+
+Decoding, stretching and analysis run on a thread pool so that the Tk mainloop keeps
+handling key presses and redraws. Results, progress and errors are handed back to the
+Tk thread by a poll loop scheduled with root.after, and submitting a job of a kind
+that is already running cancels the superseded one.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+# Interval in ms at which the Tk thread picks up job progress and results
+POLL_INTERVAL = 50
+
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class Job:
+    """
+    The Job class is the handle of a submitted job.
+
+    The job function receives it as its first argument, checks cancelled to stop
+    early and sets progress to report how far it is.
+
+    Attributes:
+        kind (str): The kind of the job, e.g. "load". Only one job of a kind runs.
+        cancelled (threading.Event): Set when the job is cancelled or superseded.
+        progress (float): The finished fraction, set by the job function.
+        started_at (float): The perf_counter time the job was submitted.
+    """
+
+    def __init__(self, kind, on_done, on_progress, on_error):
+        self.kind = kind
+        self.on_done = on_done
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+        self.progress = 0.0
+        self.started_at = time.perf_counter()
+        self.future = None
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+
+class JobScheduler:
+    """
+    The JobScheduler class runs jobs on a thread pool and calls their callbacks on
+    the Tk thread.
+
+    Attributes:
+        root: The root widget, used to schedule the poll loop.
+        jobs (dict): The running jobs by kind.
+        on_status (callable): Called with a text describing the running jobs, or an
+            empty text when idle.
+        max_lateness (float): The largest delay of a poll tick in ms while jobs ran,
+            a measure of how responsive the Tk thread stayed.
+    """
+
+    def __init__(self, root, max_workers=MAX_WORKERS):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = {}
+        self.finished = queue.Queue()
+        self.on_status = None
+        self.polling = False
+        self.next_poll = None
+        self.max_lateness = 0.0
+        self.status = ""
+
+    def submit(self, kind, function, *args, on_done=None, on_progress=None,
+               on_error=None):
+        """
+        Runs function(job, *args) on the pool, cancelling a running job of the
+        same kind.
+
+        Args:
+            kind (str): The kind of the job.
+            function (callable): The job function.
+            on_done (callable): Called on the Tk thread with the result.
+            on_progress (callable): Called on the Tk thread with the job on every
+                poll tick while it runs.
+            on_error (callable): Called on the Tk thread with the exception. The
+                error is printed if not given.
+
+        Returns:
+            Job: The handle of the job.
+        """
+        self.cancel(kind)
+        job = Job(kind, on_done, on_progress, on_error)
+        self.jobs[kind] = job
+        job.future = self.executor.submit(self.run, job, function, args)
+        self.start_polling()
+        return job
+
+    def run(self, job, function, args):
+        # Runs on a worker thread
+        try:
+            result = function(job, *args)
+        except Exception as error:  # pylint: disable=broad-except
+            self.finished.put((job, None, error))
+        else:
+            self.finished.put((job, result, None))
+
+    def cancel(self, kind):
+        """
+        Cancels the running job of the given kind, if any. Its callbacks are not called.
+        """
+        job = self.jobs.pop(kind, None)
+        if job is not None:
+            job.cancel()
+
+    def is_running(self, kind):
+        return kind in self.jobs
+
+    def start_polling(self):
+        if not self.polling:
+            self.polling = True
+            self.max_lateness = 0.0
+            self.next_poll = time.perf_counter() + POLL_INTERVAL / 1000
+            self.root.after(POLL_INTERVAL, self.poll)
+
+    def poll(self):
+        """
+        Hands progress and results of the jobs to their callbacks. Runs on the Tk thread.
+        """
+        lateness = (time.perf_counter() - self.next_poll) * 1000
+        self.max_lateness = max(self.max_lateness, lateness)
+
+        while not self.finished.empty():
+            job, result, error = self.finished.get()
+            if job.cancelled.is_set() or self.jobs.get(job.kind) is not job:
+                continue  # superseded
+            del self.jobs[job.kind]
+            elapsed = time.perf_counter() - job.started_at
+            telemetry.recorder.record(f"job {job.kind}", elapsed)
+            if error is not None:
+                if job.on_error is not None:
+                    job.on_error(error)
+                else:
+                    print(f"Job {job.kind} failed: {error}")
+            else:
+                print(f"Job {job.kind} finished in {elapsed:.2f} s")
+                if job.on_done is not None:
+                    job.on_done(result)
+
+        for job in list(self.jobs.values()):
+            if job.on_progress is not None and not job.cancelled.is_set():
+                job.on_progress(job)
+
+        self.update_status()
+        if self.jobs:
+            self.next_poll = time.perf_counter() + POLL_INTERVAL / 1000
+            self.root.after(POLL_INTERVAL, self.poll)
+        else:
+            self.polling = False
+            print(f"UI tick lateness while busy: max {self.max_lateness:.0f} ms")
+
+    def update_status(self):
+        status = ", ".join(f"{job.kind} {job.progress:.0%}"
+                           for job in self.jobs.values())
+        if status != self.status:
+            self.status = status
+            if self.on_status is not None:
+                self.on_status(status)
+
+    def shutdown(self):
+        for kind in list(self.jobs):
+            self.cancel(kind)
+        self.executor.shutdown(wait=False, cancel_futures=True)
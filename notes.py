@@ -0,0 +1,172 @@
+"""
+This module contains the note detection.
+
+pYIN tracks the fundamental frequency of monophonic audio well, but it runs at about
+real time on one core. The decoded audio is therefore split into overlapping chunks
+that are tracked on a process pool, one chunk per core at a time. The pitch tracks of
+the chunks are joined, each keeping the frames nearest to it, and segmented into note
+events of a constant MIDI pitch.
+
+Notes are (onset, offset, pitch) rows with the times in ms of the original audio, like
+Core.beats. Stretching keeps the pitch and the timeline stays the original audio, so
+the notes of a file hold at every playback rate.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import librosa
+
+from pcm import to_mono
+
+# Length of the chunks tracked by a worker
+CHUNK_SECONDS = 10.0
+# Extra audio on each side of a chunk, so the tracks match at the chunk edges
+OVERLAP_SECONDS = 0.5
+FRAME_LENGTH = 2048
+HOP_LENGTH = 512
+# Pitch range of the tracker, from C2 to C7
+FMIN = 65.41
+FMAX = 2093.0
+# Notes shorter than this are dropped as tracking noise
+MIN_NOTE_SECONDS = 0.06
+
+MAX_WORKERS = os.cpu_count() or 1
+
+# Name of the array cached next to the decoded audio
+NOTES_NAME = "notes"
+
+PITCH_CLASSES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
+
+def note_name(pitch):
+    """
+    Returns the name of a MIDI pitch, e.g. "A4" for 69.
+    """
+    pitch = int(round(pitch))
+    return f"{PITCH_CLASSES[pitch % 12]}{pitch // 12 - 1}"
+
+
+def track_chunk(audio, sample_rate):
+    """
+    Tracks the pitch of a mono float chunk. Runs in a worker process.
+
+    Returns:
+        np.array: The MIDI pitch of every HOP_LENGTH frames, NaN where unvoiced.
+    """
+    f0, voiced, _ = librosa.pyin(audio, fmin=FMIN, fmax=FMAX, sr=sample_rate,
+                                 frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH)
+    f0[~voiced] = np.nan
+    return librosa.hz_to_midi(f0)
+
+
+def chunk_bounds(num_frames, sample_rate):
+    """
+    Returns the (start, end, input_start, input_end) frames of the chunks, with the
+    bounds aligned to HOP_LENGTH.
+    """
+    chunk_frames = max(1, int(CHUNK_SECONDS * sample_rate) // HOP_LENGTH) * HOP_LENGTH
+    overlap = int(OVERLAP_SECONDS * sample_rate) // HOP_LENGTH * HOP_LENGTH
+    return [(start, min(num_frames, start + chunk_frames), max(0, start - overlap),
+             min(num_frames, start + chunk_frames + overlap))
+            for start in range(0, num_frames, chunk_frames)]
+
+
+def segment_notes(pitches, sample_rate):
+    """
+    Splits a pitch track into notes of a constant rounded MIDI pitch.
+
+    Returns:
+        np.array: The (onset ms, offset ms, MIDI pitch) rows of the notes.
+    """
+    # Unvoiced frames are -1
+    rounded = np.round(np.nan_to_num(pitches, nan=-1.0))
+    changes = np.flatnonzero(np.diff(rounded)) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [len(rounded)]))
+    frame_ms = HOP_LENGTH / sample_rate * 1000
+    min_frames = MIN_NOTE_SECONDS * 1000 / frame_ms
+
+    keep = (rounded[starts] >= 0) & (ends - starts >= min_frames)
+    return np.column_stack((starts[keep] * frame_ms, ends[keep] * frame_ms,
+                            rounded[starts[keep]])).astype(np.float64).reshape(-1, 3)
+
+
+def detect_notes(audio_array, sample_rate, job=None, max_workers=MAX_WORKERS):
+    """
+    Detects the notes of the audio on a process pool.
+
+    Args:
+        audio_array (np.array): The audio array.
+        sample_rate (int): The sample rate.
+        job (jobs.Job): The job running the detection, for cancellation and progress.
+        max_workers (int): The number of worker processes.
+
+    Returns:
+        np.array: The (onset ms, offset ms, MIDI pitch) rows of the notes, or None if
+            the job was cancelled.
+    """
+    started = time.perf_counter()
+    bounds = chunk_bounds(audio_array.shape[-1], sample_rate)
+    tracks = [None] * len(bounds)
+
+    # Spawned workers do not inherit the threads of the app
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        pending = {executor.submit(track_chunk, to_mono(audio_array[..., start:end]),
+                                   sample_rate): index
+                   for index, (_, _, start, end) in enumerate(bounds)}
+        while pending:
+            done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            if job is not None and job.cancelled.is_set():
+                executor.shutdown(wait=False, cancel_futures=True)
+                return None
+            for future in done:
+                tracks[pending.pop(future)] = future.result()
+            if job is not None:
+                job.progress = 1 - len(pending) / len(bounds)
+
+    # Keep the frames of each chunk between its own bounds
+    pitches = []
+    for (start, end, input_start, _), track in zip(bounds, tracks):
+        skip = (start - input_start) // HOP_LENGTH
+        pitches.append(track[skip:skip + -(-(end - start) // HOP_LENGTH)])
+    notes = segment_notes(np.concatenate(pitches), sample_rate)
+
+    elapsed = time.perf_counter() - started
+    seconds = audio_array.shape[-1] / sample_rate
+    print(f"Detected {len(notes)} notes in {seconds:.1f} s of audio in "
+          f"{elapsed:.1f} s ({seconds / elapsed:.2f} s of audio per s, "
+          f"{max_workers} workers)")
+    return notes
+
+
+def benchmark(seconds, max_workers, sample_rate=44100):
+    """
+    Detects the notes of a synthetic melody and checks them against the melody.
+    """
+    note_seconds = 0.5
+    melody = np.tile([57, 60, 64, 67, 69, 67, 64, 60],
+                     int(seconds / note_seconds) // 8 + 1)
+    melody = melody[:int(seconds / note_seconds)]
+    note_frames = int(note_seconds * sample_rate)
+    phase = np.cumsum(np.repeat(librosa.midi_to_hz(melody), note_frames)) / sample_rate
+    audio = (np.sin(2 * np.pi * phase) * 0.3).astype(np.float32)[np.newaxis]
+
+    notes = detect_notes(audio, sample_rate, max_workers=max_workers)
+    expected = melody[(notes[:, 0] / 1000 / note_seconds).astype(int)]
+    print(f"{np.mean(notes[:, 2] == expected):.0%} of {len(notes)} notes have the "
+          f"pitch of the melody, {len(melody)} notes expected")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the note detection on a synthetic melody.")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    args = parser.parse_args()
+    benchmark(args.seconds, args.workers)
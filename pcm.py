@@ -0,0 +1,91 @@
+"""
+This module contains the conversions between PCM data and the internal audio format.
+
+Audio is held as contiguous float32 arrays in [-1, 1] in channel-major layout, shaped
+(channels, frames), mono as (1, frames). Every channel is contiguous, so stretching
+and analysis work on all channels at once along the last axis, and the arrays are
+memory-mapped from the cache as they are. Decoded PCM is converted once when it is
+read, and the device format is produced only at the output edge.
+
+The functions also accept 1-D mono arrays, so the frames are always the last axis.
+"""
+
+import numpy as np
+
+DTYPE = np.float32
+
+# Integer sample formats by sample width in bytes. 8-bit PCM is unsigned.
+INTEGER_TYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+def from_pcm(raw_data, sample_width, num_channels, floating=False):
+    """
+    Converts interleaved PCM data to the internal format.
+
+    Args:
+        raw_data (bytes): The interleaved samples.
+        sample_width (int): The bytes per sample: 1, 2, 3 or 4.
+        num_channels (int): The number of channels.
+        floating (bool): Whether the samples are 32-bit floats instead of integers.
+
+    Returns:
+        np.array: The (channels, frames) float32 audio.
+    """
+    if floating:
+        samples = np.frombuffer(raw_data, dtype=np.float32)
+        scale = 1.0
+    elif sample_width == 3:
+        # Place the 24-bit samples in the top bytes of 32-bit ones
+        packed = np.frombuffer(raw_data, dtype=np.uint8).reshape((-1, 3))
+        padded = np.zeros((packed.shape[0], 4), dtype=np.uint8)
+        padded[:, 1:] = packed
+        samples = padded.view("<i4").reshape(-1)
+        scale = 1.0 / 2 ** 31
+    else:
+        samples = np.frombuffer(raw_data, dtype=INTEGER_TYPES[sample_width])
+        scale = 1.0 / 2 ** (8 * sample_width - 1)
+    if sample_width == 1 and not floating:
+        samples = samples.astype(np.int16) - 128
+
+    audio = np.empty((num_channels, len(samples) // num_channels), dtype=DTYPE)
+    for channel in range(num_channels):
+        np.multiply(samples[channel::num_channels], scale, out=audio[channel],
+                    casting="unsafe")
+    return audio
+
+
+def to_mono(audio_array):
+    """
+    Returns the audio with the channels averaged, as a 1-D array. A mono array is
+    returned as a view.
+    """
+    if audio_array.ndim == 1:
+        return audio_array
+    if audio_array.shape[0] == 1:
+        return audio_array[0]
+    return audio_array.mean(axis=0, dtype=DTYPE)
+
+
+def write_int16(audio_array, out):
+    """
+    Converts audio to the int16 device format into a (frames, channels) block.
+    Mono audio is copied to every channel of the block.
+    """
+    scaled = np.clip(audio_array * 32767.0, -32768, 32767)
+    if scaled.ndim == 1:
+        scaled = scaled[np.newaxis]
+    if scaled.shape[0] == 1:
+        out[:] = scaled[0, :, np.newaxis]
+    else:
+        out[:] = scaled[:out.shape[1]].T
+
+
+def to_int16(audio_array):
+    """
+    Returns the audio as interleaved int16 PCM, shaped (frames, channels), e.g. to
+    write a WAV file.
+    """
+    channels = 1 if audio_array.ndim == 1 else audio_array.shape[0]
+    out = np.empty((audio_array.shape[-1], channels), dtype=np.int16)
+    write_int16(audio_array, out)
+    return out
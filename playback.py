@@ -0,0 +1,486 @@
+"""
+This module contains the persistent audio output.
+
+Re-initializing the mixer and building a Sound of the whole selection on every play
+costs time and memory proportional to the file length. Instead the mixer is opened
+once per sample rate, and a feeder thread keeps a pygame channel queued with short
+blocks. The blocks are rendered into a ring of preallocated Sounds straight from a
+view of the float32 source array, converting to int16 and expanding mono to stereo
+per block, and wrapping at the end of the loop to the exact sample.
+
+The playback position is a clock driven by the blocks the mixer has actually
+consumed, interpolated within the playing block and corrected by the measured
+output latency, so it does not drift against the audio device.
+
+In the live mode the stream stretches the source block by block with a
+WsolaStretcher, so the rate can change while playing. Every block then records the
+source frame it starts at and its rate, and the clock advances through the source at
+that rate. The blocks can also pass through a FilterStage of filters.py before the
+conversion.
+
+The AudioOutput talks to the device through a small interface, so the PygameDevice
+can be swapped for the SimulatedDevice of simulated.py, which plays headless on a
+virtual clock.
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import telemetry
+from filters import FilterStage
+from pcm import write_int16
+from wsola import WsolaStretcher
+
+# Number of frames in an output block
+BLOCK_FRAMES = 1024
+# Number of preallocated blocks. One plays, one is queued, the others are free.
+NUM_BLOCKS = 4
+# Weight of a new latency measurement in the running estimate
+LATENCY_SMOOTHING = 0.25
+
+
+class LoopStream:
+    """
+    The LoopStream class renders output blocks from a source array played in a loop.
+
+    Attributes:
+        source (np.array): The (channels, frames) float32 audio being played. It is
+            read in place, so it may still be filled while it plays.
+        position (int): The next frame of the source to render.
+        stretcher (WsolaStretcher): The stretcher of the live mode, or None if the
+            source plays as it is.
+        filters (FilterStage): The filters the blocks pass through, or None.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.position = 0
+        self.stretcher = None
+        self.filters = None
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return 1.0 if self.stretcher is None else self.stretcher.rate
+
+    def set_source(self, source, position=0):
+        with self.lock:
+            self.source = source
+            self.position = position
+            if self.stretcher is not None:
+                self.stretcher.reset(position)
+
+    def set_rate(self, rate, sample_rate):
+        """
+        Stretches the source in real time at the rate, or plays it as it is if the
+        rate is None. A running stretch changes its rate from the next hop.
+        """
+        with self.lock:
+            if rate is None:
+                self.stretcher = None
+                return
+            if self.stretcher is None:
+                self.stretcher = WsolaStretcher(sample_rate)
+                self.stretcher.reset(self.position)
+            self.stretcher.rate = rate
+
+    def set_filter(self, preset, sample_rate):
+        """
+        Passes the blocks through the filter preset from the next block, or plays
+        them as they are if the preset is "off".
+        """
+        stage = None if preset == "off" else FilterStage(sample_rate, preset)
+        with self.lock:
+            self.filters = stage
+
+    def read(self, source, count):
+        """
+        Returns the next count frames of the source, wrapping at its end. They are a
+        view of the source unless they wrap.
+        """
+        parts = []
+        while count > 0:
+            num_frames = min(count, source.shape[-1] - self.position)
+            parts.append(source[..., self.position:self.position + num_frames])
+            count -= num_frames
+            self.position += num_frames
+            if self.position >= source.shape[-1]:
+                self.position = 0
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=-1)
+
+    def render(self, out):
+        """
+        Fills a (frames, 2) int16 block with the next frames of the source, wrapping
+        at its end. Fills silence if there is no source.
+        """
+        with self.lock:
+            source = self.source
+            if source is None or source.shape[-1] == 0:
+                out[:] = 0
+                return
+            if self.stretcher is not None:
+                block = self.stretcher.read(source, out.shape[0])
+                self.position = self.stretcher.source_position(source.shape[-1])
+            else:
+                block = self.read(source, out.shape[0])
+            if self.filters is not None:
+                started = time.perf_counter()
+                block = self.filters.process(block)
+                telemetry.recorder.record("filter block", time.perf_counter() - started)
+            write_int16(block, out)
+
+
+class PygameDevice:
+    """
+    The PygameDevice class is the output device of an AudioOutput that plays
+    through one persistent pygame channel. A feeder thread calls the feed function
+    of the output four times per block.
+
+    The device interface is: open, close, quit, now, play, queue, busy, queue_empty,
+    stop, pause and unpause. SimulatedDevice of simulated.py implements it on a
+    virtual clock.
+    """
+
+    def __init__(self):
+        # Imported here, so the module imports without pygame for the headless devices
+        import pygame  # pylint: disable=import-outside-toplevel
+        self.pygame = pygame
+        pygame.init()
+        self.sounds = []
+        self.channel = None
+        self.running = False
+        self.thread = None
+
+    def open(self, sample_rate, block_frames, num_blocks, feed):
+        """
+        Opens the mixer at the sample rate and starts calling feed.
+
+        Returns:
+            list: The (frames, 2) int16 buffers the blocks are rendered into.
+        """
+        self.pygame.mixer.quit()
+        self.pygame.mixer.init(frequency=sample_rate, size=-16, channels=2, buffer=block_frames)
+        self.sounds = [
+            self.pygame.mixer.Sound(buffer=np.zeros((block_frames, 2), dtype=np.int16))
+            for _ in range(num_blocks)]
+        self.channel = self.pygame.mixer.Channel(0)
+        self.running = True
+        self.thread = threading.Thread(target=self.run_feeder,
+                                       args=(feed, block_frames / sample_rate / 4),
+                                       daemon=True)
+        self.thread.start()
+        # Views into the sample memory of the Sounds, rendered into in place
+        return [self.pygame.sndarray.samples(sound) for sound in self.sounds]
+
+    def run_feeder(self, feed, interval):
+        """
+        Keeps the channel queued with the next block. Runs on a background thread.
+        """
+        while self.running:
+            feed()
+            time.sleep(interval)
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.channel is not None:
+            self.channel.stop()
+            self.channel = None
+
+    def quit(self):
+        self.pygame.quit()  # pylint: disable=no-member
+
+    def now(self):
+        return time.perf_counter()
+
+    def play(self, index):
+        self.channel.play(self.sounds[index])
+
+    def queue(self, index):
+        self.channel.queue(self.sounds[index])
+
+    def busy(self):
+        return self.channel.get_busy()
+
+    def queue_empty(self):
+        return self.channel.get_queue() is None
+
+    def stop(self):
+        self.channel.stop()
+
+    def pause(self):
+        self.channel.pause()
+
+    def unpause(self):
+        self.channel.unpause()
+
+
+class AudioOutput:
+    """
+    The AudioOutput class plays a LoopStream through a device that plays one block
+    and holds the next one queued, and keeps the playback clock.
+
+    Attributes:
+        device: The output device, e.g. a PygameDevice.
+        stream (LoopStream): The stream rendering the blocks.
+        sample_rate (int): The sample rate the device is open at, or None.
+        block_frames (int): The number of frames in a block.
+        latency (float): The estimated output latency in seconds, measured as the
+            delay of the first block change after a play.
+        frames_played (int): The frames of the blocks that started playing since
+            the last play, for the drift diagnostic.
+    """
+
+    def __init__(self, device, block_frames=BLOCK_FRAMES, num_blocks=NUM_BLOCKS):
+        self.device = device
+        self.stream = LoopStream()
+        self.block_frames = block_frames
+        self.num_blocks = num_blocks
+        self.sample_rate = None
+        self.buffers = []
+        self.next_block = 0
+        self.filter_preset = "off"
+        self.paused = False
+        self.lock = threading.Lock()
+
+        # Clock state: the source position, rate and start time of the playing block
+        self.block_position = 0
+        self.block_rate = 1.0
+        self.block_started_at = None
+        self.queued_position = None
+        self.queued_rate = 1.0
+        self.frames_played = 0
+        self.paused_elapsed = 0
+        self.play_position = 0
+        self.play_started_at = None
+        self.paused_since = None
+        self.paused_total = 0.0
+        self.latency = 0.0
+        self.latency_pending = False
+
+    def open(self, sample_rate):
+        """
+        Opens the device at the sample rate, unless it is already open at it.
+        """
+        if self.sample_rate == sample_rate:
+            return
+        self.close()
+        self.sample_rate = sample_rate
+        # Until measured, assume the device buffer of one block
+        self.latency = self.block_frames / sample_rate
+        # The filters are designed for the sample rate
+        self.stream.set_filter(self.filter_preset, sample_rate)
+        # The device may call feed before it returns the buffers
+        with self.lock:
+            self.buffers = self.device.open(sample_rate, self.block_frames,
+                                            self.num_blocks, self.feed)
+
+    def close(self):
+        if self.sample_rate is not None:
+            self.device.close()
+        self.sample_rate = None
+
+    def quit(self):
+        """
+        Closes the device and releases the audio system.
+        """
+        self.close()
+        self.device.quit()
+
+    def set_rate(self, rate):
+        """
+        Stretches the playback in real time at the rate, or stops stretching if the
+        rate is None. The device must be open.
+        """
+        self.stream.set_rate(rate, self.sample_rate)
+
+    def set_filter(self, preset):
+        """
+        Filters the playback with a preset of filters.py from the next block. The
+        preset is kept when the device is reopened at another sample rate.
+        """
+        self.filter_preset = preset
+        if self.sample_rate is not None:
+            self.stream.set_filter(preset, self.sample_rate)
+
+    def render_next(self):
+        """
+        Renders the next block. Returns its buffer index, its first source frame and
+        the rate it advances through the source at.
+        """
+        index = self.next_block
+        position = self.stream.position
+        rate = self.stream.rate
+        self.stream.render(self.buffers[index])
+        self.next_block = (self.next_block + 1) % self.num_blocks
+        return index, position, rate
+
+    def start_block(self, position, rate, now):
+        """
+        Records that the block starting at the source position began playing.
+        """
+        if self.block_started_at is not None:
+            self.frames_played += self.block_frames
+        self.block_position = position
+        self.block_rate = rate
+        self.block_started_at = now
+
+    def play(self, source, position=0):
+        """
+        Starts playing the source in a loop from the given frame, replacing what was
+        playing. The first block starts right away.
+        """
+        with self.lock:
+            self.stream.set_source(source, position)
+            self.paused = False
+            index, block_position, block_rate = self.render_next()
+            self.device.play(index)
+            now = self.device.now()
+            self.block_started_at = None
+            self.start_block(block_position, block_rate, now)
+            self.frames_played = 0
+            self.play_position = position
+            self.play_started_at = now
+            self.paused_total = 0.0
+            self.latency_pending = True
+
+            index, self.queued_position, self.queued_rate = self.render_next()
+            self.device.queue(index)
+
+    def stop(self):
+        with self.lock:
+            self.stream.set_source(None)
+            self.paused = False
+            self.device.stop()
+            self.block_started_at = None
+            self.queued_position = None
+
+    def pause(self):
+        with self.lock:
+            if self.paused:
+                return
+            now = self.device.now()
+            self.paused_elapsed = self.block_elapsed(now)
+            self.paused = True
+            self.device.pause()
+            self.paused_since = now
+
+    def unpause(self):
+        with self.lock:
+            if not self.paused:
+                return
+            now = self.device.now()
+            self.paused = False
+            self.device.unpause()
+            if self.block_started_at is not None:
+                self.block_started_at = now - self.paused_elapsed / self.sample_rate
+            self.paused_total += now - self.paused_since
+
+    def feed(self):
+        """
+        Keeps the device queued with the next block. Called by the device, e.g. from
+        its feeder thread.
+        """
+        with self.lock:
+            if self.stream.source is None or self.paused:
+                return
+            now = self.device.now()
+            if not self.device.busy():
+                # The queue ran dry: restart right away
+                index, position, rate = self.render_next()
+                self.device.play(index)
+                self.start_block(position, rate, now)
+                self.queued_position = None
+            if self.device.queue_empty():
+                if self.queued_position is not None:
+                    # The queued block started playing
+                    self.start_block(self.queued_position, self.queued_rate, now)
+                    self.measure_latency(now)
+                index, self.queued_position, self.queued_rate = self.render_next()
+                self.device.queue(index)
+
+    def measure_latency(self, now):
+        """
+        Updates the latency estimate from the first block change after a play. The
+        first block should end one block duration after it was started; the extra
+        delay is the time the device took to start pulling it.
+        """
+        if not self.latency_pending:
+            return
+        self.latency_pending = False
+        measured = max(0.0, now - self.play_started_at
+                       - self.block_frames / self.sample_rate)
+        self.latency += LATENCY_SMOOTHING * (measured - self.latency)
+
+    def block_elapsed(self, now):
+        """
+        Returns the frames of the playing block played by now.
+        """
+        if self.block_started_at is None:
+            return 0
+        if self.paused:
+            return self.paused_elapsed
+        return min(self.block_frames,
+                   (now - self.block_started_at) * self.sample_rate)
+
+    def position_frames(self):
+        """
+        Returns the source frame that is heard now.
+        """
+        with self.lock:
+            source = self.stream.source
+            if source is None or source.shape[-1] == 0 or self.block_started_at is None:
+                return 0
+            elapsed = self.block_elapsed(self.device.now())
+            latency_frames = self.latency * self.sample_rate
+            if self.frames_played + elapsed < latency_frames:
+                # The first frames are not heard yet
+                return self.play_position
+            position = (self.block_position
+                        + (elapsed - latency_frames) * self.block_rate)
+            return int(position) % source.shape[-1]
+
+    def drift(self):
+        """
+        Returns the difference in seconds between the frames played according to the
+        clock and the wall time since the last play, not counting pauses.
+        """
+        with self.lock:
+            if self.play_started_at is None:
+                return 0.0, 0.0
+            now = self.device.now()
+            wall = now - self.play_started_at - self.paused_total
+            if self.paused:
+                wall -= now - self.paused_since
+            clock = (self.frames_played + self.block_elapsed(now)) / self.sample_rate
+            return clock - wall, wall
+
+
+def drift_diagnostic(seconds, loop_seconds, sample_rate=44100):
+    """
+    Plays a silent loop and prints the clock drift against wall time.
+    """
+    output = AudioOutput(PygameDevice())
+    output.open(sample_rate)
+    output.play(np.zeros((1, int(loop_seconds * sample_rate)), dtype=np.float32))
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        time.sleep(min(5.0, seconds))
+        drift, wall = output.drift()
+        print(f"{wall:7.1f} s: drift {drift * 1000:+.1f} ms, "
+              f"latency {output.latency * 1000:.1f} ms")
+    output.quit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the playback clock with wall time over a long loop.")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--loop", type=float, default=4)
+    args = parser.parse_args()
+    drift_diagnostic(args.seconds, args.loop)
@@ -0,0 +1,251 @@
+"""
+This module contains the playlist of a practice session.
+
+A Playlist holds the recordings worked through in a session. Every PlaylistEntry
+keeps its own loop, rate and live mode, and the beats and measures of a recording are
+kept in its session file, so switching back to a recording restores where it was left.
+
+The entries after the current one are prefetched in the background: decoded into the
+disk cache, with their envelope pyramid, beats, measures and onsets computed and
+cached, and the loop of an entry left at another rate stretched for the stretch cache.
+Their audio and pyramid are then held in memory, so switching to them only swaps
+arrays and redraws. The entries held in memory are kept under a memory budget: beyond
+it the least recently used ones are released back to the disk cache, from which they
+are memory-mapped again in a few ms.
+
+    python playlist.py --files 4 --seconds 180  # measure prefetching and switching
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+# Memory budget of the recordings a Playlist holds in memory
+PLAYLIST_BUDGET_BYTES = 1024 ** 3
+# Number of entries after the current one that are prefetched
+PREFETCH_AHEAD = 2
+
+
+class PlaylistEntry:
+    """
+    The PlaylistEntry class is a recording of a playlist.
+
+    Attributes:
+        file_path (str): The path to the audio file.
+        cache_key (str): The cache key of the file, once known.
+        loop_start (int): The loop start in ms, restored when switching back.
+        loop_end (int): The loop end in ms, or None.
+        rate (float): The playback rate.
+        live (bool): Whether the rate is played in the live mode.
+        prepared (bool): Whether the file is decoded into the cache and its envelope
+            and analysis are cached, so it loads without a job.
+        loaded (tuple): The audio array, sample rate, number of channels, cache key and
+            waveform pyramid held in memory, like the result of Core.open_audio_file,
+            or None.
+        last_used (float): The perf_counter time the entry was last current or loaded.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.cache_key = None
+        self.loop_start = 0
+        self.loop_end = None
+        self.rate = 1.0
+        self.live = False
+        self.prepared = False
+        self.loaded = None
+        self.last_used = 0.0
+
+    def hold(self, loaded):
+        self.loaded = loaded
+        self.cache_key = loaded[3]
+        self.last_used = time.perf_counter()
+
+    def release(self):
+        self.loaded = None
+
+    def nbytes(self):
+        if self.loaded is None:
+            return 0
+        audio_array, pyramid = self.loaded[0], self.loaded[4]
+        return audio_array.nbytes + pyramid.nbytes()
+
+
+class Playlist:
+    """
+    The Playlist class holds the entries of a session and decides which to prefetch
+    and which to release.
+
+    Attributes:
+        entries (list): The PlaylistEntry of every recording, in order.
+        index (int): The index of the current entry, or None.
+        max_bytes (int): The memory budget of the entries held in memory.
+        ahead (int): The number of entries after the current one to prefetch.
+    """
+
+    def __init__(self, max_bytes=PLAYLIST_BUDGET_BYTES, ahead=PREFETCH_AHEAD):
+        self.entries = []
+        self.index = None
+        self.max_bytes = max_bytes
+        self.ahead = ahead
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def current(self):
+        return None if self.index is None else self.entries[self.index]
+
+    def add(self, file_paths):
+        """
+        Appends the files that are not in the playlist yet.
+
+        Returns:
+            int: The index of the entry of the first file, or None if there are none.
+        """
+        paths = [entry.file_path for entry in self.entries]
+        first = None
+        for file_path in file_paths:
+            file_path = os.path.abspath(file_path)
+            if file_path not in paths:
+                paths.append(file_path)
+                self.entries.append(PlaylistEntry(file_path))
+            if first is None:
+                first = paths.index(file_path)
+        return first
+
+    def select(self, index):
+        """
+        Makes an entry the current one.
+
+        Returns:
+            PlaylistEntry: The entry.
+        """
+        self.index = index
+        entry = self.entries[index]
+        entry.last_used = time.perf_counter()
+        return entry
+
+    def next_to_prefetch(self):
+        """
+        Returns the first entry of the ones after the current one that is not
+        prepared, or None.
+        """
+        if self.index is None:
+            return None
+        for entry in self.entries[self.index + 1:self.index + 1 + self.ahead]:
+            if not entry.prepared:
+                return entry
+        return None
+
+    def nbytes(self):
+        return sum(entry.nbytes() for entry in self.entries)
+
+    def enforce_budget(self):
+        """
+        Releases the least recently used entries held in memory, other than the
+        current one, until they fit the memory budget.
+
+        Returns:
+            list: The released entries.
+        """
+        released = []
+        held = sorted((entry for entry in self.entries
+                       if entry.loaded is not None and entry is not self.current),
+                      key=lambda entry: entry.last_used)
+        total = self.nbytes()
+        for entry in held:
+            if total <= self.max_bytes:
+                break
+            total -= entry.nbytes()
+            entry.release()
+            released.append(entry)
+        return released
+
+
+def benchmark(num_files, seconds, max_bytes, sample_rate=44100):
+    """
+    Prefetches a playlist of synthetic recordings through Core and reports the time
+    of switching to an entry held in memory and to a released one, and the memory
+    held.
+    """
+    # pylint: disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use("Agg")
+    from bench import synthetic_audio, write_wav
+    from cache import AudioCache
+    from core import Core
+    from plot import Plot
+    from simulated import SimulatedDevice
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index in range(num_files):
+            path = os.path.join(directory, f"take{index}.wav")
+            write_wav(path, synthetic_audio(seconds, sample_rate, 2, seed=index),
+                      sample_rate)
+            paths.append(path)
+
+        core = Core(None, Plot(None), device=SimulatedDevice())
+        core.cache = AudioCache(os.path.join(directory, "cache"))
+        core.playlist = Playlist(max_bytes, ahead=num_files)
+        core.playlist.add(paths)
+
+        # Prefetch every entry on the calling thread, like the prefetch jobs do. With
+        # no current entry, nothing more is submitted.
+        started = time.perf_counter()
+        for entry in core.playlist.entries:
+            core.on_prefetched(core.run_prefetch(None, entry))
+        print(f"Prefetched {num_files} recordings of {seconds:g} s in "
+              f"{time.perf_counter() - started:.1f} s, holding "
+              f"{core.playlist.nbytes() / 1024 ** 2:.0f} MB of a "
+              f"{max_bytes / 1024 ** 2:.0f} MB budget")
+
+        # The drawing of the waveform is timed apart, as it depends on the view
+        drawing = []
+        display_waveform = core.plot.display_waveform
+
+        def timed_display_waveform(*args):
+            started = time.perf_counter()
+            display_waveform(*args)
+            drawing.append((time.perf_counter() - started) * 1000)
+        core.plot.display_waveform = timed_display_waveform
+
+        def switch(index):
+            started = time.perf_counter()
+            core.switch_to(index)
+            return (time.perf_counter() - started) * 1000
+
+        released = [entry for entry in core.playlist.entries if entry.loaded is None]
+        held = [index for index, entry in enumerate(core.playlist.entries)
+                if entry.loaded is not None]
+        switch(held[0])
+        if len(held) > 1:
+            # Every switch goes to another entry than the current one
+            drawing.clear()
+            times = [switch(index) for index in held[1:] + held[:1]]
+            print(f"Switch to a held entry: mean {sum(times) / len(times):.1f} ms, "
+                  f"max {max(times):.1f} ms over {len(times)} switches, of which "
+                  f"drawing the waveform {sum(drawing) / len(drawing):.1f} ms")
+        else:
+            print("Only one entry fits the budget, so there is no switch between held "
+                  "entries")
+        if released:
+            index = core.playlist.entries.index(released[0])
+            elapsed = switch(index)
+            print(f"Switch to a released entry: {elapsed:.1f} ms, of which drawing the "
+                  f"waveform {drawing[-1]:.1f} ms")
+
+        core.on_closing()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure prefetching and switching of a playlist.")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=180)
+    parser.add_argument("--budget", type=float, default=PLAYLIST_BUDGET_BYTES / 1024 ** 2,
+                        help="memory budget in MB")
+    args = parser.parse_args()
+    benchmark(args.files, args.seconds, int(args.budget * 1024 ** 2))
@@ -1,21 +1,40 @@
 import tkinter as tk
 import time
-import pygame
+from collections import deque
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.collections import LineCollection
+from matplotlib.patches import Polygon
 from matplotlib.widgets import SpanSelector
 import matplotlib.ticker as ticker
 
+import telemetry
+from notes import note_name
+from raster import RasterView
+from spectrogram import KINDS, SpectrogramTiles
+from waveform import envelope_outline
+
+# Lengths of the beat and measure tick marks above the waveform, in axes heights
+BEAT_TICK_LENGTH = 0.02
+MEASURE_TICK_LENGTH = 0.05
+
 
 class Plot:
-    def __init__(self, root):
+    def __init__(self, root, raster=False):
         self.root = root
 
        # Plot
         self.fig, self.ax = plt.subplots()
-        self.canvas = FigureCanvasTkAgg(self.fig, master=root)
-        self.canvas.get_tk_widget().pack(side=tk.BOTTOM, fill=tk.BOTH, expand=True)
+        if root is None:
+            # Offscreen figure without Tk, e.g. for the benchmarks
+            self.canvas = FigureCanvasAgg(self.fig)
+        else:
+            self.canvas = FigureCanvasTkAgg(self.fig, master=root)
+            if not raster:
+                self.canvas.get_tk_widget().pack(side=tk.BOTTOM, fill=tk.BOTH, expand=True)
+        self.canvas.draw = telemetry.timed("canvas.draw")(self.canvas.draw)
 
         # Connect the callback function to the 'button_press_event'
         cid = self.fig.canvas.mpl_connect('button_press_event', self.on_click)
@@ -24,22 +43,45 @@ class Plot:
         # self.toolbar = NavigationToolbar2Tk(self.canvas, root)
         # self.toolbar.update()
 
+        # Recapture the blit background whenever the figure is fully drawn. The span
+        # selector captures its own background in between, while on_draw hides the
+        # marker lines until show_markers, so it copies the canvas without them
+        # instead of drawing the whole figure again.
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+
         # Span selector for interactive selection
         self.span = SpanSelector(
             self.ax, self.on_select, 'horizontal', useblit=True)
+        self.fig.canvas.mpl_connect('draw_event', self.show_markers)
 
         # Reference to the core
         self.core = None
 
+        # The raster view shown instead of the figure, or None
+        self.raster_view = RasterView(self, root) if raster else None
+
         # Plot variables
 
-        self.plot_data = None
+        self.pyramid = None
+        # Envelope and view of the filtered audio, drawn instead of the original
+        self.filtered_pyramid = None
+        self.filtered_audio = None
+        self.plot_length = 0  # Length of the audio in plot units
         self.plot_line = None
+        # The envelope, filled instead of drawn by plot_line unless zoomed in to samples
+        self.envelope_patch = None
         self.playback_line = None
         self.loop_start_line = None
         self.loop_end_line = None
 
         self.beat_axis = None
+        # Tick marks of the visible beats and measures above the waveform
+        self.beat_lines = None
+        # Window and marker versions the tick marks were set for
+        self.beat_ticks_key = None
+        # Twin y-axis in MIDI pitch for the note overlay
+        self.note_axis = None
+        self.note_lines = None
 
         self.plot_downsample = 20
 
@@ -49,6 +91,25 @@ class Plot:
 
         self.current_plot_pos = 0
 
+        # Blitting state: the background is the figure without the marker lines,
+        # valid for the view window it was drawn for
+        self.background = None
+        self.background_view = None
+        self.view_start = 0
+        self.view_end = 0
+
+        self.frame_interval = 33  # Interval between playhead frames in ms (~30 fps)
+        self.frame_times = deque(maxlen=300)
+        self.full_redraws = 0
+
+        # Spectrogram or chromagram panel below the waveform, off by default
+        self.spectrum_kind = None
+        self.spectrum_ax = None
+        self.spectrum_image = None
+        self.spectrum_tiles = None
+        self.requested_tiles = []
+        self.tiles_shown = 0
+
     def increase_loop_line(self):
         self.plot_line_index = self.plot_line_index + 1
         if self.plot_line_index == self.plot_line_divisions:
@@ -65,8 +126,8 @@ class Plot:
 
     def increase_loop_window(self):
         self.plot_window = 2*self.plot_window
-        if self.plot_window > len(self.plot_data):
-            self.plot_window = len(self.plot_data)
+        if self.plot_window > self.plot_length:
+            self.plot_window = self.plot_length
         print(f"Plot window: {self.plot_window}")
         self.draw_plot()
 
@@ -75,41 +136,119 @@ class Plot:
         print(f"Plot window: {self.plot_window}")
         self.draw_plot()
 
+    def cycle_spectrum(self):
+        """
+        Switches the panel below the waveform between off, spectrogram and chromagram.
+        """
+        if self.raster_view is not None:
+            print("The spectrum panel is only drawn by the matplotlib view")
+            return
+        kinds = (None,) + KINDS
+        self.show_spectrum(kinds[(kinds.index(self.spectrum_kind) + 1) % len(kinds)])
+
+    def show_spectrum(self, kind):
+        """
+        Shows the given kind of panel below the waveform, or hides it if None.
+        """
+        self.spectrum_kind = kind
+        self.spectrum_tiles = None
+        self.requested_tiles = []
+        if self.core is not None:
+            self.core.jobs.cancel("spectrogram")
+        if self.spectrum_ax is not None:
+            self.spectrum_ax.remove()
+            self.spectrum_ax = None
+            self.spectrum_image = None
+
+        if kind is None:
+            self.ax.set_subplotspec(self.fig.add_gridspec(1, 1)[0])
+        else:
+            grid = self.fig.add_gridspec(3, 1, hspace=0.3)
+            self.ax.set_subplotspec(grid[:2])
+            self.spectrum_ax = self.fig.add_subplot(grid[2])
+            self.spectrum_image = self.spectrum_ax.imshow(
+                np.zeros((1, 1)), aspect='auto', origin='lower', interpolation='nearest')
+            self.spectrum_ax.set_ylabel(kind.capitalize())
+        print(f"Spectrum panel: {kind}")
+
+        if self.pyramid is not None:
+            self.update_xaxis_labels()
+            self.draw_plot()
+
     def display_waveform(self, core):
         self.core = core
-        self.plot_data = self.core.original_data[::self.plot_downsample]
+        # The tiles are of the previous audio
+        self.spectrum_tiles = None
+        self.requested_tiles = []
+        self.core.jobs.cancel("spectrogram")
+        self.pyramid = self.core.get_waveform_pyramid()
+        self.plot_length = -(-self.pyramid.num_frames // self.plot_downsample)
+        if self.plot_line is None:
+            self.create_artists()
+        else:
+            # The artists of the previous audio are reused, which is much cheaper than
+            # clearing the axes and creating the twin axes again
+            self.plot_line.set_data([], [])
+            self.envelope_patch.set_visible(False)
+            self.beat_ticks_key = None
+        self.update_ylim()
+        self.background = None
+        self.update_note_axis()
+
+        self.update_xaxis_labels()
+        self.draw_plot()
+        # self.update_plot()
+
+    def create_artists(self):
+        """
+        Creates the waveform line, the marker lines and the twin axes of the beats and
+        the notes.
+        """
         self.ax.clear()
-        self.plot_line, = self.ax.plot(self.plot_data)
-        # self.plot_window = len(self.plot_data)
-        # Vertical line for playback position
-        self.playback_line = self.ax.axvline(x=0, color='r')
+        # The line only holds the envelope points of the visible window
+        self.plot_line, = self.ax.plot([], [])
+        self.envelope_patch = self.ax.add_patch(Polygon(
+            [[0, 0]], color=self.plot_line.get_color(), linewidth=1, visible=False))
+        # self.plot_window = self.plot_length
+        # Vertical line for playback position. The marker lines are animated: they
+        # are left out of full redraws and blitted over the cached background
+        self.playback_line = self.ax.axvline(x=0, color='r', animated=True)
 
         self.loop_start_line = self.ax.axvline(
-            x=0, color='r', linestyle='--', linewidth=0.5)  # Red dashed line for loop start
+            x=0, color='r', linestyle='--', linewidth=0.5, animated=True)  # Red dashed line for loop start
         self.loop_end_line = self.ax.axvline(
-            x=0, color='g', linestyle='--', linewidth=0.5)
+            x=0, color='g', linestyle='--', linewidth=0.5, animated=True)
 
         # Create a twin x-axis for the beats
         self.beat_axis = self.ax.twiny()
         self.beat_axis.xaxis.tick_top()
         self.beat_axis.xaxis.set_label_position('top')
-
-        # Convert beats from milliseconds to samples
-        beat_samples = [
-            (beat / 1000) * self.core.sample_rate for beat in self.core.beats]
-
-        # Adjust for downsampling
-        beat_samples_downsampled = [
-            beat / self.plot_downsample for beat in beat_samples]
-
-        # Set the initial tick locations to the beats
-        self.beat_axis.set_xticks(beat_samples_downsampled)
-        self.beat_axis.set_xticklabels(
-            [''] * len(beat_samples_downsampled))  # No labels, just ticks
-
-        self.update_xaxis_labels()
-        self.canvas.draw()
-        # self.update_plot()
+        # The markers are drawn as one collection of tick marks rather than as axis
+        # ticks, which cost an artist each. Their y is in axes units.
+        self.beat_axis.set_xticks([])
+        self.beat_lines = LineCollection([], colors='k', linewidths=0.8, clip_on=False,
+                                         transform=self.beat_axis.get_xaxis_transform())
+        self.beat_axis.add_collection(self.beat_lines)
+        self.beat_ticks_key = None
+
+        # Create a twin y-axis for the notes, drawn as horizontal bars at their pitch
+        self.note_axis = self.ax.twinx()
+        self.note_lines = LineCollection([], colors='tab:orange', linewidths=3)
+        self.note_axis.add_collection(self.note_lines)
+
+    def update_waveform(self, start_frame, end_frame):
+        """
+        Updates the envelope after the given frames of the audio changed.
+        """
+        self.pyramid.update(self.core.original_data, start_frame, end_frame)
+        self.update_ylim()
+
+    def update_ylim(self):
+        # The top level of the pyramid holds the overall minimum and maximum
+        low = float(self.pyramid.mins[-1][0])
+        high = float(self.pyramid.maxs[-1][0])
+        if low < high:
+            self.ax.set_ylim(1.1 * low, 1.1 * high)
 
     def on_select(self, xmin, xmax):
         print(f"Selected region from {xmin} to {xmax}")
@@ -124,8 +263,9 @@ class Plot:
 
     # Define a callback function to handle click events
     def on_click(self, event):
-        # Check if the click was in the primary axes
-        if event.inaxes != self.ax and event.inaxes != self.beat_axis:
+        # Check if the click was in the primary axes or the spectrum panel
+        if event.inaxes is None or event.inaxes not in (
+                self.ax, self.beat_axis, self.note_axis, self.spectrum_ax):
             return
 
         # # If the click was in the secondary axis, convert the x-coordinate to the scale of the primary axis
@@ -141,7 +281,13 @@ class Plot:
         # print(f"Clicked at x={xdata}")
         # self.core.on_click(xdata)
 
-        x = event.xdata * self.plot_downsample
+        self.seek(event.xdata)
+
+    def seek(self, plot_x):
+        """
+        Starts the playback at a position in plot units.
+        """
+        x = plot_x * self.plot_downsample
         start_at = int((x / self.core.sample_rate) * 1000)
 
         self.core.on_plot_click(start_at)
@@ -153,38 +299,245 @@ class Plot:
         # self.plot.draw_plot()
 
     def update_plot(self):
-        if self.plot_data is not None:
-            # get the current time
-            current_time = self.core.get_current_time()
-            # the current time should not exceed the loop end. It should loop back to the loop start
-            if self.core.loop_end is not None and current_time >= self.core.loop_end:
-                current_time = self.core.loop_start + \
-                    (current_time - self.core.loop_end)
-                self.core.start_play_time = pygame.time.get_ticks()
-
-            # convert the time to sample index
+        telemetry.recorder.tick("update_plot", self.frame_interval / 1000)
+        if self.pyramid is not None:
+            # get the current position. It wraps at the loop end with the audio
             self.current_plot_pos = int(
-                current_time / 1000 * self.core.sample_rate / self.plot_downsample)
+                self.core.get_position() / self.plot_downsample)
 
             # self.current_plot_pos = self.current_plot_pos + self.loop_start
-            self.draw_plot()
+            frame_start = time.perf_counter()
+            if self.view_is_current():
+                self.blit_markers()
+            else:
+                # The playhead left the visible window: scroll it
+                self.draw_plot()
+                self.full_redraws += 1
+            self.frame_times.append(time.perf_counter() - frame_start)
 
             if self.core.playing:
-                self.root.after(100, self.update_plot)
+                self.root.after(self.frame_interval, self.update_plot)
+            else:
+                self.report_frame_times()
+
+    def view_is_current(self):
+        """
+        Returns whether the cached background still shows the playhead position.
+        """
+        if self.raster_view is not None:
+            current = self.raster_view.view == self.get_view_key()
+        else:
+            current = (self.background is not None
+                       and self.background_view == self.get_view_key())
+        return current and self.view_start <= self.current_plot_pos < self.view_end
+
+    def get_view_key(self):
+        size = (self.raster_view.size() if self.raster_view is not None
+                else self.canvas.get_width_height())
+        return (self.view_start, self.view_end, self.core.beats.version,
+                self.core.measures.version, size)
+
+    def report_frame_times(self):
+        if self.frame_times:
+            frame_ms = [frame_time * 1000 for frame_time in self.frame_times]
+            print(f"Frame time: mean {sum(frame_ms) / len(frame_ms):.1f} ms, "
+                  f"max {max(frame_ms):.1f} ms over {len(frame_ms)} frames, "
+                  f"{self.full_redraws} full redraws")
+            self.frame_times.clear()
+            self.full_redraws = 0
+
+    def on_draw(self, _):
+        """
+        Caches the background of a full redraw and hides the marker lines from the
+        span selector, which captures its background next.
+        """
+        if self.playback_line is None:
+            return
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.background_view = self.get_view_key()
+        for line in (self.loop_start_line, self.loop_end_line, self.playback_line):
+            line.set_visible(False)
+
+    def show_markers(self, _):
+        """
+        Shows the marker lines again after a full redraw and draws them over it.
+        """
+        if self.playback_line is None:
+            return
+        for line in (self.loop_start_line, self.loop_end_line, self.playback_line):
+            line.set_visible(True)
+        self.draw_markers()
+
+    def draw_markers(self):
+        self.update_marker_lines()
+        for line in (self.loop_start_line, self.loop_end_line, self.playback_line):
+            self.ax.draw_artist(line)
+
+    def blit_markers(self):
+        """
+        Redraws only the marker lines over the cached background.
+        """
+        if self.raster_view is not None:
+            self.raster_view.move_markers()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_markers()
+        self.canvas.blit(self.fig.bbox)
 
+    @telemetry.timed("draw_plot")
     def draw_plot(self):
         start = max(0, self.current_plot_pos - int(self.plot_line_index *
                     self.plot_window / self.plot_line_divisions))
-        end = min(len(self.plot_data), self.current_plot_pos + int((self.plot_line_divisions -
+        end = min(self.plot_length, self.current_plot_pos + int((self.plot_line_divisions -
                   self.plot_line_index)*self.plot_window/self.plot_line_divisions))
 
         # start *= self.plot_downsample
         # end *= self.plot_downsample
 
-        self.plot_line.set_data(np.arange(start, end),
-                                self.plot_data[start:end])
+        self.view_start = start
+        self.view_end = end
+        if self.raster_view is not None:
+            # The raster view draws the markers itself, without the figure
+            self.raster_view.draw(start, end)
+            return
+
+        # Draw the envelope level with about one bucket per pixel of the axes
+        num_pixels = self.ax.get_window_extent().width
+        pyramid, audio = self.waveform_source()
+        x, y = pyramid.envelope(audio, start * self.plot_downsample,
+                                end * self.plot_downsample, num_pixels)
+        outline = envelope_outline(x / self.plot_downsample, y)
+        if outline is None:
+            self.plot_line.set_data(x / self.plot_downsample, y)
+        else:
+            self.plot_line.set_data([], [])
+            self.envelope_patch.set_xy(outline)
+        self.envelope_patch.set_visible(outline is not None)
         self.ax.set_xlim(start, end)
 
+        self.update_beat_axis()
+        self.update_note_lines(start, end)
+        if self.spectrum_ax is not None:
+            self.draw_spectrum(start, end, num_pixels)
+
+        # The marker lines are drawn by on_draw
+        self.canvas.draw()
+
+    def waveform_source(self):
+        """
+        Returns the envelope pyramid and the audio the waveform is drawn from, those
+        of the filtered audio if it is shown.
+        """
+        if self.filtered_pyramid is not None:
+            return self.filtered_pyramid, self.filtered_audio
+        return self.pyramid, self.core.original_data
+
+    def show_filtered_waveform(self, pyramid, audio):
+        """
+        Draws the waveform of filtered audio from its envelope pyramid and its
+        FilteredAudio view, or of the original audio if they are None. The y range
+        stays that of the original, so the level left by the filter shows.
+        """
+        if pyramid is None and self.filtered_pyramid is None:
+            return
+        self.filtered_pyramid = pyramid
+        self.filtered_audio = audio
+        if self.pyramid is not None:
+            self.draw_plot()
+
+    def update_note_axis(self):
+        """
+        Fits the pitch range of the note axis to the detected notes.
+        """
+        notes = self.core.notes
+        if self.note_axis is None:
+            return
+        if len(notes) == 0:
+            self.note_axis.set_yticks([])
+            return
+        low = int(notes[:, 2].min()) - 1
+        high = int(notes[:, 2].max()) + 1
+        self.note_axis.set_ylim(low, high)
+        # Label the C of every octave, or every note over a small range
+        step = 1 if high - low <= 12 else 12
+        pitches = [pitch for pitch in range(low, high + 1) if step == 1 or pitch % 12 == 0]
+        self.note_axis.set_yticks(pitches)
+        self.note_axis.set_yticklabels([note_name(pitch) for pitch in pitches])
+
+    def update_note_lines(self, start, end):
+        """
+        Draws the notes between start and end in plot units.
+        """
+        notes = self.core.notes
+        if self.note_lines is None:
+            return
+        if len(notes) == 0:
+            self.note_lines.set_segments([])
+            return
+        # The notes are sorted and do not overlap, so only the visible ones are drawn
+        to_plot = self.core.sample_rate / 1000 / self.plot_downsample
+        first = np.searchsorted(notes[:, 1], start / to_plot)
+        last = np.searchsorted(notes[:, 0], end / to_plot)
+        visible = notes[first:last]
+        segments = np.empty((len(visible), 2, 2))
+        segments[:, 0, 0] = visible[:, 0] * to_plot
+        segments[:, 1, 0] = visible[:, 1] * to_plot
+        segments[:, :, 1] = visible[:, 2:3]
+        self.note_lines.set_segments(segments)
+
+    def draw_spectrum(self, start, end, num_pixels):
+        """
+        Shows the spectrum tiles of the window from start to end, and requests the
+        missing ones from the background.
+        """
+        # Tiles are computed once the audio is completely decoded
+        if self.spectrum_tiles is None and not self.core.decoding:
+            self.spectrum_tiles = SpectrogramTiles(
+                self.core.original_data, self.core.sample_rate, self.spectrum_kind,
+                self.core.cache, self.core.cache_key)
+        self.spectrum_ax.set_xlim(start, end)
+        if self.spectrum_tiles is None:
+            return
+
+        start_frame = start * self.plot_downsample
+        end_frame = end * self.plot_downsample
+        image, image_start, image_end = self.spectrum_tiles.image(
+            start_frame, end_frame, num_pixels)
+        self.spectrum_image.set_data(image)
+        self.spectrum_image.set_extent((image_start / self.plot_downsample,
+                                        image_end / self.plot_downsample,
+                                        0, self.spectrum_tiles.num_bins))
+        self.spectrum_image.set_clim(*self.spectrum_tiles.color_limits(image))
+        self.request_tiles(start_frame, end_frame, num_pixels)
+
+    def request_tiles(self, start_frame, end_frame, num_pixels):
+        missing = self.spectrum_tiles.missing(start_frame, end_frame, num_pixels)
+        if not missing:
+            return
+        # A running job already computes them
+        if (self.core.jobs.is_running("spectrogram")
+                and set(missing) <= set(self.requested_tiles)):
+            return
+        self.requested_tiles = missing
+        self.tiles_shown = 0
+        self.core.jobs.submit("spectrogram", self.spectrum_tiles.run, missing,
+                              on_progress=self.show_tiles, on_done=self.on_tiles_done)
+
+    def show_tiles(self, job):
+        """
+        Redraws when the background job finished new tiles. Runs on the Tk thread.
+        """
+        tiles_done = getattr(job, "tiles_done", 0)
+        if tiles_done > self.tiles_shown:
+            self.tiles_shown = tiles_done
+            self.draw_plot()
+
+    def on_tiles_done(self, tiles_done):
+        self.requested_tiles = []
+        if tiles_done > self.tiles_shown:
+            self.draw_plot()
+
+    def update_marker_lines(self):
         # Update playback position line
         self.playback_line.set_xdata([self.current_plot_pos])
 
@@ -201,32 +554,47 @@ class Plot:
         else:
             self.loop_end_line.set_xdata([0])
 
-        self.update_beat_axis()
-
-        self.canvas.draw()
-
     def update_xaxis_labels(self):
         # Format the x-axis ticks to show minutes and seconds
         formatter = ticker.FuncFormatter(lambda x, pos: time.strftime(
             '%M:%S', time.gmtime(x / self.core.sample_rate * self.plot_downsample)))
         self.ax.xaxis.set_major_formatter(formatter)
 
-        # Set the x-axis label to 'Time (min:sec)'
-        self.ax.set_xlabel('Time (min:sec)')
+        # Set the x-axis label to 'Time (min:sec)', below the spectrum panel if shown
+        if self.spectrum_ax is not None:
+            self.spectrum_ax.xaxis.set_major_formatter(formatter)
+            self.spectrum_ax.set_xlabel('Time (min:sec)')
+            self.ax.set_xlabel('')
+        else:
+            self.ax.set_xlabel('Time (min:sec)')
 
         self.update_beat_axis()
 
     def update_beat_axis(self):
-        # print("Updating beat axis")
-        # Update the beat axis
-        if hasattr(self, 'beat_axis'):
-            # print(self.beat_axis.get_xticks())
-            # Convert beats from milliseconds to samples and adjust for downsampling
-            beat_samples_downsampled = [
-                (beat / 1000) * self.core.sample_rate / self.plot_downsample for beat in self.core.beats]
-            self.beat_axis.set_xticks(beat_samples_downsampled)
-            self.beat_axis.set_xticklabels(
-                [''] * len(beat_samples_downsampled))
-
-            # Update the x-axis range of the beat axis to match the main x-axis
-            self.beat_axis.set_xlim(self.ax.get_xlim())
+        """
+        Draws tick marks at the beats and the measures of the visible window, the
+        measures longer. They are only replaced when the window or the markers changed.
+        """
+        if self.beat_axis is None:
+            return
+        start, end = self.ax.get_xlim()
+        key = (start, end, self.core.beats.version, self.core.measures.version)
+        if key == self.beat_ticks_key:
+            return
+        self.beat_ticks_key = key
+
+        # Convert the window to ms, find its markers and convert them to plot units
+        to_plot = self.core.sample_rate / 1000 / self.plot_downsample
+        segments = []
+        for markers, length in ((self.core.beats, BEAT_TICK_LENGTH),
+                                (self.core.measures, MEASURE_TICK_LENGTH)):
+            visible = markers.between(start / to_plot, end / to_plot)
+            ticks = np.empty((len(visible), 2, 2))
+            ticks[:, :, 0] = visible[:, np.newaxis] * to_plot
+            ticks[:, 0, 1] = 1.0
+            ticks[:, 1, 1] = 1.0 + length
+            segments.append(ticks)
+        self.beat_lines.set_segments(np.concatenate(segments))
+
+        # Update the x-axis range of the beat axis to match the main x-axis
+        self.beat_axis.set_xlim(start, end)
@@ -0,0 +1,398 @@
+"""
+This module contains the rasterized waveform view.
+
+The matplotlib view of plot.py draws the envelope as a Line2D, which goes through the
+artist and transform machinery of matplotlib and a redraw of the whole figure. The
+raster view instead fills the visible window directly into an RGBA NumPy image: the
+envelope points are reduced to the lowest and the highest value of every pixel
+column, and all columns are filled from their top to their bottom row in one
+vectorized comparison. The beat and measure ticks are set into the same image, which
+is handed to a Tk PhotoImage on a Tk canvas as the bytes of a binary PPM image.
+The playhead, the loop lines and the selection are canvas items moved over the image,
+so a playhead frame leaves it alone.
+
+Dragging over the view selects a region through Plot.on_select and clicking seeks
+through Plot.seek, like in the matplotlib view. The spectrum panel and the notes are
+only drawn by the matplotlib view.
+
+    python raster.py --seconds 60  # compare the frame time with matplotlib
+"""
+
+import argparse
+import sys
+import time
+import tkinter as tk
+
+import numpy as np
+
+import telemetry
+
+# Colors as RGBA: the waveform in the default matplotlib blue on white
+BACKGROUND_COLOR = (255, 255, 255, 255)
+WAVEFORM_COLOR = (31, 119, 180, 255)
+TICK_COLOR = (0, 0, 0, 255)
+# Height of the strip above the waveform holding the beat and measure ticks, and the
+# lengths of the ticks in pixels
+TICK_STRIP = 12
+BEAT_TICK_PIXELS = 5
+MEASURE_TICK_PIXELS = 12
+# Height of the strip below the waveform holding the time labels
+LABEL_STRIP = 16
+# Smallest distance between two time labels in pixels, and the label steps in seconds
+LABEL_SPACING = 80
+LABEL_STEPS = (1, 2, 5, 10, 15, 30, 60, 120, 300, 600)
+# A drag shorter than this many pixels is a click
+MIN_SPAN_PIXELS = 3
+# Window sizes in pixels compared by the benchmark
+BENCHMARK_SIZES = ((640, 240), (1280, 480), (1920, 720))
+
+
+def column_ranges(x, y, start_frame, end_frame, width):
+    """
+    Returns the lowest and the highest value of the points in every pixel column of a
+    window. Columns without points, when zoomed in past one sample per pixel, are
+    interpolated, and every column reaches to its left neighbour so the trace is
+    connected.
+
+    Args:
+        x (np.array): The sorted frame positions of the points.
+        y (np.array): The values of the points.
+        start_frame (int): The first frame of the window.
+        end_frame (int): The frame after the window.
+        width (int): The number of pixel columns.
+
+    Returns:
+        tuple: The lowest and the highest values, or None if there are no points.
+    """
+    if len(x) == 0:
+        return None
+    columns = ((x - start_frame) * (width / max(1, end_frame - start_frame))).astype(np.intp)
+    np.clip(columns, 0, width - 1, out=columns)
+    # The points are sorted, so every column is one run of them
+    starts = np.flatnonzero(np.diff(columns, prepend=-1))
+    occupied = columns[starts]
+    lows = np.empty(width, dtype=np.float32)
+    highs = np.empty(width, dtype=np.float32)
+    lows[occupied] = np.minimum.reduceat(y, starts)
+    highs[occupied] = np.maximum.reduceat(y, starts)
+
+    if len(occupied) < width:
+        empty = np.ones(width, dtype=bool)
+        empty[occupied] = False
+        centers = (lows[occupied] + highs[occupied]) / 2
+        lows[empty] = highs[empty] = np.interp(np.flatnonzero(empty), occupied, centers)
+
+    previous_lows = lows[:-1].copy()
+    np.minimum(lows[1:], highs[:-1], out=lows[1:])
+    np.maximum(highs[1:], previous_lows, out=highs[1:])
+    return lows, highs
+
+
+def pixel(color):
+    """
+    Returns an RGBA color as the uint32 value of one pixel of an image.
+    """
+    return np.array(color, dtype=np.uint8).view(np.uint32)[0]
+
+
+def fill_columns(pixels, lows, highs, ylim, color):
+    """
+    Fills every pixel column of the image from the row of its highest value to the
+    row of its lowest value.
+
+    Args:
+        pixels (np.array): The (height, width) uint32 pixels of an RGBA image.
+        lows (np.array): The lowest value of every column.
+        highs (np.array): The highest value of every column.
+        ylim (tuple): The values at the bottom and at the top of the image.
+        color (tuple): The RGBA color.
+    """
+    bottom, top = ylim
+    scale = (pixels.shape[0] - 1) / (top - bottom)
+    top_rows = np.rint((top - highs) * scale).astype(np.int32)
+    bottom_rows = np.rint((top - lows) * scale).astype(np.int32)
+    rows = np.arange(pixels.shape[0], dtype=np.int32)[:, np.newaxis]
+    # Unsigned, a row above the top wraps around to a large value
+    inside = (rows - top_rows).view(np.uint32) <= (bottom_rows - top_rows).view(np.uint32)
+    np.copyto(pixels, pixel(color), where=inside)
+
+
+def to_columns(frames, start_frame, end_frame, width):
+    """
+    Returns the pixel columns of frame positions in a window.
+    """
+    columns = ((np.asarray(frames) - start_frame) * (width / max(1, end_frame - start_frame)))
+    return np.clip(columns.astype(np.intp), 0, width - 1)
+
+
+def to_ppm(image):
+    """
+    Returns an RGBA image as the bytes of a binary PPM image, which Tk reads without
+    decoding. The alpha channel is dropped by packing every four pixels into three
+    words of RGB bytes, several times faster than copying the strided RGB bytes.
+    """
+    height, width = image.shape[:2]
+    header = b"%d %d 255\n" % (width, height)
+    # Padded, so the pixels start at a word boundary
+    header = b"P6" + b" " * (-(len(header) + 3) % 4 + 1) + header
+    pixels = image.reshape(-1, 4)
+    if sys.byteorder != "little":
+        return header + pixels[:, :3].tobytes()
+    ppm = np.empty(len(header) + len(pixels) * 3, dtype=np.uint8)
+    ppm[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+    whole = len(pixels) // 4 * 4
+    # The red byte of a pixel is the lowest byte of its word
+    quads = pixels[:whole].view(np.uint32).reshape(-1, 4)
+    words = ppm[len(header):len(header) + whole * 3].view(np.uint32).reshape(-1, 3)
+    np.bitwise_or(quads[:, 0] & 0xFFFFFF, quads[:, 1] << 24, out=words[:, 0])
+    np.bitwise_or((quads[:, 1] >> 8) & 0xFFFF, quads[:, 2] << 16, out=words[:, 1])
+    np.bitwise_or((quads[:, 2] >> 16) & 0xFF, quads[:, 3] << 8, out=words[:, 2])
+    ppm[len(header) + whole * 3:] = pixels[whole:, :3].reshape(-1)
+    return ppm.tobytes()
+
+
+class WaveformRaster:
+    """
+    The WaveformRaster class renders the waveform of a window into an RGBA image. It
+    does not need Tk.
+
+    Attributes:
+        image (np.array): The (height, width, 4) RGBA image of the last render, reused
+            by the next render of the same size.
+    """
+
+    def __init__(self):
+        self.image = np.zeros((0, 0, 4), dtype=np.uint8)
+
+    def render(self, pyramid, audio, start_frame, end_frame, ylim, size,
+               beat_frames=(), measure_frames=()):
+        """
+        Renders the waveform of a window with the ticks of its beats and measures
+        above it and room for the time labels below it.
+
+        Args:
+            pyramid (WaveformPyramid): The envelope pyramid of the audio.
+            audio (np.array): The (channels, frames) audio, for windows drawn sample
+                by sample.
+            start_frame (int): The first frame of the window.
+            end_frame (int): The frame after the window.
+            ylim (tuple): The values at the bottom and at the top of the waveform.
+            size (tuple): The width and the height of the image in pixels.
+            beat_frames (np.array): The frame positions of the visible beats.
+            measure_frames (np.array): The frame positions of the visible measures.
+
+        Returns:
+            np.array: The RGBA image.
+        """
+        width, height = size
+        if self.image.shape[:2] != (height, width):
+            self.image = np.empty((height, width, 4), dtype=np.uint8)
+        # Every pixel is written as one uint32
+        pixels = self.image.view(np.uint32)[..., 0]
+        pixels[:] = pixel(BACKGROUND_COLOR)
+
+        waveform = pixels[TICK_STRIP:max(TICK_STRIP + 1, height - LABEL_STRIP)]
+        x, y = pyramid.envelope(audio, start_frame, end_frame, width)
+        ranges = column_ranges(x, y, start_frame, end_frame, width)
+        if ranges is not None and ylim[0] < ylim[1]:
+            fill_columns(waveform, *ranges, ylim, WAVEFORM_COLOR)
+
+        for frames, length in ((beat_frames, BEAT_TICK_PIXELS),
+                               (measure_frames, MEASURE_TICK_PIXELS)):
+            if len(frames):
+                columns = to_columns(frames, start_frame, end_frame, width)
+                pixels[TICK_STRIP - length:TICK_STRIP, columns] = pixel(TICK_COLOR)
+        return self.image
+
+
+class RasterView:
+    """
+    The RasterView class shows the raster of the waveform on a Tk canvas in place of
+    the matplotlib figure of a Plot.
+
+    Attributes:
+        plot (Plot): The plot whose window and markers are shown.
+        view (tuple): The view key of the plot the image was drawn for.
+        start (int): The first plot unit of the drawn window.
+        end (int): The plot unit after the drawn window.
+    """
+
+    def __init__(self, plot, master):
+        self.plot = plot
+        self.canvas = tk.Canvas(master, background="white", highlightthickness=0)
+        self.canvas.pack(side=tk.BOTTOM, fill=tk.BOTH, expand=True)
+        self.photo = tk.PhotoImage(master=master, width=1, height=1)
+        self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
+        # The selection, the loop lines and the playhead are drawn in this order
+        self.selection = self.canvas.create_rectangle(
+            0, 0, 0, 0, fill="red", stipple="gray25", outline="", state=tk.HIDDEN)
+        self.loop_start_line = self.canvas.create_line(0, 0, 0, 0, fill="red", dash=(4, 2))
+        self.loop_end_line = self.canvas.create_line(0, 0, 0, 0, fill="green", dash=(4, 2))
+        self.playback_line = self.canvas.create_line(0, 0, 0, 0, fill="red", width=2)
+        self.raster = WaveformRaster()
+        self.view = None
+        self.start = 0
+        self.end = 1
+        self.drag_start = None
+
+        self.canvas.bind("<ButtonPress-1>", self.on_press)
+        self.canvas.bind("<B1-Motion>", self.on_motion)
+        self.canvas.bind("<ButtonRelease-1>", self.on_release)
+        self.canvas.bind("<Configure>", self.on_resize)
+
+    def size(self):
+        return max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height())
+
+    def to_plot_x(self, pixel):
+        width = self.size()[0]
+        return self.start + pixel / width * (self.end - self.start)
+
+    def to_pixel(self, plot_x):
+        width = self.size()[0]
+        return (plot_x - self.start) / max(1, self.end - self.start) * width
+
+    @telemetry.timed("raster draw")
+    def draw(self, start, end):
+        """
+        Renders the window from start to end in plot units and shows it.
+        """
+        plot, core = self.plot, self.plot.core
+        self.start, self.end = start, end
+        size = self.size()
+        downsample = plot.plot_downsample
+        start_frame, end_frame = start * downsample, end * downsample
+        to_ms = 1000 / core.sample_rate
+        to_frames = core.sample_rate / 1000
+        beats = core.beats.between(start_frame * to_ms, end_frame * to_ms) * to_frames
+        measures = core.measures.between(start_frame * to_ms, end_frame * to_ms) * to_frames
+
+        pyramid, audio = plot.waveform_source()
+        image = self.raster.render(pyramid, audio, start_frame, end_frame,
+                                   plot.ax.get_ylim(), size, beats, measures)
+        self.photo.configure(width=size[0], height=size[1], data=to_ppm(image),
+                             format="PPM")
+        self.draw_time_labels()
+        self.view = plot.get_view_key()
+        self.move_markers()
+
+    def draw_time_labels(self):
+        """
+        Labels the window with min:sec times at a step that keeps them apart.
+        """
+        self.canvas.delete("time")
+        width, height = self.size()
+        seconds_per_plot = self.plot.plot_downsample / self.plot.core.sample_rate
+        start_seconds = self.start * seconds_per_plot
+        end_seconds = self.end * seconds_per_plot
+        pixels_per_second = width / max(1e-9, end_seconds - start_seconds)
+        step = next((step for step in LABEL_STEPS
+                     if step * pixels_per_second >= LABEL_SPACING), LABEL_STEPS[-1])
+        for seconds in range(-(-int(start_seconds) // step) * step, int(end_seconds) + 1, step):
+            self.canvas.create_text(
+                self.to_pixel(seconds / seconds_per_plot), height - LABEL_STRIP // 2,
+                text=time.strftime('%M:%S', time.gmtime(seconds)), tags="time")
+
+    def move_markers(self):
+        """
+        Moves the playhead and the loop lines to their positions in the window.
+        """
+        core, plot = self.plot.core, self.plot
+        height = self.size()[1]
+        to_plot = core.sample_rate / 1000 / plot.plot_downsample
+        for line, position in (
+                (self.playback_line, plot.current_plot_pos),
+                (self.loop_start_line, None if core.loop_start is None
+                 else core.loop_start * to_plot),
+                (self.loop_end_line, None if core.loop_end is None
+                 else core.loop_end * to_plot)):
+            x = -1 if position is None else self.to_pixel(position)
+            self.canvas.coords(line, x, 0, x, height)
+
+    def on_press(self, event):
+        if self.plot.pyramid is None:
+            return
+        self.drag_start = event.x
+        self.canvas.itemconfigure(self.selection, state=tk.HIDDEN)
+        self.plot.seek(self.to_plot_x(event.x))
+        self.move_markers()
+
+    def on_motion(self, event):
+        if self.drag_start is None or abs(event.x - self.drag_start) < MIN_SPAN_PIXELS:
+            return
+        self.canvas.coords(self.selection, self.drag_start, TICK_STRIP, event.x,
+                           self.size()[1] - LABEL_STRIP)
+        self.canvas.itemconfigure(self.selection, state=tk.NORMAL)
+
+    def on_release(self, event):
+        if self.drag_start is None:
+            return
+        drag_start, self.drag_start = self.drag_start, None
+        if abs(event.x - drag_start) < MIN_SPAN_PIXELS:
+            return
+        xmin, xmax = sorted((self.to_plot_x(drag_start), self.to_plot_x(event.x)))
+        self.plot.on_select(xmin, xmax)
+        self.move_markers()
+
+    def on_resize(self, _):
+        if self.plot.pyramid is not None:
+            self.plot.draw_plot()
+
+
+def benchmark(seconds, sizes=BENCHMARK_SIZES, repeat=20, sample_rate=44100):
+    """
+    Compares the frame time of the raster with the matplotlib draw_plot under the Agg
+    backend at several window sizes, both scrolling through the audio. Neither
+    includes the copy to Tk, which needs a display.
+    """
+    # pylint: disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use("Agg")
+    from bench import synthetic_audio
+    from core import Core
+    from plot import Plot
+
+    audio = synthetic_audio(seconds, sample_rate, 2)
+    plot = Plot(None)
+    core = Core(None, plot)
+    core.original_data = audio
+    core.playing_data = audio
+    core.sample_rate = sample_rate
+    core.num_channels = 2
+    core.beats.set(np.arange(0, seconds * 1000, 500.0))
+    core.measures.set(np.arange(0, seconds * 1000, 2000.0))
+    plot.display_waveform(core)
+    raster = WaveformRaster()
+    window = int(plot.plot_window) * plot.plot_downsample
+    step = window // 8
+
+    for width, height in sizes:
+        plot.fig.set_size_inches(width / plot.fig.dpi, height / plot.fig.dpi)
+        matplotlib_times = []
+        raster_times = []
+        for index in range(repeat):
+            plot.current_plot_pos = (index * step // plot.plot_downsample) % plot.plot_length
+            started = time.perf_counter()
+            plot.draw_plot()
+            matplotlib_times.append(time.perf_counter() - started)
+
+            start_frame = (index * step) % max(1, audio.shape[-1] - window)
+            started = time.perf_counter()
+            beats = core.beats.between(start_frame / sample_rate * 1000,
+                                       (start_frame + window) / sample_rate * 1000)
+            raster.render(plot.pyramid, audio, start_frame, start_frame + window,
+                          plot.ax.get_ylim(), (width, height), beats * sample_rate / 1000)
+            raster_times.append(time.perf_counter() - started)
+        matplotlib_ms = np.median(matplotlib_times) * 1000
+        raster_ms = np.median(raster_times) * 1000
+        print(f"{width}x{height}: matplotlib {matplotlib_ms:.1f} ms, raster "
+              f"{raster_ms:.1f} ms per frame ({matplotlib_ms / raster_ms:.0f}x)")
+    core.on_closing()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the frame time of the raster and the matplotlib waveform.")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    benchmark(args.seconds, repeat=args.repeat)
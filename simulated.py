@@ -0,0 +1,311 @@
+"""
+This module contains the simulated output device, for headless playback.
+
+The SimulatedDevice implements the device interface of playback.py on a virtual
+clock instead of a sound card. Advancing the clock plays the blocks the output
+queued, at the sample rate and block size it was opened with, and calls the feed
+function of the output as often as the feeder thread of the PygameDevice would. Like a
+sound card, it pulls the first block a start delay after a play, and every block is
+heard an output latency after it was pulled. Every block is recorded as it was heard,
+with the time it started, so what was heard at any moment is known exactly. Play, loop wraps,
+pause_mp3 and on_plot_click of Core can then be checked and timed on a machine
+without a sound device, and the results do not depend on the load of the machine.
+
+    python simulated.py --seconds 10  # measure the loop, seek and pause accuracy
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+# Delay between a play and the device pulling the first block, in seconds
+START_DELAY = 0.01
+# Delay between the device pulling a block and the block being heard, in blocks
+OUTPUT_LATENCY_BLOCKS = 1
+# Number of feed calls per block duration, like the feeder thread of the PygameDevice
+FEEDS_PER_BLOCK = 4
+
+
+class SimulatedDevice:
+    """
+    The SimulatedDevice class plays blocks on a virtual clock.
+
+    Attributes:
+        time (float): The virtual time in seconds.
+        start_delay (float): The delay between a play and the first block playing.
+        output_latency (float): The delay between a block playing and being heard.
+        blocks (list): The (time heard, frames) of the played blocks in the order
+            they played, the frames (frames, 2) int16. A block cut short by a stop
+            or a play only holds the frames that were heard.
+        underruns (int): The number of times the queue ran dry.
+        feed_seconds (list): The real time spent in every feed call that rendered a
+            block.
+    """
+
+    def __init__(self, start_delay=START_DELAY, latency_blocks=OUTPUT_LATENCY_BLOCKS,
+                 feeds_per_block=FEEDS_PER_BLOCK):
+        self.start_delay = start_delay
+        self.latency_blocks = latency_blocks
+        self.output_latency = 0.0
+        self.feeds_per_block = feeds_per_block
+        self.time = 0.0
+        self.sample_rate = None
+        self.block_duration = 0.0
+        self.buffers = []
+        self.feed_function = None
+        self.playing = None
+        self.queued = None
+        self.block_end = 0.0
+        self.paused_at = None
+        self.blocks = []
+        self.underruns = 0
+        self.feed_seconds = []
+
+    def open(self, sample_rate, block_frames, num_blocks, feed):
+        """
+        Opens the device at the sample rate. feed is called while the clock advances.
+
+        Returns:
+            list: The (frames, 2) int16 buffers the blocks are rendered into.
+        """
+        self.sample_rate = sample_rate
+        self.block_duration = block_frames / sample_rate
+        self.output_latency = self.latency_blocks * self.block_duration
+        self.buffers = [np.zeros((block_frames, 2), dtype=np.int16)
+                        for _ in range(num_blocks)]
+        self.feed_function = feed
+        return self.buffers
+
+    def close(self):
+        self.cut()
+        self.playing = None
+        self.queued = None
+        self.feed_function = None
+
+    def quit(self):
+        pass
+
+    def now(self):
+        return self.time
+
+    def start(self, index, at):
+        """
+        Starts playing a buffer at a virtual time, recording its frames.
+        """
+        self.playing = index
+        self.block_end = at + self.block_duration
+        self.blocks.append((at + self.output_latency, self.buffers[index].copy()))
+
+    def cut(self):
+        """
+        Trims the blocks to the frames heard by now, dropping those still in the
+        output buffer.
+        """
+        if self.playing is None:
+            return
+        now = self.time if self.paused_at is None else self.paused_at
+        while self.blocks:
+            heard_at, frames = self.blocks[-1]
+            heard = int(round((now - heard_at) * self.sample_rate))
+            if heard > 0:
+                self.blocks[-1] = (heard_at, frames[:min(len(frames), heard)])
+                return
+            self.blocks.pop()
+
+    def play(self, index):
+        self.cut()
+        self.paused_at = None
+        self.queued = None
+        self.start(index, self.time + self.start_delay)
+
+    def queue(self, index):
+        self.queued = index
+
+    def busy(self):
+        return self.playing is not None
+
+    def queue_empty(self):
+        return self.queued is None
+
+    def stop(self):
+        self.cut()
+        self.playing = None
+        self.queued = None
+        self.paused_at = None
+
+    def pause(self):
+        if self.paused_at is None:
+            self.paused_at = self.time
+
+    def unpause(self):
+        if self.paused_at is not None:
+            # The blocks not heard in full resume where they were paused
+            paused = self.time - self.paused_at
+            self.block_end += paused
+            for index in range(len(self.blocks) - 1, -1, -1):
+                heard_at, frames = self.blocks[index]
+                if heard_at + len(frames) / self.sample_rate <= self.paused_at:
+                    break
+                self.blocks[index] = (heard_at + paused, frames)
+            self.paused_at = None
+
+    def consume(self):
+        """
+        Starts the queued blocks of the playing blocks that ended by now.
+        """
+        while (self.playing is not None and self.paused_at is None
+               and self.block_end <= self.time):
+            if self.queued is None:
+                self.playing = None
+                self.underruns += 1
+                return
+            index, self.queued = self.queued, None
+            self.start(index, self.block_end)
+
+    def advance(self, seconds):
+        """
+        Advances the virtual clock, playing the queued blocks and calling feed.
+        """
+        end = self.time + seconds
+        step = self.block_duration / self.feeds_per_block
+        while self.time < end:
+            self.time = min(end, self.time + step)
+            self.consume()
+            if self.feed_function is None:
+                continue
+            queued = self.queued
+            started = time.perf_counter()
+            self.feed_function()
+            if self.queued is not None and self.queued != queued:
+                self.feed_seconds.append(time.perf_counter() - started)
+
+    def frame_at(self, at):
+        """
+        Returns the (2,) int16 frame heard at a virtual time, or None in silence.
+        """
+        for start, frames in reversed(self.blocks):
+            if start <= at:
+                index = int((at - start) * self.sample_rate)
+                return frames[index] if index < len(frames) else None
+        return None
+
+    def recording(self):
+        """
+        Returns all played frames, (frames, 2) int16.
+        """
+        if not self.blocks:
+            return np.zeros((0, 2), dtype=np.int16)
+        return np.concatenate([frames for _, frames in self.blocks])
+
+
+def frame_index_audio(num_frames):
+    """
+    Returns (2, frames) float32 audio whose int16 samples encode the index of every
+    frame, the high bits in the left channel and the low 14 bits in the right one.
+    """
+    index = np.arange(num_frames)
+    # Half a step up, so that truncating to int16 gives the exact value
+    return ((np.stack((index >> 14, index & 0x3fff)) + 0.5) / 32767).astype(np.float32)
+
+
+def decode_frames(frames):
+    """
+    Returns the frame indices encoded by frame_index_audio in int16 frames.
+    """
+    frames = np.asarray(frames, dtype=np.int64)
+    return (frames[..., 0] << 14) | frames[..., 1]
+
+
+def benchmark(seconds, loop_seconds, sample_rate=44100, start_delay=START_DELAY,
+              latency_blocks=OUTPUT_LATENCY_BLOCKS):
+    """
+    Plays a loop through Core on a simulated device and reports the accuracy of the
+    loop wraps and the playback clock, the start latency after a seek and a pause,
+    and the cost of rendering a block.
+    """
+    # pylint: disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use("Agg")
+    from core import Core
+    from plot import Plot
+
+    device = SimulatedDevice(start_delay, latency_blocks)
+    core = Core(None, Plot(None), device=device)
+    num_frames = int(seconds * sample_rate)
+    core.original_data = frame_index_audio(num_frames)
+    core.playing_data = core.original_data
+    core.sample_rate = sample_rate
+    core.num_channels = 2
+
+    def heard():
+        """
+        Returns the frame heard now, or None in silence.
+        """
+        frame = device.frame_at(device.time)
+        return None if frame is None else int(decode_frames(frame))
+
+    # Loop a region and sample the clock along the way
+    loop_frames = int(loop_seconds * sample_rate)
+    core.on_select(0, loop_frames)
+    core.play_mp3()
+    errors = []
+    for _ in range(int(seconds * 100)):
+        device.advance(0.01)
+        if heard() is not None:
+            errors.append(core.get_position() - heard())
+    played = decode_frames(device.recording())
+    jumps = np.flatnonzero(np.diff(played) != 1)
+    exact = np.sum((played[jumps] == loop_frames - 1) & (played[jumps + 1] == 0))
+    print(f"Loop of {loop_seconds:g} s: {len(jumps)} wraps, {exact} at the exact frame, "
+          f"{device.underruns} underruns")
+    # Errors larger than half the loop are a wrap seen on one side only
+    errors = np.array(errors)
+    errors = (errors + loop_frames // 2) % loop_frames - loop_frames // 2
+    print(f"Clock error: mean {errors.mean() / sample_rate * 1000:+.2f} ms, max "
+          f"{np.abs(errors).max() / sample_rate * 1000:.2f} ms; latency estimate "
+          f"{core.output.latency * 1000:.2f} ms for a start delay of "
+          f"{start_delay * 1000:g} ms and an output latency of "
+          f"{device.output_latency * 1000:.2f} ms")
+
+    # Seek and measure how long until the target frame is heard
+    target_ms = seconds * 1000 / 2
+    target = int(target_ms / 1000 * sample_rate)
+    seek_at = device.time
+    core.on_plot_click(target_ms)
+    while heard() is None or heard() < target:
+        device.advance(16 / sample_rate)
+    print(f"Seek: heard after {(device.time - seek_at) * 1000:.2f} ms")
+
+    # Pause, wait, resume: playback continues at the frame it paused at
+    device.advance(0.5)
+    before = core.get_position()
+    core.pause_mp3()
+    device.advance(1.0)
+    core.pause_mp3()
+    after = core.get_position()
+    device.advance(0.5)
+    played = decode_frames(device.recording())
+    resumed = played[np.flatnonzero(played >= target)]
+    print(f"Pause: clock moved {after - before} frames while paused, "
+          f"{np.sum(np.diff(resumed) != 1)} gaps in the audio")
+
+    feed_ms = np.array(device.feed_seconds) * 1000
+    block_ms = core.output.block_frames / sample_rate * 1000
+    print(f"Block render: mean {feed_ms.mean():.3f} ms, max {feed_ms.max():.3f} ms "
+          f"per {block_ms:.1f} ms block over {len(feed_ms)} blocks")
+    core.stop_mp3()
+    core.on_closing()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the playback accuracy on a simulated output device.")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--loop", type=float, default=1.5)
+    parser.add_argument("--delay", type=float, default=START_DELAY,
+                        help="start delay of the device in seconds")
+    parser.add_argument("--latency", type=float, default=OUTPUT_LATENCY_BLOCKS,
+                        help="output latency of the device in blocks")
+    args = parser.parse_args()
+    benchmark(args.seconds, args.loop, start_delay=args.delay, latency_blocks=args.latency)
@@ -0,0 +1,294 @@
+"""
+This module contains the tiled spectrogram and chromagram of the audio.
+
+An STFT of a whole song is far too slow to compute on every zoom. Instead the
+time-frequency plane is cut into tiles of TILE_COLUMNS columns at power-of-two hop
+sizes, like the levels of the waveform pyramid. Drawing a window picks the level with
+about one column per screen pixel and assembles its tiles, so every zoom level costs
+about the same. The columns of a tile are windows sampled at the hop of its level, so
+a tile of the whole song costs as much as a tile of a second.
+
+Tiles are computed lazily by a background job, the visible ones first, and kept in
+memory under a byte budget and on disk in the cache entry of the file. The tiles are
+computed from the original audio, so they hold at every playback rate.
+"""
+
+import argparse
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import librosa
+
+# Length of the FFT window in frames
+N_FFT = 2048
+# Hop between the columns of level 0 in frames
+HOP_LENGTH = 512
+# Number of columns in a tile
+TILE_COLUMNS = 256
+N_MELS = 128
+# Highest frequency of the spectrogram, enough for transcription
+FMAX = 8000
+N_CHROMA = 12
+# Dynamic range of the spectrogram colors in dB
+TOP_DB = 80.0
+
+# Memory budget of the tiles kept by a SpectrogramTiles
+TILE_CACHE_BYTES = 256 * 1024 ** 2
+
+KINDS = ("spectrogram", "chroma")
+
+
+class SpectrogramTiles:
+    """
+    The SpectrogramTiles class computes and keeps the tiles of the spectrogram or the
+    chromagram of an audio array.
+
+    A tile (level, index) holds TILE_COLUMNS columns with a hop of
+    HOP_LENGTH << level frames, starting at frame index * tile_frames(level). The mel
+    spectrogram is in dB, the chromagram is normalized per column.
+
+    Attributes:
+        kind (str): "spectrogram" or "chroma".
+        num_bins (int): The number of rows of a tile.
+        num_levels (int): The number of levels. The top one has a single tile.
+        tiles (OrderedDict): The tiles in memory by (level, index), least recently
+            used first.
+    """
+
+    def __init__(self, audio_array, sample_rate, kind, cache=None, cache_key=None,
+                 max_bytes=TILE_CACHE_BYTES):
+        """
+        Args:
+            audio_array (np.array): The audio array.
+            sample_rate (int): The sample rate.
+            kind (str): "spectrogram" or "chroma".
+            cache (AudioCache): The cache to keep the tiles in on disk, if any.
+            cache_key (str): The cache key of the audio, or None if it is not cached.
+            max_bytes (int): The memory budget of the tiles in bytes.
+        """
+        self.audio = audio_array
+        self.sample_rate = sample_rate
+        self.kind = kind
+        self.cache = cache
+        self.cache_key = cache_key
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+        if kind == "chroma":
+            self.basis = librosa.filters.chroma(sr=sample_rate, n_fft=N_FFT,
+                                                n_chroma=N_CHROMA, tuning=0.0)
+        else:
+            self.basis = librosa.filters.mel(sr=sample_rate, n_fft=N_FFT,
+                                             n_mels=N_MELS,
+                                             fmax=min(FMAX, sample_rate / 2))
+        self.num_bins = self.basis.shape[0]
+        self.window = np.hanning(N_FFT).astype(np.float32)
+
+        self.num_levels = 1
+        while self.tile_frames(self.num_levels - 1) < audio_array.shape[-1]:
+            self.num_levels += 1
+
+    def hop(self, level):
+        return HOP_LENGTH << level
+
+    def tile_frames(self, level):
+        return TILE_COLUMNS * self.hop(level)
+
+    def level_for(self, frames_per_pixel):
+        """
+        Returns the coarsest level that still has at least one column per pixel.
+        """
+        level = 0
+        while level + 1 < self.num_levels and self.hop(level + 1) <= frames_per_pixel:
+            level += 1
+        return level
+
+    def tile_range(self, level, start_frame, end_frame):
+        """
+        Returns the indexes of the tiles of a level covering the given frames.
+        """
+        tile_frames = self.tile_frames(level)
+        last = -(-min(end_frame, self.audio.shape[-1]) // tile_frames)
+        return range(max(0, start_frame) // tile_frames, max(last, 1))
+
+    def tile_name(self, level, index):
+        return f"{self.kind}-{level}-{index}"
+
+    def get(self, level, index, load=True):
+        """
+        Returns a tile from memory or from the disk cache, or None if it is not
+        computed yet.
+        """
+        key = (level, index)
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                return tile
+        if not load or self.cache is None or self.cache_key is None:
+            return None
+        tile = self.cache.load_array(self.cache_key, self.tile_name(level, index),
+                                     mmap=False)
+        if tile is not None:
+            self.put(level, index, tile)
+        return tile
+
+    def put(self, level, index, tile):
+        with self.lock:
+            self.tiles[(level, index)] = tile
+            self.tiles.move_to_end((level, index))
+            while self.nbytes() > self.max_bytes and len(self.tiles) > 1:
+                self.tiles.popitem(last=False)
+
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def compute(self, level, index):
+        """
+        Computes a tile, keeps it and stores it in the disk cache.
+        """
+        hop = self.hop(level)
+        positions = (index * self.tile_frames(level) + np.arange(TILE_COLUMNS) * hop
+                     - N_FFT // 2)
+        frames = positions[:, np.newaxis] + np.arange(N_FFT)
+        num_frames = self.audio.shape[-1]
+        outside = (frames < 0) | (frames >= num_frames)
+        # Gather the windows of every channel and average them
+        windows = self.audio[..., np.clip(frames, 0, num_frames - 1)]
+        if windows.ndim == 3:
+            windows = windows.mean(axis=0)
+        windows = windows.astype(np.float32, copy=False)
+        windows[outside] = 0.0
+
+        power = np.abs(np.fft.rfft(windows * self.window, axis=1)) ** 2
+        values = self.basis @ power.T
+        if self.kind == "chroma":
+            peaks = values.max(axis=0, keepdims=True)
+            values = np.divide(values, peaks, out=np.zeros_like(values),
+                               where=peaks > 0)
+        else:
+            values = librosa.power_to_db(values, ref=1.0, top_db=None)
+        tile = values.astype(np.float16)
+
+        self.put(level, index, tile)
+        if self.cache is not None and self.cache_key is not None:
+            self.cache.store_array(self.cache_key, self.tile_name(level, index), tile)
+        return tile
+
+    def missing(self, start_frame, end_frame, num_pixels):
+        """
+        Returns the tiles to compute to draw the given frames, the visible ones first
+        and then the ones of the neighbouring windows, for panning.
+        """
+        level = self.level_for((end_frame - start_frame) / max(1, num_pixels))
+        width = end_frame - start_frame
+        visible = list(self.tile_range(level, start_frame, end_frame))
+        neighbours = [index for index in self.tile_range(level, start_frame - width,
+                                                         end_frame + width)
+                      if index not in visible]
+        # Nearest neighbours first
+        center = (start_frame + end_frame) / 2 / self.tile_frames(level)
+        neighbours.sort(key=lambda index: abs(index + 0.5 - center))
+        return [(level, index) for index in visible + neighbours
+                if self.get(level, index) is None]
+
+    def run(self, job, requests):
+        """
+        Computes the requested tiles. Runs on a worker thread as a scheduler job.
+
+        Returns:
+            int: The number of tiles computed.
+        """
+        job.tiles_done = 0
+        for level, index in requests:
+            if job.cancelled.is_set():
+                break
+            if self.get(level, index, load=False) is None:
+                self.compute(level, index)
+            job.tiles_done += 1
+            job.progress = job.tiles_done / len(requests)
+        return job.tiles_done
+
+    def coarser(self, level, index):
+        """
+        Returns the columns of a tile taken from a coarser tile in memory, repeated
+        to the resolution of the level, or None if there is none.
+        """
+        for up in range(1, self.num_levels - level):
+            if TILE_COLUMNS >> up == 0:
+                break
+            tile = self.get(level + up, index >> up, load=False)
+            if tile is not None:
+                count = TILE_COLUMNS >> up
+                offset = (index - ((index >> up) << up)) * count
+                return np.repeat(tile[:, offset:offset + count], 1 << up, axis=1)
+        return None
+
+    def image(self, start_frame, end_frame, num_pixels):
+        """
+        Assembles the tiles covering the given frames. Tiles not computed yet are
+        taken from a coarser level if possible, and left blank otherwise.
+
+        Returns:
+            tuple: The image with one row per bin and one column per hop, and the
+                first and the end frame it covers.
+        """
+        level = self.level_for((end_frame - start_frame) / max(1, num_pixels))
+        indexes = self.tile_range(level, start_frame, end_frame)
+        blank = np.full((self.num_bins, TILE_COLUMNS), np.nan, dtype=np.float32)
+        columns = []
+        for index in indexes:
+            tile = self.get(level, index, load=False)
+            if tile is None:
+                tile = self.coarser(level, index)
+            columns.append(blank if tile is None else tile.astype(np.float32))
+        tile_frames = self.tile_frames(level)
+        return (np.concatenate(columns, axis=1), indexes.start * tile_frames,
+                indexes.stop * tile_frames)
+
+    def color_limits(self, image):
+        """
+        Returns the color range of an image.
+        """
+        if self.kind == "chroma":
+            return 0.0, 1.0
+        if np.all(np.isnan(image)):
+            return -TOP_DB, 0.0
+        high = float(np.nanmax(image))
+        return high - TOP_DB, high
+
+
+def benchmark(seconds, sample_rate=44100, num_pixels=1000):
+    """
+    Times drawing a view at every zoom level of a long synthetic track, with the
+    tiles computed from scratch and then taken from memory.
+    """
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal((1, int(seconds * sample_rate))) * 0.1).astype(np.float32)
+    for kind in KINDS:
+        tiles = SpectrogramTiles(audio, sample_rate, kind)
+        window = audio.shape[-1]
+        while window >= num_pixels * HOP_LENGTH:
+            start = (audio.shape[-1] - window) // 2
+            started = time.perf_counter()
+            for level, index in tiles.missing(start, start + window, num_pixels):
+                tiles.compute(level, index)
+            computed = time.perf_counter() - started
+            started = time.perf_counter()
+            tiles.image(start, start + window, num_pixels)
+            assembled = time.perf_counter() - started
+            print(f"{kind} window {window / sample_rate:8.1f} s: computed in "
+                  f"{computed * 1000:6.0f} ms, assembled in {assembled * 1000:.1f} ms")
+            window //= 4
+        print(f"{kind}: {len(tiles.tiles)} tiles, {tiles.nbytes() / 1024 ** 2:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the spectrogram tiles on a long synthetic track.")
+    parser.add_argument("--seconds", type=float, default=3600)
+    args = parser.parse_args()
+    benchmark(args.seconds)
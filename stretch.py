@@ -0,0 +1,271 @@
+"""
+This module contains the background time-stretch engine.
+
+Stretching a whole song on the Tk thread freezes the UI, although usually only the
+looped region is needed. A StretchJob stretches a region of the audio in overlapping
+chunks on a background job of the scheduler. The chunks are written to a preallocated
+output array as they finish, so playback can start on the first ones, and the job can
+be cancelled.
+
+Finished renders are kept in a StretchCache, so switching back to a rate that was
+already used is instant.
+"""
+
+import argparse
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Length of the input chunks in seconds
+CHUNK_SECONDS = 5.0
+# Extra input on each side of a chunk, so the stretch has context at the edges
+OVERLAP_SECONDS = 0.25
+# Length of the crossfade between consecutive chunks in seconds
+FADE_SECONDS = 0.02
+
+# Memory budget of the stretched renders kept by a StretchCache
+STRETCH_CACHE_BYTES = 512 * 1024 ** 2
+
+
+def stretch_chunks(source, sample_rate, rate, start_frame, end_frame, stretch,
+                   chunk_frames):
+    """
+    Stretches a region of audio chunk by chunk, crossfading consecutive chunks.
+
+    Args:
+        source (np.array): The (channels, frames) source audio.
+        sample_rate (int): The sample rate.
+        rate (float): The stretch rate.
+        start_frame (int): The first frame of the region.
+        end_frame (int): The frame after the region.
+        stretch (callable): Stretches an audio array by a rate.
+        chunk_frames (int): The length of the input chunks in frames.
+
+    Yields:
+        tuple: The output frame a stretched chunk starts at, the chunk and the source
+            frame after it. Only one chunk is held at a time.
+    """
+    overlap = int(OVERLAP_SECONDS * sample_rate)
+    fade = int(FADE_SECONDS * sample_rate)
+    num_output_frames = max(0, int(round((end_frame - start_frame) / rate)))
+    tail = None
+
+    def output_position(frame):
+        return min(num_output_frames, int(round((frame - start_frame) / rate)))
+
+    for chunk_start in range(start_frame, end_frame, chunk_frames):
+        chunk_end = min(end_frame, chunk_start + chunk_frames)
+        input_start = max(0, chunk_start - overlap)
+        input_end = min(source.shape[-1], chunk_end + overlap)
+        stretched = stretch(source[..., input_start:input_end], rate)
+
+        # Drop the stretched overlap before the chunk and keep the overlap after it
+        # for the crossfade with the next chunk
+        lead = int(round((chunk_start - input_start) / rate))
+        output_start = output_position(chunk_start)
+        length = output_position(chunk_end) - output_start
+        segment = stretched[..., lead:lead + length + fade]
+        if segment.shape[-1] < length:
+            padding = np.zeros(segment.shape[:-1] + (length - segment.shape[-1],),
+                               dtype=segment.dtype)
+            segment = np.concatenate((segment, padding), axis=-1)
+
+        # The ramp runs along the frames, the last axis, of every channel
+        body = segment[..., :length]
+        if tail is not None:
+            num_faded = min(fade, tail.shape[-1], length)
+            ramp = np.linspace(0.0, 1.0, num_faded, dtype=np.float32)
+            body[..., :num_faded] = (tail[..., :num_faded] * (1 - ramp)
+                                     + body[..., :num_faded] * ramp)
+        tail = segment[..., length:]
+        yield output_start, body, chunk_end
+
+
+class StretchJob:
+    """
+    The StretchJob class stretches a region of audio in chunks. Its run method is
+    submitted to the job scheduler, or called directly to stretch on the calling thread.
+
+    Attributes:
+        rate (float): The stretch rate, below 1 slows down.
+        start_frame (int): The first frame of the region in the source audio.
+        end_frame (int): The frame after the region in the source audio.
+        output (np.array): The stretched region, filled as the chunks finish.
+        done_frames (int): The number of output frames finished so far.
+        progress (float): The finished fraction of the region.
+        finished (bool): Whether the whole region is stretched.
+        elapsed (float): The time the job took in seconds, once finished.
+    """
+
+    def __init__(self, audio_array, sample_rate, rate, start_frame, end_frame, stretch,
+                 chunk_seconds=CHUNK_SECONDS):
+        """
+        Args:
+            audio_array (np.array): The source audio.
+            sample_rate (int): The sample rate.
+            rate (float): The stretch rate.
+            start_frame (int): The first frame of the region.
+            end_frame (int): The frame after the region.
+            stretch (callable): Stretches an audio array by a rate, like
+                core.stretch_audio.
+            chunk_seconds (float): The length of the input chunks in seconds.
+        """
+        self.source = audio_array
+        self.sample_rate = sample_rate
+        self.rate = rate
+        self.start_frame = max(0, start_frame)
+        self.end_frame = min(audio_array.shape[-1], end_frame)
+        self.stretch = stretch
+        self.chunk_frames = max(1, int(chunk_seconds * sample_rate))
+
+        num_output_frames = max(
+            0, int(round((self.end_frame - self.start_frame) / rate)))
+        self.output = np.zeros(audio_array.shape[:-1] + (num_output_frames,),
+                               dtype=audio_array.dtype)
+        self.done_frames = 0
+        self.progress = 0.0
+        self.finished = False
+        self.elapsed = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def output_position(self, frame):
+        """
+        Returns the output frame of a source frame of the region.
+        """
+        return min(self.output.shape[-1],
+                   int(round((frame - self.start_frame) / self.rate)))
+
+    def run(self, job=None):
+        """
+        Stretches the region chunk by chunk. Can also be called directly to stretch
+        on the calling thread.
+
+        Args:
+            job (jobs.Job): The scheduler job running the stretch, if any. Its
+                cancellation stops the stretch and it receives the progress.
+
+        Returns:
+            StretchJob: The stretch job itself.
+        """
+        started = time.perf_counter()
+        chunks = stretch_chunks(self.source, self.sample_rate, self.rate, self.start_frame,
+                                self.end_frame, self.stretch, self.chunk_frames)
+        # Every chunk is stretched when the loop asks for it
+        while True:
+            if self.cancelled.is_set() or (job is not None and job.cancelled.is_set()):
+                # Cancelled before the last chunk
+                return self
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            output_start, body, chunk_end = chunk
+            output_end = output_start + body.shape[-1]
+            self.output[..., output_start:output_end] = body
+            self.done_frames = output_end
+            self.progress = (chunk_end - self.start_frame) / \
+                (self.end_frame - self.start_frame)
+            if job is not None:
+                job.progress = self.progress
+
+        self.elapsed = time.perf_counter() - started
+        self.finished = True
+        return self
+
+
+class StretchCache:
+    """
+    The StretchCache class keeps finished stretched renders, keyed by source, region
+    and rate, and evicts the least recently used ones beyond a memory budget.
+
+    A render also serves any region inside its own region at the same rate.
+
+    Attributes:
+        max_bytes (int): The memory budget in bytes.
+        renders (OrderedDict): The renders by (source, start_frame, end_frame, rate),
+            least recently used first.
+    """
+
+    def __init__(self, max_bytes=STRETCH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.renders = OrderedDict()
+
+    @staticmethod
+    def rate_key(rate):
+        # 0.8 * 0.8 and 0.64 are the same rate
+        return round(rate, 4)
+
+    def get(self, source, start_frame, end_frame, rate):
+        """
+        Returns the stretched region, or None if no cached render covers it.
+
+        Args:
+            source: The identity of the source audio, e.g. its cache key.
+            start_frame (int): The first frame of the region in the source audio.
+            end_frame (int): The frame after the region in the source audio.
+            rate (float): The stretch rate.
+        """
+        rate = self.rate_key(rate)
+        for key in reversed(self.renders):
+            render_source, render_start, render_end, render_rate = key
+            if (render_source == source and render_rate == rate
+                    and render_start <= start_frame and end_frame <= render_end):
+                self.renders.move_to_end(key)
+                offset = int(round((start_frame - render_start) / rate))
+                length = int(round((end_frame - start_frame) / rate))
+                return self.renders[key][..., offset:offset + length]
+        return None
+
+    def put(self, source, start_frame, end_frame, rate, output):
+        """
+        Adds a finished render and evicts old ones beyond the memory budget.
+        """
+        key = (source, start_frame, end_frame, self.rate_key(rate))
+        self.renders[key] = output
+        self.renders.move_to_end(key)
+        while self.nbytes() > self.max_bytes and len(self.renders) > 1:
+            self.renders.popitem(last=False)
+
+    def nbytes(self):
+        return sum(output.nbytes for output in self.renders.values())
+
+    def clear(self):
+        self.renders.clear()
+
+
+def benchmark(seconds, region_seconds, rate, sample_rate=44100):
+    """
+    Compares stretching a region in chunks with stretching the whole file.
+    """
+    from core import stretch_audio  # pylint: disable=import-outside-toplevel
+
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal((1, int(seconds * sample_rate))) * 0.1).astype(np.float32)
+    region_frames = int(region_seconds * sample_rate)
+
+    # Warm up librosa, whose first call compiles its kernels
+    stretch_audio(audio[:, :sample_rate], rate)
+
+    job = StretchJob(audio, sample_rate, rate, 0, region_frames, stretch_audio)
+    job.run()
+    print(f"Region of {region_seconds} s: {job.elapsed:.2f} s")
+
+    started = time.perf_counter()
+    stretch_audio(audio, rate)
+    full = time.perf_counter() - started
+    print(f"Whole file of {seconds} s: {full:.2f} s")
+    print(f"Speed-up: {full / job.elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark region stretching against whole-file stretching.")
+    parser.add_argument("--seconds", type=float, default=300)
+    parser.add_argument("--region", type=float, default=20)
+    parser.add_argument("--rate", type=float, default=0.8)
+    args = parser.parse_args()
+    benchmark(args.seconds, args.region, args.rate)
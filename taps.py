@@ -0,0 +1,212 @@
+"""
+This module contains the correction of tapped beats and measures.
+
+A tap is read from the playback clock when its key event is handled, which is later
+than the key press by the time the event waited in the Tk event queue, and a player
+taps ahead of or behind what they hear by a personal offset. The TapCorrector takes
+both out: the queue delay of every event from the timestamp Tk gives it, and the
+personal offset measured by a calibration. The corrected time is then snapped to the
+nearest onset of the onset index within a tolerance, a binary search over the sorted
+onset times of the file.
+
+Delays and the tolerance are in ms of heard time. At a rate below 1 a heard ms covers
+less of the original audio, so they are scaled by the rate before they are applied to
+the marker times, which are in ms of the original audio.
+
+The calibration collects the distance of a number of taps to their nearest onsets
+while the player taps along the beat, and takes the median as the offset. It is saved
+to a small settings file, so it holds for every file.
+
+    python taps.py --taps 100000  # benchmark the correction and the calibration
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from cache import write_atomically
+
+DEFAULT_SETTINGS_PATH = os.path.join(
+    os.path.expanduser("~"), ".local", "share", "music-transcriber", "taps.json")
+# Taps further than this from an onset, in ms of heard time, are not snapped
+SNAP_TOLERANCE_MS = 40.0
+# Number of taps a calibration takes the median of
+CALIBRATION_TAPS = 16
+# Taps further than this from an onset, in ms of heard time, do not count towards a
+# calibration
+CALIBRATION_WINDOW_MS = 150.0
+# Queue delays above this are a jump of the event clock, e.g. a wrap-around, rather
+# than a real delay
+MAX_QUEUE_DELAY_MS = 1000.0
+
+
+class TapCorrector:
+    """
+    The TapCorrector class corrects tapped times and snaps them to onsets.
+
+    Attributes:
+        onsets (np.array): The sorted onset times in ms of the original audio.
+        offset_ms (float): How late the player taps, in ms of heard time. Negative
+            if they tap ahead.
+        tolerance_ms (float): The largest distance to an onset a tap is snapped
+            over, in ms of heard time. 0 disables snapping.
+        clock_difference (float): The smallest difference between the local clock
+            and the event clock seen, the difference of an event handled at once.
+        calibration (list): The distances of the calibration taps to their onsets,
+            or None if not calibrating.
+    """
+
+    def __init__(self, offset_ms=0.0, tolerance_ms=SNAP_TOLERANCE_MS,
+                 settings_path=None):
+        self.onsets = np.zeros(0)
+        self.offset_ms = offset_ms
+        self.tolerance_ms = tolerance_ms
+        self.settings_path = settings_path
+        self.clock_difference = None
+        self.calibration = None
+
+    @classmethod
+    def load(cls, settings_path=DEFAULT_SETTINGS_PATH):
+        """
+        Returns a TapCorrector with the settings saved at the path, or the defaults
+        if there are none.
+        """
+        corrector = cls(settings_path=settings_path)
+        try:
+            with open(settings_path, "r", encoding="utf-8") as file:
+                settings = json.load(file)
+        except (OSError, ValueError):
+            return corrector
+        corrector.offset_ms = float(settings.get("offset_ms", corrector.offset_ms))
+        corrector.tolerance_ms = float(settings.get("tolerance_ms", corrector.tolerance_ms))
+        return corrector
+
+    def save(self):
+        if self.settings_path is None:
+            return
+        os.makedirs(os.path.dirname(self.settings_path), exist_ok=True)
+        settings = {"offset_ms": self.offset_ms, "tolerance_ms": self.tolerance_ms}
+        write_atomically(self.settings_path, lambda file: json.dump(settings, file), "w")
+
+    def set_onsets(self, onsets):
+        self.onsets = np.sort(np.asarray(onsets, dtype=np.float64).reshape(-1))
+
+    def queue_delay(self, event_time, now_ms=None):
+        """
+        Returns how long an event waited before it was handled, in ms.
+
+        Args:
+            event_time (int): The timestamp of the event in ms, the time attribute of
+                a Tk event, or None if unknown.
+            now_ms (float): The local time the event is handled at in ms, now if None.
+        """
+        if event_time is None:
+            return 0.0
+        if now_ms is None:
+            now_ms = time.monotonic() * 1000
+        # The clocks differ by a constant, plus the delay of the event
+        difference = now_ms - event_time
+        if (self.clock_difference is None or difference < self.clock_difference
+                or difference - self.clock_difference > MAX_QUEUE_DELAY_MS):
+            self.clock_difference = difference
+        return difference - self.clock_difference
+
+    def nearest_onset(self, time_ms):
+        """
+        Returns the onset nearest to a time, or None if there are none.
+        """
+        index = int(np.searchsorted(self.onsets, time_ms))
+        if index == len(self.onsets) or (
+                index > 0 and time_ms - self.onsets[index - 1] <= self.onsets[index] - time_ms):
+            index -= 1
+        return None if index < 0 else float(self.onsets[index])
+
+    def correct(self, time_ms, rate=1.0, delay_ms=0.0):
+        """
+        Returns a tapped time with the queue delay and the personal offset taken out,
+        snapped to the nearest onset within the tolerance.
+
+        Args:
+            time_ms (float): The playback time of the tap in ms of the original audio.
+            rate (float): The playback rate.
+            delay_ms (float): The queue delay of the tap event.
+        """
+        time_ms -= (delay_ms + self.offset_ms) * rate
+        onset = self.nearest_onset(time_ms)
+        if onset is not None and abs(onset - time_ms) <= self.tolerance_ms * rate:
+            return onset
+        return time_ms
+
+    def start_calibration(self):
+        self.calibration = []
+
+    def calibrate(self, time_ms, rate=1.0, delay_ms=0.0):
+        """
+        Adds a tap to the calibration. After CALIBRATION_TAPS taps near onsets the
+        offset is set to their median distance and saved.
+
+        Returns:
+            bool: Whether the calibration finished.
+        """
+        time_ms -= delay_ms * rate
+        onset = self.nearest_onset(time_ms)
+        if onset is None:
+            return False
+        distance = (time_ms - onset) / rate
+        if abs(distance) <= CALIBRATION_WINDOW_MS:
+            self.calibration.append(distance)
+        if len(self.calibration) < CALIBRATION_TAPS:
+            return False
+        self.offset_ms = float(np.median(self.calibration))
+        self.calibration = None
+        self.save()
+        return True
+
+
+def benchmark(num_taps, num_onsets=5000, offset_ms=25.0, jitter_ms=10.0, seed=0):
+    """
+    Simulates taps with a constant offset, jitter and random queue delays on a track
+    of onsets, and reports the cost of a correction, the calibrated offset and how
+    many taps land on their onset before and after the correction.
+    """
+    rng = np.random.default_rng(seed)
+    onsets = np.cumsum(rng.uniform(100, 600, num_onsets))
+    corrector = TapCorrector()
+    corrector.set_onsets(onsets)
+
+    targets = rng.choice(onsets, num_taps)
+    delays = rng.exponential(5, num_taps)
+    taps = targets + offset_ms + rng.normal(0, jitter_ms, num_taps) + delays
+    # The event clock runs a constant apart from the local one
+    event_times = np.round(targets + offset_ms).astype(np.int64)
+    now = event_times + 123456.0 + delays
+
+    corrector.start_calibration()
+    index = 0
+    while not corrector.calibrate(taps[index], 1.0,
+                                  corrector.queue_delay(event_times[index], now[index])):
+        index += 1
+    print(f"Calibrated an offset of {corrector.offset_ms:.1f} ms "
+          f"(true {offset_ms:g} ms) from {index + 1} taps")
+
+    started = time.perf_counter()
+    corrected = [corrector.correct(tap, 1.0, corrector.queue_delay(event_time, now_ms))
+                 for tap, event_time, now_ms in zip(taps, event_times, now)]
+    elapsed = time.perf_counter() - started
+    print(f"Corrected {num_taps} taps in {elapsed * 1000:.1f} ms "
+          f"({elapsed / num_taps * 1e6:.2f} us per tap)")
+    print(f"On their onset: {np.mean(np.abs(taps - targets) < 1):.0%} of the raw taps, "
+          f"{np.mean(np.abs(np.array(corrected) - targets) < 1):.0%} corrected")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the correction of tapped markers.")
+    parser.add_argument("--taps", type=int, default=100000)
+    parser.add_argument("--offset", type=float, default=25.0,
+                        help="simulated tap offset in ms")
+    args = parser.parse_args()
+    benchmark(args.taps, offset_ms=args.offset)
@@ -0,0 +1,179 @@
+"""
+This module contains the opt-in instrumentation of the hot paths.
+
+When enabled, by setting MUSIC_TRANSCRIBER_TELEMETRY=1 or by running transcribe.py
+with --telemetry, it records the durations of the instrumented functions and jobs, the
+intervals between the ticks of the playhead animation against the intended interval,
+the memory held by the audio buffers and the latest values of a few settings that adapt
+to the load. The app shows a live summary over the plot
+and dumps everything to a JSON file on exit.
+
+When disabled, an instrumented call costs one flag check.
+"""
+
+import functools
+import json
+import os
+import time
+from collections import defaultdict, deque
+
+ENV_VARIABLE = "MUSIC_TRANSCRIBER_TELEMETRY"
+DEFAULT_FILE = "telemetry.json"
+# Number of durations kept per name
+MAX_SAMPLES = 1000
+# Upper edges of the tick histogram bins, as multiples of the intended interval
+TICK_BINS = (0.9, 1.1, 1.5, 2.0, 4.0, float("inf"))
+# A tick this many intended intervals after the previous one starts a new run
+TICK_RESTART = 10
+
+
+class Telemetry:
+    """
+    The Telemetry class records durations, tick intervals and memory.
+
+    Attributes:
+        enabled (bool): Whether anything is recorded.
+        durations (dict): The recent durations in seconds by name.
+        counts (dict): The number of recorded durations by name.
+        ticks (dict): The tick histogram counts by name, one per TICK_BINS bin.
+        memory (dict): The latest memory figures in bytes by buffer name.
+        values (dict): The latest values by name.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started_at = time.time()
+        self.durations = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+        self.counts = defaultdict(int)
+        self.ticks = defaultdict(lambda: [0] * len(TICK_BINS))
+        self.last_ticks = {}
+        self.intended = {}
+        self.memory = {}
+        self.values = {}
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self.durations[name].append(seconds)
+            self.counts[name] += 1
+
+    def timed(self, name):
+        """
+        Returns a decorator recording the duration of every call under the name.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def tick(self, name, intended):
+        """
+        Records the interval since the previous tick of a periodic callback.
+
+        Args:
+            name (str): The name of the callback.
+            intended (float): The intended interval in seconds.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        last = self.last_ticks.get(name)
+        self.last_ticks[name] = now
+        self.intended[name] = intended
+        if last is None or now - last > TICK_RESTART * intended:
+            return
+        ratio = (now - last) / intended
+        for index, edge in enumerate(TICK_BINS):
+            if ratio < edge:
+                self.ticks[name][index] += 1
+                break
+
+    def measure_memory(self, buffers):
+        """
+        Records the size of the given buffers.
+
+        Args:
+            buffers (dict): The buffers by name. A buffer has an nbytes attribute or
+                method, or is None.
+        """
+        if not self.enabled:
+            return
+        for name, buffer in buffers.items():
+            nbytes = getattr(buffer, "nbytes", 0)
+            self.memory[name] = nbytes() if callable(nbytes) else nbytes
+
+    def set_value(self, name, value):
+        """
+        Records the latest value of a setting, e.g. one changed on the audio thread,
+        where printing it could delay the next block.
+        """
+        if self.enabled:
+            self.values[name] = value
+
+    def statistics(self):
+        """
+        Returns count, mean, 95th percentile and maximum in ms of every name.
+        """
+        statistics = {}
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            statistics[name] = {
+                "count": self.counts[name],
+                "mean_ms": sum(ordered) / len(ordered) * 1000,
+                "p95_ms": ordered[int(0.95 * (len(ordered) - 1))] * 1000,
+                "max_ms": ordered[-1] * 1000,
+            }
+        return statistics
+
+    def summary(self):
+        """
+        Returns a short text of the figures, for the overlay.
+        """
+        lines = [f"{name[:18]:18} {values['mean_ms']:6.1f} {values['p95_ms']:6.1f} "
+                 f"{values['max_ms']:6.1f}"
+                 for name, values in sorted(self.statistics().items())]
+        if lines:
+            lines.insert(0, f"{'ms':18} {'mean':>6} {'p95':>6} {'max':>6}")
+        for name, counts in self.ticks.items():
+            total = sum(counts) or 1
+            late = sum(counts[2:]) / total
+            lines.append(f"{name} ticks at {self.intended[name] * 1000:.0f} ms: "
+                         f"{late:.0%} late by >10%")
+        for name, nbytes in self.memory.items():
+            lines.append(f"{name[:18]:18} {nbytes / 1024 ** 2:8.1f} MB")
+        for name, value in self.values.items():
+            lines.append(f"{name[:18]:18} {value:8}")
+        return "\n".join(lines)
+
+    def dump(self, path=DEFAULT_FILE):
+        """
+        Writes all figures to a JSON file.
+        """
+        if not self.enabled:
+            return
+        report = {
+            "started": time.strftime("%Y-%m-%d %H:%M:%S",
+                                     time.localtime(self.started_at)),
+            "durations": self.statistics(),
+            "ticks": {name: {"intended_ms": self.intended[name] * 1000,
+                             "bins": [f"<{edge}x" for edge in TICK_BINS],
+                             "counts": counts}
+                      for name, counts in self.ticks.items()},
+            "memory_bytes": self.memory,
+            "values": self.values,
+        }
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Wrote telemetry to {path}")
+
+
+# The recorder of the app, enabled by the environment variable
+recorder = Telemetry(enabled=os.environ.get(ENV_VARIABLE, "") not in ("", "0"))
+timed = recorder.timed
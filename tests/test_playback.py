@@ -0,0 +1,111 @@
+"""
+Tests of the playback accuracy, driving Core on a SimulatedDevice. The device plays on
+a virtual clock and the audio encodes the index of every frame, so the recording
+tells exactly which frame was heard when, independent of the load of the machine.
+"""
+
+import matplotlib
+import numpy as np
+import pytest
+
+matplotlib.use("Agg")
+
+# pylint: disable=wrong-import-position
+from core import Core
+from plot import Plot
+from simulated import SimulatedDevice, decode_frames, frame_index_audio
+
+SAMPLE_RATE = 44100
+SECONDS = 6
+LOOP_FRAMES = int(1.5 * SAMPLE_RATE)
+
+
+@pytest.fixture(name="player")
+def fixture_player():
+    device = SimulatedDevice()
+    core = Core(None, Plot(None), device=device)
+    core.original_data = frame_index_audio(SECONDS * SAMPLE_RATE)
+    core.playing_data = core.original_data
+    core.sample_rate = SAMPLE_RATE
+    core.num_channels = 2
+    yield core, device
+    core.stop_mp3()
+    core.on_closing()
+
+
+def heard_at(device, frame):
+    """
+    Returns the virtual time the first frame of the given index was heard at, or
+    None if it was not heard.
+    """
+    for start, frames in device.blocks:
+        indices = np.flatnonzero(decode_frames(frames) == frame)
+        if len(indices):
+            return start + indices[0] / device.sample_rate
+    return None
+
+
+def test_loop_wraps_on_the_exact_frame(player):
+    core, device = player
+    core.on_select(0, LOOP_FRAMES)
+    core.play_mp3()
+    device.advance(5.0)
+
+    played = decode_frames(device.recording())
+    jumps = np.flatnonzero(np.diff(played) != 1)
+    assert played[0] == 0
+    assert len(jumps) == len(played) // LOOP_FRAMES
+    assert np.all(played[jumps] == LOOP_FRAMES - 1)
+    assert np.all(played[jumps + 1] == 0)
+    assert device.underruns == 0
+
+
+def test_start_latency(player):
+    core, device = player
+    played_at = device.time
+    core.play_mp3()
+    device.advance(1.0)
+
+    assert decode_frames(device.recording())[0] == 0
+    assert heard_at(device, 0) - played_at == pytest.approx(
+        device.start_delay + device.output_latency)
+    assert device.underruns == 0
+
+
+def test_seek_is_heard_within_one_block(player):
+    core, device = player
+    core.play_mp3()
+    device.advance(0.5)
+    target = SAMPLE_RATE * SECONDS // 2
+    clicked_at = device.time
+    core.on_plot_click(target / SAMPLE_RATE * 1000)
+    device.advance(0.5)
+
+    # Beyond the latency of the device, the seek waits for at most one block
+    latency = device.start_delay + device.output_latency
+    assert latency <= heard_at(device, target) - clicked_at <= \
+        latency + device.block_duration
+    played = decode_frames(device.recording())
+    resumed = played[np.flatnonzero(played == target)[0]:]
+    assert np.all(np.diff(resumed) == 1)
+    assert device.underruns == 0
+
+
+def test_pause_holds_the_position(player):
+    core, device = player
+    core.play_mp3()
+    device.advance(0.5)
+    core.pause_mp3()
+    paused_position = core.get_position()
+    paused_frames = len(device.recording())
+    device.advance(1.0)
+
+    assert core.get_position() - paused_position == 0
+    assert len(device.recording()) == paused_frames
+
+    core.pause_mp3()
+    device.advance(0.5)
+    played = decode_frames(device.recording())
+    assert played[0] == 0
+    assert np.all(np.diff(played) == 1)
+    assert device.underruns == 0
@@ -1,16 +1,38 @@
+import time
+
+# Measured before the other imports, which take most of the startup time
+STARTED_AT = time.perf_counter()
+
+# pylint: disable=wrong-import-position
+import argparse
+import threading
 import tkinter as tk
 from tkinter import filedialog
 
-from core import Core
+from core import Core, warm_up
 from plot import Plot
+import filters
+import telemetry
+
+IMPORTED_AT = time.perf_counter()
+
+# Playback rates offered next to the Slow Down button
+RATES = (1.0, 0.8, 0.64, 0.5)
+
+# Range of the live rate slider, stretched in real time
+LIVE_RATE_RANGE = (0.25, 1.5)
+
+# Interval in ms at which the telemetry overlay is refreshed
+TELEMETRY_INTERVAL = 500
 
 
 class MusicTranscriberApp:
-    def __init__(self, root):
+    def __init__(self, root, telemetry_file=telemetry.DEFAULT_FILE, raster=False):
         self.root = root
+        self.telemetry_file = telemetry_file
         self.root.title("Music Transcriber")
 
-        self.plot = Plot(root)
+        self.plot = Plot(root, raster=raster)
 
         core = Core(root, self.plot)
         self.core = core
@@ -26,6 +48,13 @@ class MusicTranscriberApp:
         self.load_button = tk.Button(button_frame, text="Load MP3", command=self.load_mp3)
         self.load_button.pack(side=tk.LEFT)
 
+        # Previous and next recording of the playlist
+        self.previous_button = tk.Button(button_frame, text="Prev", command=core.previous_entry)
+        self.previous_button.pack(side=tk.LEFT)
+
+        self.next_button = tk.Button(button_frame, text="Next", command=core.next_entry)
+        self.next_button.pack(side=tk.LEFT)
+
         # Play button
         self.play_button = tk.Button(button_frame, text="Play", command=core.play_mp3)
         self.play_button.pack(side=tk.LEFT)
@@ -38,6 +67,21 @@ class MusicTranscriberApp:
         self.slow_down_button = tk.Button(button_frame, text="Slow Down", command=core.slow_down)
         self.slow_down_button.pack(side=tk.LEFT)
 
+        # Playback rates, rendered from the original audio and cached
+        for rate in RATES:
+            rate_button = tk.Button(button_frame, text=f"{rate:g}x",
+                                    command=lambda rate=rate: core.set_rate(rate))
+            rate_button.pack(side=tk.LEFT)
+
+        # Live rate, stretched in real time by the output while it plays
+        self.live_rate_scale = tk.Scale(button_frame, from_=LIVE_RATE_RANGE[0],
+                                        to=LIVE_RATE_RANGE[1], resolution=0.01,
+                                        orient=tk.HORIZONTAL, label="Live rate")
+        self.live_rate_scale.set(1.0)
+        self.live_rate_scale.config(
+            command=lambda value: core.set_live_rate(float(value)))
+        self.live_rate_scale.pack(side=tk.LEFT)
+
         # Mark beats and measures
         self.mark_beat_button = tk.Button(button_frame, text="Mark Beat", command=core.mark_beat)
         self.mark_beat_button.pack(side=tk.LEFT)
@@ -45,6 +89,11 @@ class MusicTranscriberApp:
         self.mark_measure_button = tk.Button(button_frame, text="Mark Measure", command=core.mark_measure)
         self.mark_measure_button.pack(side=tk.LEFT)
 
+        # Measures the tap offset of the player, while they tap along the beat
+        self.calibrate_button = tk.Button(button_frame, text="Calibrate",
+                                          command=core.calibrate_taps)
+        self.calibrate_button.pack(side=tk.LEFT)
+
         self.reset_loop_button = tk.Button(button_frame, text="Reset Loop", command=core.reset_loop)
         self.reset_loop_button.pack(side=tk.LEFT)        
 
@@ -60,26 +109,128 @@ class MusicTranscriberApp:
         self.inc_plot_line_button = tk.Button(button_frame, text=">", command=self.plot.increase_loop_line)
         self.inc_plot_line_button.pack(side=tk.LEFT)   
 
+        # Spectrogram or chromagram below the waveform
+        self.spectrum_button = tk.Button(button_frame, text="Spectrum", command=self.plot.cycle_spectrum)
+        self.spectrum_button.pack(side=tk.LEFT)
+
+        # Note detection, drawn over the waveform
+        self.notes_button = tk.Button(button_frame, text="Notes", command=core.detect_notes)
+        self.notes_button.pack(side=tk.LEFT)
+
+        # Isolation filter of the playback, and whether the waveform shows its output
+        self.filter_var = tk.StringVar(value="off")
+        self.filter_menu = tk.OptionMenu(button_frame, self.filter_var, *filters.PRESETS,
+                                         command=core.set_filter)
+        self.filter_menu.pack(side=tk.LEFT)
+
+        self.filtered_button = tk.Checkbutton(button_frame, text="Filtered wave",
+                                              command=core.toggle_filtered_waveform)
+        self.filtered_button.pack(side=tk.LEFT)
+
+        # Export of the loop region at the current rate, or of the markers to MIDI
+        self.export_button = tk.Button(button_frame, text="Export", command=self.export)
+        self.export_button.pack(side=tk.LEFT)
+
+        # Busy state of the background jobs
+        self.status_label = tk.Label(button_frame, text="")
+        self.status_label.pack(side=tk.RIGHT)
+        core.jobs.on_status = self.show_status
+
+        # Live telemetry over the top right corner of the plot, if enabled
+        self.telemetry_label = None
+        if telemetry.recorder.enabled:
+            self.telemetry_label = tk.Label(root, justify=tk.LEFT, font="TkFixedFont",
+                                            bg="white", anchor="nw")
+            self.telemetry_label.place(relx=1.0, rely=0.0, y=40, anchor="ne")
+            self.update_telemetry()
+
         # Bind the space key to the on_space method
         self.root.bind('<space>', core.toggle_play_pause)
         self.root.bind('b', core.mark_beat)
         self.root.bind('m', core.mark_measure)
-
-        self.core.load_mp3_from_file_path("/home/dimitris/Documents/Stepped-Green.mp3")
-
+        self.root.bind('B', core.remove_beat)
+        self.root.bind('M', core.remove_measure)
+        self.root.bind('<Escape>', core.cancel_stretch)
+        self.root.bind('<Prior>', core.previous_entry)
+        self.root.bind('<Next>', core.next_entry)
+
+    def on_shown(self, file_paths=(), warm=True):
+        """
+        Runs once the first frame of the window is painted. Reports the startup time,
+        starts the audio output and opens the files given on the command line as the
+        playlist. The analysis dependencies are warmed up in the background.
+        """
+        shown_at = time.perf_counter()
+        print(f"Startup: window shown in {(shown_at - STARTED_AT) * 1000:.0f} ms "
+              f"(imports {(IMPORTED_AT - STARTED_AT) * 1000:.0f} ms)")
+        telemetry.recorder.record("startup", shown_at - STARTED_AT)
+
+        self.core.start_output()
+        print(f"Startup: audio output ready in "
+              f"{(time.perf_counter() - shown_at) * 1000:.0f} ms")
+        if file_paths:
+            self.core.open_files(file_paths)
+        if warm:
+            threading.Thread(target=warm_up, daemon=True).start()
 
     def on_closing(self):
         print("Closing")
+        telemetry.recorder.dump(self.telemetry_file)
         self.core.on_closing()
         self.root.quit()        # Close the application
 
+    def update_telemetry(self):
+        telemetry.recorder.measure_memory({
+            "original_data": self.core.original_data,
+            "playing_data": self.core.playing_data,
+            "waveform pyramid": self.plot.pyramid,
+            "stretch cache": self.core.stretch_cache,
+            "spectrum tiles": self.plot.spectrum_tiles,
+            "playlist": self.core.playlist,
+        })
+        self.telemetry_label.config(text=telemetry.recorder.summary())
+        self.root.after(TELEMETRY_INTERVAL, self.update_telemetry)
+
+    def show_status(self, status):
+        self.status_label.config(text=status)
+        self.root.config(cursor="watch" if status else "")
+
     def load_mp3(self):
-        file_path = filedialog.askopenfilename(initialdir="~/Documents/", filetypes=[("MP3 files", "*.mp3")])
-        if file_path:
-            self.core.load_mp3_from_file_path(file_path)        
+        file_paths = filedialog.askopenfilenames(initialdir="~/Documents/", filetypes=[("MP3 files", "*.mp3")])
+        if file_paths:
+            self.core.open_files(file_paths)
+
+    def export(self):
+        file_path = filedialog.asksaveasfilename(
+            initialdir="~/Documents/", defaultextension=".wav",
+            filetypes=[("WAV files", "*.wav"), ("FLAC files", "*.flac"),
+                       ("MIDI files", "*.mid")])
+        if not file_path:
+            return
+        if file_path.lower().endswith(".mid"):
+            self.core.export_markers(file_path)
+        else:
+            self.core.export_region(file_path)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcribe music by ear.")
+    parser.add_argument("files", nargs="*", help="audio files to open as the playlist")
+    parser.add_argument("--no-warm-up", action="store_true",
+                        help="import the analysis dependencies on first use only")
+    parser.add_argument("--telemetry", nargs="?", const=telemetry.DEFAULT_FILE,
+                        metavar="FILE",
+                        help="record hot-path timings and dump them to FILE on exit")
+    parser.add_argument("--raster", action="store_true",
+                        help="draw the waveform with the raster view instead of matplotlib")
+    args = parser.parse_args()
+    if args.telemetry:
+        telemetry.recorder.enabled = True
+
     root = tk.Tk()
-    app = MusicTranscriberApp(root)
+    app = MusicTranscriberApp(root, args.telemetry or telemetry.DEFAULT_FILE,
+                              raster=args.raster)
+    # Paint the first frame before anything slow happens
+    root.update()
+    root.after_idle(app.on_shown, args.files, not args.no_warm_up)
     root.mainloop()
@@ -0,0 +1,208 @@
+"""
+This module contains the min/max envelope pyramid used to draw the waveform.
+
+Level 0 holds the minimum and the maximum of every BASE_BUCKET frames of the audio,
+and every further level halves the resolution of the previous one. Drawing a window
+picks the level with about one bucket per screen pixel, so every zoom level draws a
+bounded number of points and short peaks stay visible.
+"""
+
+import numpy as np
+
+from pcm import to_mono
+
+# Number of frames in a bucket of level 0
+BASE_BUCKET = 16
+
+
+def _reduce_level(mins, maxs):
+    """
+    Returns the next level by combining pairs of buckets.
+    """
+    if len(mins) % 2:
+        mins = np.append(mins, mins[-1])
+        maxs = np.append(maxs, maxs[-1])
+    return (np.minimum(mins[0::2], mins[1::2]),
+            np.maximum(maxs[0::2], maxs[1::2]))
+
+
+def _bucket_envelope(audio_array, bucket_size):
+    """
+    Returns the minimum and maximum of every bucket_size frames of the audio array.
+    """
+    mono = to_mono(audio_array)
+    padding = -len(mono) % bucket_size
+    if padding:
+        mono = np.append(mono, np.full(padding, mono[-1], dtype=mono.dtype))
+    buckets = mono.reshape((-1, bucket_size))
+    return buckets.min(axis=1), buckets.max(axis=1)
+
+
+def _level_lengths(num_frames):
+    lengths = [max(1, -(-num_frames // BASE_BUCKET))]
+    while lengths[-1] > 1:
+        lengths.append(-(-lengths[-1] // 2))
+    return lengths
+
+
+def envelope_outline(x, y):
+    """
+    Returns the outline of the zigzag of an envelope, along the maxima and back along
+    the minima, to fill as one polygon. Agg fills it in a few ms, while stroking the
+    zigzag takes tens of ms.
+
+    Args:
+        x (np.array): The positions of the points returned by WaveformPyramid.envelope.
+        y (np.array): The values of the points.
+
+    Returns:
+        np.array: The (n, 2) vertices of the outline, or None if the points are
+            samples rather than minimums and maximums.
+    """
+    if len(x) < 2 or x[0] != x[1]:
+        return None
+    centers = x[0::2]
+    return np.concatenate((np.column_stack((centers, y[1::2])),
+                           np.column_stack((centers[::-1], y[0::2][::-1]))))
+
+
+class WaveformPyramid:
+    """
+    The WaveformPyramid class holds the min/max envelope of the audio at power-of-two
+    resolutions.
+
+    Attributes:
+        num_frames (int): The number of frames of the audio.
+        mins (list): The bucket minimums of every level.
+        maxs (list): The bucket maximums of every level.
+    """
+
+    def __init__(self, num_frames, mins, maxs):
+        self.num_frames = num_frames
+        self.mins = mins
+        self.maxs = maxs
+
+    @classmethod
+    def build(cls, audio_array):
+        """
+        Builds the pyramid of an audio array.
+        """
+        num_frames = audio_array.shape[-1]
+        if num_frames == 0:
+            empty = np.zeros(1, dtype=audio_array.dtype)
+            return cls(0, [empty], [empty.copy()])
+        mins, maxs = _bucket_envelope(audio_array, BASE_BUCKET)
+        level_mins, level_maxs = [mins], [maxs]
+        while len(level_mins[-1]) > 1:
+            mins, maxs = _reduce_level(level_mins[-1], level_maxs[-1])
+            level_mins.append(mins)
+            level_maxs.append(maxs)
+        return cls(num_frames, level_mins, level_maxs)
+
+    @classmethod
+    def zeros(cls, num_frames, dtype):
+        """
+        Returns the pyramid of silent audio, to be filled with update.
+        """
+        lengths = _level_lengths(num_frames)
+        return cls(num_frames, [np.zeros(length, dtype=dtype) for length in lengths],
+                   [np.zeros(length, dtype=dtype) for length in lengths])
+
+    def update(self, audio_array, start_frame, end_frame):
+        """
+        Recomputes the buckets covering the given frames, e.g. after more audio was
+        decoded into the array.
+        """
+        first = start_frame // BASE_BUCKET
+        last = min(-(-end_frame // BASE_BUCKET), len(self.mins[0]))
+        if first >= last:
+            return
+        self.update_block(
+            audio_array[..., first * BASE_BUCKET:min(last * BASE_BUCKET, self.num_frames)],
+            first * BASE_BUCKET)
+
+    def update_block(self, block, start_frame):
+        """
+        Recomputes the buckets of a block of audio that starts at start_frame, a
+        multiple of BASE_BUCKET, e.g. a chunk of audio that is not held in full.
+        """
+        first = start_frame // BASE_BUCKET
+        mins, maxs = _bucket_envelope(block, BASE_BUCKET)
+        last = first + len(mins)
+        self.mins[0][first:last] = mins
+        self.maxs[0][first:last] = maxs
+        for level in range(1, len(self.mins)):
+            first //= 2
+            last = min(-(-last // 2), len(self.mins[level]))
+            below_mins = self.mins[level - 1][2 * first:2 * last]
+            below_maxs = self.maxs[level - 1][2 * first:2 * last]
+            mins, maxs = _reduce_level(below_mins, below_maxs)
+            self.mins[level][first:last] = mins
+            self.maxs[level][first:last] = maxs
+
+    def bucket_size(self, level):
+        return BASE_BUCKET << level
+
+    def level_for(self, frames_per_pixel):
+        """
+        Returns the coarsest level that still has at least one bucket per pixel.
+        """
+        level = 0
+        while (level + 1 < len(self.mins)
+               and self.bucket_size(level + 1) <= frames_per_pixel):
+            level += 1
+        return level
+
+    def envelope(self, audio_array, start_frame, end_frame, num_pixels):
+        """
+        Returns the points to draw the frames from start_frame to end_frame on a line
+        num_pixels wide.
+
+        When the window has fewer than two frames per pixel the samples themselves
+        are returned. Otherwise the minimum and the maximum of every bucket are
+        returned one after the other, a zigzag that envelope_outline turns into a
+        polygon to fill.
+
+        Returns:
+            tuple: The frame positions and the values of the points.
+        """
+        start_frame = max(0, int(start_frame))
+        end_frame = min(self.num_frames, int(end_frame))
+        if end_frame <= start_frame:
+            return np.zeros(0), np.zeros(0)
+
+        frames_per_pixel = (end_frame - start_frame) / max(1, num_pixels)
+        if frames_per_pixel < 2 * BASE_BUCKET:
+            x = np.arange(start_frame, end_frame)
+            return x, to_mono(audio_array[..., start_frame:end_frame])
+
+        level = self.level_for(frames_per_pixel)
+        bucket_size = self.bucket_size(level)
+        first = start_frame // bucket_size
+        last = -(-end_frame // bucket_size)
+        x = np.repeat(np.arange(first, last) * bucket_size + bucket_size // 2, 2)
+        y = np.column_stack((self.mins[level][first:last],
+                             self.maxs[level][first:last])).ravel()
+        return x, y
+
+    def nbytes(self):
+        return sum(level.nbytes for level in self.mins + self.maxs)
+
+    def to_array(self):
+        """
+        Returns the pyramid packed into one (2, n) array, for the cache.
+        """
+        return np.stack((np.concatenate(self.mins), np.concatenate(self.maxs)))
+
+    @classmethod
+    def from_array(cls, array, num_frames):
+        """
+        Unpacks a pyramid packed by to_array.
+        """
+        lengths = _level_lengths(num_frames)
+        if sum(lengths) != array.shape[1]:
+            return None
+        offsets = np.cumsum([0] + lengths)
+        mins = [array[0, offsets[i]:offsets[i + 1]] for i in range(len(lengths))]
+        maxs = [array[1, offsets[i]:offsets[i + 1]] for i in range(len(lengths))]
+        return cls(num_frames, mins, maxs)
@@ -0,0 +1,204 @@
+"""
+This module contains the real-time time stretching of the playback.
+
+The StretchJob of stretch.py renders a region with librosa's phase vocoder, which
+sounds best but has to finish a chunk before it plays. The live mode instead stretches
+inside the output with WSOLA (waveform similarity overlap-add): every hop of output
+overlap-adds one Hann-windowed frame of the source, taken near the nominal position
+for the rate, at the offset whose waveform best continues the previous frame. The
+cost is one short cross-correlation per hop, so the rate can change between any two
+output blocks and takes effect a few blocks later.
+
+The stretcher measures the time it spends per block against the block duration. When
+it exceeds CPU_BUDGET, the search range is halved, down to MIN_TOLERANCE, and grown
+back when there is room, so a slow core degrades the quality rather than underrunning.
+The range is reported through telemetry rather than printed, as it changes on the audio
+thread.
+
+    python wsola.py --seconds 30  # measure the cost per block at several rates
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import telemetry
+from pcm import to_mono
+
+# Length of the overlap-added frames, about 23 ms at 44.1 kHz. The hop is half of it.
+FRAME_LENGTH = 1024
+# Largest offset in frames searched around the nominal position
+TOLERANCE = 256
+MIN_TOLERANCE = 16
+# Fraction of the block duration the stretching may take
+CPU_BUDGET = 0.25
+# Weight of a new block in the running load estimate
+LOAD_SMOOTHING = 0.1
+# Number of blocks between two changes of the search range, so the load settles
+ADAPT_BLOCKS = 32
+
+
+class WsolaStretcher:
+    """
+    The WsolaStretcher class stretches a looped source array block by block.
+
+    Attributes:
+        rate (float): The stretch rate, below 1 slows down. It may be changed at any
+            time and applies from the next hop.
+        position (float): The nominal source frame of the next frame.
+        tolerance (int): The current search range in frames.
+        load (float): The running fraction of the block duration spent stretching.
+    """
+
+    def __init__(self, sample_rate, frame_length=FRAME_LENGTH, tolerance=TOLERANCE):
+        self.sample_rate = sample_rate
+        self.frame_length = frame_length
+        self.hop = frame_length // 2
+        # A periodic Hann window sums to one at half overlap
+        self.window = np.hanning(frame_length + 1)[:-1].astype(np.float32)
+        self.max_tolerance = tolerance
+        self.tolerance = tolerance
+        self.rate = 1.0
+        self.load = 0.0
+        self.blocks_since_adapt = 0
+        self.reset(0)
+
+    def reset(self, position):
+        """
+        Restarts the stretching at a source frame, e.g. after a seek.
+        """
+        self.position = float(position)
+        self.previous = None
+        self.overlap = None
+        self.pending = None
+        self.pending_position = float(position)
+
+    @staticmethod
+    def segment(source, start, length):
+        """
+        Returns the frames of the source from start, wrapping at its end.
+        """
+        num_frames = source.shape[-1]
+        start %= num_frames
+        if start + length <= num_frames:
+            return source[..., start:start + length]
+        return source[..., np.arange(start, start + length) % num_frames]
+
+    def step(self, source):
+        """
+        Overlap-adds the next frame.
+
+        Returns:
+            tuple: The hop of finished output frames and the source frame they start at.
+        """
+        nominal = int(round(self.position))
+        if self.previous is not None and self.rate == 1.0:
+            # Unstretched, the frame following the previous one is an exact match
+            chosen = self.previous + self.hop
+            self.position = chosen
+        elif self.previous is None or self.tolerance == 0:
+            chosen = nominal
+        else:
+            # The frame that would follow the previous one without stretching
+            natural = to_mono(self.segment(source, self.previous + self.hop,
+                                           self.frame_length))
+            region = to_mono(self.segment(source, nominal - self.tolerance,
+                                          self.frame_length + 2 * self.tolerance))
+            similarity = np.correlate(region, natural, mode="valid")
+            chosen = nominal - self.tolerance + int(np.argmax(similarity))
+
+        frame = self.segment(source, chosen, self.frame_length) * self.window
+        output = frame[..., :self.hop]
+        if self.overlap is not None:
+            output += self.overlap
+        self.overlap = frame[..., self.hop:]
+        self.previous = chosen
+        self.position += self.hop * self.rate
+        return output, chosen
+
+    def read(self, source, count):
+        """
+        Returns the next count output frames, stretched from the source.
+        """
+        started = time.perf_counter()
+        hops = [] if self.pending is None else [self.pending]
+        available = 0 if self.pending is None else self.pending.shape[-1]
+        while available < count:
+            output, chosen = self.step(source)
+            if available == 0:
+                self.pending_position = chosen
+            hops.append(output)
+            available += output.shape[-1]
+        frames = np.concatenate(hops, axis=-1) if len(hops) > 1 else hops[0]
+        self.pending = frames[..., count:] if available > count else None
+        self.pending_position += count * self.rate
+
+        elapsed = time.perf_counter() - started
+        telemetry.recorder.record("live stretch block", elapsed)
+        self.adapt(elapsed, count / self.sample_rate)
+        return frames[..., :count]
+
+    def source_position(self, num_frames):
+        """
+        Returns the source frame of the next output frame, in a source of the given
+        length.
+        """
+        return int(self.pending_position) % num_frames
+
+    def adapt(self, elapsed, block_seconds):
+        """
+        Halves the search range when the stretching takes more than CPU_BUDGET of
+        the block duration, and doubles it when it takes less than a quarter of that.
+        """
+        self.load += LOAD_SMOOTHING * (elapsed / block_seconds - self.load)
+        self.blocks_since_adapt += 1
+        if self.blocks_since_adapt < ADAPT_BLOCKS:
+            return
+        if self.load > CPU_BUDGET and self.tolerance > MIN_TOLERANCE:
+            self.tolerance //= 2
+        elif self.load < CPU_BUDGET / 4 and self.tolerance < self.max_tolerance:
+            self.tolerance *= 2
+        else:
+            return
+        self.blocks_since_adapt = 0
+        telemetry.recorder.set_value("live search range", self.tolerance)
+
+
+def benchmark(seconds, block_frames, sample_rate=44100):
+    """
+    Measures the time per block of the stretching at several rates and search ranges
+    against the block duration.
+    """
+    rng = np.random.default_rng(0)
+    times = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = np.sin(2 * np.pi * 220 * times) * 0.3 + rng.standard_normal(len(times)) * 0.02
+    audio = np.stack((audio, audio)).astype(np.float32)
+    block_ms = block_frames / sample_rate * 1000
+
+    for tolerance in (TOLERANCE, TOLERANCE // 4, MIN_TOLERANCE):
+        for rate in (1.0, 0.8, 0.5):
+            stretcher = WsolaStretcher(sample_rate, tolerance=tolerance)
+            # Fixed search range, so that every block is measured at it
+            stretcher.adapt = lambda elapsed, block_seconds: None
+            stretcher.rate = rate
+            block_times = []
+            for _ in range(int(seconds * sample_rate) // block_frames):
+                started = time.perf_counter()
+                stretcher.read(audio, block_frames)
+                block_times.append((time.perf_counter() - started) * 1000)
+            block_times.sort()
+            p99 = block_times[int(0.99 * (len(block_times) - 1))]
+            print(f"search {tolerance:3} rate {rate:.2f}: "
+                  f"mean {np.mean(block_times):.2f} ms, p99 {p99:.2f} ms per "
+                  f"{block_ms:.1f} ms block ({np.mean(block_times) / block_ms:.1%} "
+                  f"of a core, budget {CPU_BUDGET:.0%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the cost of the real-time stretching per output block.")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--block", type=int, default=1024)
+    args = parser.parse_args()
+    benchmark(args.seconds, args.block)